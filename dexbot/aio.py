@@ -0,0 +1,330 @@
+"""
+An asyncio runtime for workers
+
+``AsyncWorkerInfrastructure`` is a drop-in alternative to
+:class:`dexbot.worker.WorkerInfrastructure`. Notifications from ``Notify``
+are handed to an event loop, so one slow worker no longer holds up all the
+others.
+
+Strategy event handlers can be coroutines::
+
+    class Strategy(BaseStrategy):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.ontick += self.tick
+
+        async def tick(self, block):
+            ticker = await dexbot.aio.call(self.market.ticker)
+            ...
+
+Ordinary (blocking) handlers run unchanged on a bounded thread pool, so
+hundreds of workers don't need hundreds of threads. A worker's handlers are
+always run one at a time and in the order the events arrived; handlers of
+different workers interleave.
+
+Each pool thread gets its own connection to the node for queries, while
+broadcasts all go through the one transaction buffer and are serialised.
+Bundled transactions (the ``bundle`` worker option) aren't supported by this
+runtime.
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bitsharesapi.bitsharesnoderpc import BitSharesNodeRPC
+
+from dexbot import metrics
+from dexbot import tracing
+from dexbot.coalesce import account_key
+from dexbot.worker import WorkerInfrastructure
+
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 8
+
+# Before Python 3.7 the loop running a coroutine is the thread's event loop
+get_running_loop = getattr(asyncio, 'get_running_loop', None) or asyncio.get_event_loop
+all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+
+
+async def call(func, *args, **kwargs):
+    """ Await a blocking call (RPC, order placement...) run on the runtime's thread pool
+    """
+    loop = get_running_loop()
+    # keep the caller's context (the worker metrics are attributed to)
+    if contextvars is not None:
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+    return await loop.run_in_executor(
+        None, functools.partial(run_as, metrics.registry.current.get(), func, *args, **kwargs))
+
+
+def run_as(current, func, *args, **kwargs):
+    """ Without contextvars: call func with the metrics' current event set to current """
+    token = metrics.registry.current.set(current)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.registry.current.reset(token)
+
+
+class ThreadLocalRPC:
+    """ Stands in for ``BitShares.rpc``: every thread other than the one that
+        made the original connection gets a connection of its own, logged on
+        with the original's user and password
+    """
+
+    def __init__(self, rpc, node):
+        self.rpc = rpc
+        self.node = node
+        self.owner = threading.current_thread()
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    def connection(self):
+        if threading.current_thread() is self.owner:
+            return self.rpc
+        rpc = getattr(self.local, 'rpc', None)
+        if rpc is None:
+            rpc = self.local.rpc = BitSharesNodeRPC(
+                self.node, getattr(self.rpc, 'user', '') or '', getattr(self.rpc, 'password', '') or '')
+            metrics.instrument_rpc(rpc)
+            tracing.instrument_rpc(rpc)
+            with self.connections_lock:
+                self.connections.append(rpc)
+        return rpc
+
+    def close(self):
+        """ Close the threads' connections (not the original one) """
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for rpc in connections:
+            ws = getattr(rpc, 'ws', None)
+            if ws is not None:
+                try:
+                    ws.close()
+                except Exception:
+                    log.debug("Cannot close a node connection", exc_info=True)
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+
+
+class Turn:
+    """ A place in a worker's line of events
+
+        Taking a turn doesn't wait, so it can be taken as an event arrives and
+        used after other awaits: the worker still handles its events in the
+        order they arrived. Must be made on the loop, and always released
+    """
+
+    def __init__(self, previous):
+        self.previous = previous
+        self.done = get_running_loop().create_future()
+
+    async def wait(self):
+        """ Wait for the turns before this one to be over """
+        if self.previous is not None:
+            await asyncio.shield(self.previous)
+
+    def release(self):
+        """ Let the next turn go, once the ones before this are over """
+        if self.previous is None or self.previous.done():
+            if not self.done.done():
+                self.done.set_result(None)
+        else:
+            self.previous.add_done_callback(lambda future: self.release())
+
+
+class AsyncWorkerInfrastructure(WorkerInfrastructure):
+
+    def __init__(self, config, bitshares_instance=None, view=None, max_threads=DEFAULT_THREADS):
+        super().__init__(config, bitshares_instance=bitshares_instance, view=view)
+        self.max_threads = max_threads
+        self.loop = None
+        self.executor = None
+        self.turns = {}  # worker name: the done future of its last Turn
+        self.broadcast_lock = threading.Lock()
+
+    def share_bitshares(self):
+        """ Make the BitShares instance safe to use from the thread pool
+        """
+        self.bitshares.rpc = ThreadLocalRPC(self.bitshares.rpc, self.config['node'])
+        finalize = self.bitshares.finalizeOp
+
+        def locked_finalize(*args, **kwargs):
+            with self.broadcast_lock:
+                return finalize(*args, **kwargs)
+        self.bitshares.finalizeOp = locked_finalize
+
+    def submit(self, coro):
+        """ Schedule a coroutine on the event loop from any thread """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def take_turn(self, worker_name):
+        """ The worker's next Turn (on the loop) """
+        turn = Turn(self.turns.get(worker_name))
+        self.turns[worker_name] = turn.done
+        return turn
+
+    def reload_config(self, config):
+        """ Like WorkerInfrastructure.reload_config(), but on the loop: it waits for
+            the workers it changes or removes to finish the events that came before,
+            and they get no more until it is done
+            Returns a concurrent.futures.Future of (added, changed, removed)
+        """
+        return self.submit(self.reload_async(config))
+
+    async def reload_async(self, config):
+        with self.config_lock:
+            old, new = self.config['workers'], config.get('workers') or {}
+            turns = [self.take_turn(worker_name) for worker_name in old if new.get(worker_name) != old[worker_name]]
+        try:
+            await asyncio.gather(*[turn.wait() for turn in turns])
+            return await call(super().reload_config, config)
+        finally:
+            for turn in turns:
+                turn.release()
+
+    # Events: these arrive on the Notify thread and are handed to the loop
+    def on_block(self, data):
+        if self.recorder:
+            self.recorder.on_block(data)
+        self.submit(self.on_block_async(data))
+
+    def on_market(self, data):
+        if self.recorder:
+            self.recorder.on_market(data)
+        if data.get("deleted", False):  # No info available on deleted orders
+            return
+        self.submit(self.on_market_async(data))
+
+    def on_account(self, account_update):
+        if self.recorder:
+            self.recorder.on_account(account_update)
+        self.submit(self.on_account_async(account_update))
+
+    async def on_block_async(self, data):
+        self.coalescer.new_block()
+        # the workers' turns are taken now, before awaiting anything: an event
+        # arriving during the housekeeping below is handled after this block
+        with self.config_lock:
+            reporters = list(self.reporters)
+            turns = {worker_name: self.take_turn(worker_name) for worker_name in self.block_targets()}
+        try:
+            await call(self.run_jobs)
+            await call(self.save_metrics)
+            await call(self.profiler.maybe_flush)
+            for reporter in reporters:
+                await call(reporter.ontick)
+        except BaseException:
+            for turn in turns.values():
+                turn.release()
+            raise
+        now = time.time()
+        for worker_name in turns:
+            self.last_tick[worker_name] = now
+        await asyncio.gather(*[self.dispatch_async(worker_name, 'ontick', data, turn)
+                               for worker_name, turn in turns.items()])
+        await call(self.take_snapshots)
+        if self.exporter:
+            await call(self.exporter.on_block)
+
+    async def on_market_async(self, data):
+        self.coalescer.invalidate(('market', data.market))
+        with self.config_lock:
+            turns = {worker_name: self.take_turn(worker_name) for worker_name in self.market_targets(data.market)}
+        await asyncio.gather(*[self.dispatch_async(worker_name, 'onMarketUpdate', data, turn)
+                               for worker_name, turn in turns.items()])
+
+    async def on_account_async(self, account_update):
+        # which workers use the account isn't known until it is fetched: take
+        # every worker's turn and give back those of the others
+        with self.config_lock:
+            turns = {worker_name: self.take_turn(worker_name) for worker_name in self.workers}
+        targets = set()
+        try:
+            account = await call(lambda: account_update.account)
+            self.coalescer.invalidate(account_key(account['name']))
+            with self.config_lock:
+                targets = set(self.account_targets(account['name']))
+        finally:
+            for worker_name in set(turns) - targets:
+                turns.pop(worker_name).release()
+        await asyncio.gather(*[self.dispatch_async(worker_name, 'onAccount', account_update, turn)
+                               for worker_name, turn in turns.items()])
+
+    async def dispatch_async(self, worker_name, event, data, turn=None):
+        """ Like dispatch() but coroutine handlers are awaited and the others run on the pool
+            turn: the worker's Turn for this event, if it was taken already
+        """
+        if turn is None:
+            turn = self.take_turn(worker_name)
+        try:
+            await turn.wait()
+            # looked up once it's our turn: a reload may have replaced the worker
+            worker = self.workers.get(worker_name)
+            if worker is None:
+                return
+            registry = metrics.registry
+            token = registry.enter_event(worker_name)
+            try:
+                with registry.timer('callback_seconds', worker=worker_name, event=event):
+                    for handler in list(getattr(worker, event)):
+                        await self.run_handler(handler, data, worker_name)
+            except Exception as e:
+                registry.inc('callback_errors', worker=worker_name, event=event)
+                self.errors[worker_name] += 1
+                self.last_error[worker_name] = "{}: {}".format(type(e).__name__, e)
+                worker.log.exception("in {}()".format(event))
+                try:
+                    await self.run_handler(getattr(worker, 'error_' + event), e)
+                except Exception:
+                    worker.log.exception("in error_{}()".format(event))
+            finally:
+                registry.leave_event(token)
+        finally:
+            turn.release()
+
+    async def run_handler(self, handler, data, worker_name=None):
+        if asyncio.iscoroutinefunction(handler):
+            await handler(data)
+        else:
+            await call(self.profiler.wrap(worker_name, handler), data)
+
+    def listen(self):
+        try:
+            self.notify.listen()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        self.loop.set_default_executor(self.executor)
+        self.share_bitshares()
+        self.init_workers(self.config)
+        self.update_notify()
+        threading.Thread(target=self.listen, name="dexbot-notify", daemon=True).start()
+        try:
+            self.loop.run_forever()
+            # Let handlers already running finish
+            pending = all_tasks(self.loop)
+            if pending:
+                self.loop.run_until_complete(asyncio.wait(pending, timeout=30))
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+            if isinstance(self.bitshares.rpc, ThreadLocalRPC):
+                self.bitshares.rpc.close()
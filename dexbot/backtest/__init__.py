@@ -0,0 +1,8 @@
+"""
+Offline backtesting of strategies
+
+* :mod:`dexbot.backtest.feed` historical trade and order book files
+* :mod:`dexbot.backtest.engine` a simple matching engine
+* :mod:`dexbot.backtest.objects` stand-ins for Market, Account and Order
+* :mod:`dexbot.backtest.runner` runs a worker's strategy over a feed
+"""
@@ -0,0 +1,243 @@
+"""
+A simple DEX matching core for backtesting
+
+Knows nothing about BitShares objects: prices are floats in base per quote,
+amounts are floats in quote. The rest of the market (the "external" book) is
+replayed from historical data and our own orders are matched against it:
+
+* a new order that crosses the external book fills immediately, as a taker,
+  at the external prices (eating into the snapshot until the next one arrives)
+* a resting order fills, as a maker at its own price, when a historical trade
+  prints at or through it
+
+The engine looks after a single account's balances.
+"""
+
+from bisect import bisect_left, insort
+
+from dexbot.errors import InsufficientFundsError
+
+BUY = 'buy'
+SELL = 'sell'
+# amounts left below this after a fill are treated as nothing
+DUST = 1e-12
+
+
+class EngineOrder:
+    __slots__ = ('id', 'side', 'price', 'amount', 'initial', 'created')
+
+    def __init__(self, order_id, side, price, amount, created):
+        self.id = order_id
+        self.side = side
+        self.price = price
+        self.amount = amount
+        self.initial = amount
+        self.created = created
+
+
+class Fill:
+    __slots__ = ('order_id', 'side', 'price', 'amount', 'stamp', 'maker')
+
+    def __init__(self, order_id, side, price, amount, stamp, maker):
+        self.order_id = order_id
+        self.side = side
+        self.price = price
+        self.amount = amount
+        self.stamp = stamp
+        self.maker = maker
+
+
+class MatchingEngine:
+
+    def __init__(self, quote=0.0, base=0.0, fee=0.0):
+        """
+        quote, base: starting balances
+        fee: fraction of the received amount taken as market fee
+        """
+        self.free = {BUY: base, SELL: quote}  # keyed by the side spending the asset
+        self.fee = fee
+        self.bids = []  # external book: [price, amount] best first
+        self.asks = []
+        self.last_price = None
+        self.now = 0.0
+        self.orders = {}
+        # sorted keys of our resting orders, best first
+        self.own_bids = []  # (-price, seq, id)
+        self.own_asks = []  # (price, seq, id)
+        self.seq = 0
+        self.fills = []
+        self.orders_placed = 0
+
+    # Balances
+    @property
+    def quote(self):
+        """ Free quote balance """
+        return self.free[SELL]
+
+    @property
+    def base(self):
+        """ Free base balance """
+        return self.free[BUY]
+
+    def locked(self):
+        """ (quote, base) held in our open orders """
+        quote = sum(o.amount for o in self.orders.values() if o.side == SELL)
+        base = sum(o.amount * o.price for o in self.orders.values() if o.side == BUY)
+        return quote, base
+
+    def _receive(self, side, price, amount):
+        """ Credit the proceeds of filling amount at price on side """
+        if side == BUY:
+            self.free[SELL] += amount * (1 - self.fee)
+        else:
+            self.free[BUY] += amount * price * (1 - self.fee)
+
+    # External market
+    def set_book(self, bids, asks):
+        """ Replace the external book with a snapshot, lists of (price, amount) """
+        self.bids = sorted(([p, a] for p, a in bids), reverse=True)
+        self.asks = sorted([p, a] for p, a in asks)
+
+    def trade(self, price, amount, side=None):
+        """ A historical trade of amount at price
+            side is the taker's side, if known: a seller only fills our buys
+            and a buyer our sells
+            Returns the list of our fills
+        """
+        self.last_price = price
+        fills = []
+        if side != BUY:
+            fills += self._fill_resting(self.own_bids, BUY, price, amount)
+        if side != SELL:
+            fills += self._fill_resting(self.own_asks, SELL, price, amount)
+        return fills
+
+    def _fill_resting(self, keys, side, price, amount):
+        fills = []
+        n = 0
+        while n < len(keys) and amount > DUST:
+            order = self.orders[keys[n][2]]
+            if (side == BUY and order.price < price) or (side == SELL and order.price > price):
+                break
+            done = min(order.amount, amount)
+            amount -= done
+            order.amount -= done
+            self._receive(side, order.price, done)
+            fills.append(self._record(order, order.price, done, True))
+            if order.amount <= DUST:
+                del self.orders[order.id]
+                n += 1
+        del keys[:n]
+        return fills
+
+    def _record(self, order, price, amount, maker):
+        fill = Fill(order.id, order.side, price, amount, self.now, maker)
+        self.fills.append(fill)
+        return fill
+
+    # Our orders
+    def place(self, side, price, amount, killfill=False):
+        """ Place an order, returns (order id, list of immediate fills)
+        """
+        cost = amount * price if side == BUY else amount
+        if cost > self.free[side] * (1 + 1e-9):
+            raise InsufficientFundsError("insufficient balance to {} {} @ {}".format(side, amount, price))
+        self.free[side] -= min(cost, self.free[side])
+        self.seq += 1
+        self.orders_placed += 1
+        order = EngineOrder('1.7.{}'.format(self.seq), side, price, amount, self.now)
+        self.orders[order.id] = order
+
+        fills = self._take(order)
+        if order.amount > DUST:
+            if killfill:
+                self._refund(order)
+                del self.orders[order.id]
+            elif side == BUY:
+                insort(self.own_bids, (-price, self.seq, order.id))
+            else:
+                insort(self.own_asks, (price, self.seq, order.id))
+        else:
+            del self.orders[order.id]
+        return order.id, fills
+
+    def _take(self, order):
+        """ Match a new order against the external book """
+        fills = []
+        if order.side == BUY:
+            levels = self.asks
+            crosses = lambda p: p <= order.price  # noqa: E731
+        else:
+            levels = self.bids
+            crosses = lambda p: p >= order.price  # noqa: E731
+        n = 0
+        while n < len(levels) and order.amount > DUST and crosses(levels[n][0]):
+            level = levels[n]
+            done = min(level[1], order.amount)
+            level[1] -= done
+            order.amount -= done
+            if order.side == BUY:
+                # we locked funds at our price but paid the (better) book price
+                self.free[BUY] += done * (order.price - level[0])
+            self._receive(order.side, level[0], done)
+            fills.append(self._record(order, level[0], done, False))
+            self.last_price = level[0]
+            if level[1] <= DUST:
+                n += 1
+        del levels[:n]
+        return fills
+
+    def cancel(self, order_id):
+        """ Cancel one of our orders, returns False if it doesn't exist (any more) """
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return False
+        self._refund(order)
+        if order.side == BUY:
+            keys, key = self.own_bids, (-order.price,)
+        else:
+            keys, key = self.own_asks, (order.price,)
+        i = bisect_left(keys, key)
+        while keys[i][2] != order_id:
+            i += 1
+        del keys[i]
+        return True
+
+    def _refund(self, order):
+        """ Return what's left of an order to the free balance """
+        if order.side == BUY:
+            self.free[BUY] += order.amount * order.price
+        else:
+            self.free[SELL] += order.amount
+
+    # Market data
+    def best_bid(self):
+        prices = []
+        if self.bids:
+            prices.append(self.bids[0][0])
+        if self.own_bids:
+            prices.append(-self.own_bids[0][0])
+        return max(prices) if prices else None
+
+    def best_ask(self):
+        prices = []
+        if self.asks:
+            prices.append(self.asks[0][0])
+        if self.own_asks:
+            prices.append(self.own_asks[0][0])
+        return min(prices) if prices else None
+
+    def ready(self):
+        """ True once there is a price to trade around """
+        return self.last_price is not None or (bool(self.bids) and bool(self.asks))
+
+    def book(self, limit=25):
+        """ The combined order book, (bids, asks) lists of (price, amount, own order id or None)
+        """
+        bids = [(p, a, None) for p, a in self.bids[:limit]]
+        bids += [(-k[0], self.orders[k[2]].amount, k[2]) for k in self.own_bids[:limit]]
+        asks = [(p, a, None) for p, a in self.asks[:limit]]
+        asks += [(k[0], self.orders[k[2]].amount, k[2]) for k in self.own_asks[:limit]]
+        bids.sort(key=lambda x: -x[0])
+        asks.sort(key=lambda x: x[0])
+        return bids[:limit], asks[:limit]
@@ -0,0 +1,81 @@
+"""
+Historical market data for backtests
+
+A feed is a CSV file (gzipped if the name ends in .gz) with one event per line::
+
+    timestamp,kind,side,price,amount
+
+timestamp
+    Unix time in seconds
+kind
+    ``trade``: a trade of amount (in quote) at price (base per quote), side is
+    the taker's side ``buy`` or ``sell``, or empty if unknown
+
+    ``book``: one level of an order book snapshot, side is ``bid`` or ``ask``.
+    The book lines sharing a timestamp make up a snapshot, which replaces the
+    previous one
+
+Blank lines, a header line and lines starting with ``#`` are skipped. Several
+feeds (e.g. one of trades and one of snapshots) are merged by timestamp.
+"""
+
+import csv
+import gzip
+import heapq
+from operator import itemgetter
+
+TRADE = 'trade'
+BOOK = 'book'
+
+
+def open_feed(path, mode='rt'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode.replace('t', ''), newline='')
+
+
+def read_feed(path):
+    """ Yield (timestamp, kind, side, price, amount) tuples from a feed file
+    """
+    with open_feed(path) as fd:
+        for row in csv.reader(fd):
+            if not row or row[0].startswith('#') or row[0] == 'timestamp':
+                continue
+            yield (float(row[0]), row[1], row[2] or None, float(row[3]), float(row[4]))
+
+
+def events(paths):
+    """ Merge feed files and group book lines into snapshots
+
+        Yields ('trade', timestamp, side, price, amount) and
+        ('book', timestamp, bids, asks) tuples, in time order
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    rows = heapq.merge(*[read_feed(path) for path in paths], key=itemgetter(0))
+    snapshot = None
+    for stamp, kind, side, price, amount in rows:
+        if snapshot is not None and (kind != BOOK or stamp != snapshot[1]):
+            yield snapshot
+            snapshot = None
+        if kind == TRADE:
+            yield (TRADE, stamp, side, price, amount)
+        elif kind == BOOK:
+            if snapshot is None:
+                snapshot = (BOOK, stamp, [], [])
+            if side == 'bid':
+                snapshot[2].append((price, amount))
+            else:
+                snapshot[3].append((price, amount))
+    if snapshot is not None:
+        yield snapshot
+
+
+def write_feed(path, rows):
+    """ Write (timestamp, kind, side, price, amount) rows to a feed file
+    """
+    with open_feed(path, 'wt') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(['timestamp', 'kind', 'side', 'price', 'amount'])
+        for stamp, kind, side, price, amount in rows:
+            writer.writerow([stamp, kind, side or '', price, amount])
@@ -0,0 +1,240 @@
+"""
+Stand-ins for the python-bitshares objects a strategy uses, backed by a
+:class:`dexbot.backtest.engine.MatchingEngine` instead of a node
+
+They only implement what dexbot's strategies need. Install a
+:class:`SimBitShares` as the shared instance (the Backtest runner does) so
+python-bitshares objects created along the way never try to connect.
+"""
+
+from bitshares.amount import Amount
+from bitshares.asset import Asset
+from bitshares.price import FilledOrder
+
+from dexbot.backtest.engine import BUY, SELL
+
+ACCOUNT_ID = '1.2.1'
+FOREIGN_ACCOUNT_ID = '1.2.0'
+
+
+class SimAsset(Asset):
+    """ An Asset that never goes to the node """
+
+    def __init__(self, asset_id, symbol, precision, bitshares_instance=None):
+        dict.__init__(self, {'id': asset_id, 'symbol': symbol, 'precision': precision})
+        self.identifier = asset_id
+        self.cached = True
+        self.lazy = False
+        self.full = False
+        self.blockchain = bitshares_instance
+
+
+class SimPrice(dict):
+    """ A ticker price: float() gives the price, like bitshares.price.Price """
+
+    def __init__(self, price):
+        super().__init__(price=price or 0.0)
+
+    def __float__(self):
+        return float(self['price'])
+
+
+class SimOrder(dict):
+    """ An open (or deleted) order, laid out like bitshares.price.Order:
+        base is what is being sold, so sell orders have an inverted price
+    """
+
+    def __init__(self, data, market=None):
+        super().__init__(data)
+        self.market = market
+
+    @classmethod
+    def from_engine(cls, order, market):
+        quote = market['quote']
+        base = market['base']
+        if order.side == BUY:
+            data = {'base': Amount(amount=order.amount * order.price, asset=base),
+                    'quote': Amount(amount=order.amount, asset=quote),
+                    'price': order.price}
+        else:
+            data = {'base': Amount(amount=order.amount, asset=quote),
+                    'quote': Amount(amount=order.amount * order.price, asset=base),
+                    'price': 1 / order.price}
+        data['id'] = order.id
+        data['deleted'] = False
+        data['for_sale'] = data['base']
+        return cls(data, market.market)
+
+    def invert(self):
+        self['base'], self['quote'] = self['quote'], self['base']
+        if self.get('price'):
+            self['price'] = 1 / self['price']
+        return self
+
+
+class SimFilledOrder(FilledOrder):
+    """ A fill notification, as passed to onMarketUpdate """
+
+    def __init__(self, data, market=None):
+        dict.__init__(self, data)
+        self.blockchain = None
+        self.sim_market = market
+
+    @property
+    def market(self):
+        # the market string, Price.market would look the assets up
+        return self.sim_market
+
+    @classmethod
+    def from_fill(cls, fill, market, account_id=ACCOUNT_ID):
+        quote = Amount(amount=fill.amount, asset=market['quote'])
+        base = Amount(amount=fill.amount * fill.price, asset=market['base'])
+        return cls({'account_id': account_id,
+                    'order_id': fill.order_id,
+                    'quote': quote,
+                    'base': base,
+                    'price': fill.price,
+                    'time': fill.stamp,
+                    'is_maker': fill.maker}, market.market)
+
+
+class SimAccountUpdate(dict):
+    """ What onAccount handlers get """
+
+    def __init__(self, account):
+        super().__init__(id=account['id'], owner=account['id'])
+        self.account = account
+
+
+class SimMarket(dict):
+
+    def __init__(self, market, engine, quote, base, account=None):
+        """ market: the market string from the worker config ("QUOTE:BASE") """
+        super().__init__(quote=quote, base=base)
+        self.market = market
+        self.engine = engine
+        self.account = account
+
+    def get_string(self, separator=":"):
+        return "{}{}{}".format(self['quote']['symbol'], separator, self['base']['symbol'])
+
+    def ticker(self):
+        engine = self.engine
+        return {'latest': SimPrice(engine.last_price),
+                'highestBid': SimPrice(engine.best_bid()),
+                'lowestAsk': SimPrice(engine.best_ask())}
+
+    def orderbook(self, limit=25):
+        bids, asks = self.engine.book(limit)
+        return {'bids': [self._book_entry(p, a) for p, a, order_id in bids],
+                'asks': [self._book_entry(p, a) for p, a, order_id in asks]}
+
+    def _book_entry(self, price, amount):
+        return SimOrder({'base': Amount(amount=amount * price, asset=self['base']),
+                         'quote': Amount(amount=amount, asset=self['quote']),
+                         'price': price}, self.market)
+
+    def _place(self, side, price, amount, killfill, returnOrderId):
+        order_id, fills = self.engine.place(side, float(price), float(amount), killfill=killfill)
+        if returnOrderId:
+            return {'orderid': order_id}
+        return {}
+
+    def buy(self, price, amount, expiration=None, killfill=False, account=None, returnOrderId=False, **kwargs):
+        return self._place(BUY, price, amount, killfill, returnOrderId)
+
+    def sell(self, price, amount, expiration=None, killfill=False, account=None, returnOrderId=False, **kwargs):
+        return self._place(SELL, price, amount, killfill, returnOrderId)
+
+    def cancel(self, orderNumber, account=None, **kwargs):
+        if not isinstance(orderNumber, (list, set, tuple)):
+            orderNumber = [orderNumber]
+        for order_id in orderNumber:
+            self.engine.cancel(order_id)
+
+    def accountopenorders(self, account=None):
+        return [SimOrder.from_engine(o, self) for o in self.engine.orders.values()]
+
+
+class SimAccount(dict):
+
+    def __init__(self, name, market, account_id=ACCOUNT_ID):
+        super().__init__(id=account_id, name=name)
+        self.sim_market = market
+        market.account = self
+
+    @property
+    def name(self):
+        return self['name']
+
+    def refresh(self):
+        pass
+
+    def ensure_full(self):
+        pass
+
+    @property
+    def openorders(self):
+        return self.sim_market.accountopenorders()
+
+    def balance(self, symbol):
+        if isinstance(symbol, dict):
+            symbol = symbol['symbol']
+        quote = self.sim_market['quote']
+        base = self.sim_market['base']
+        if symbol == quote['symbol']:
+            return Amount(amount=self.sim_market.engine.quote, asset=quote)
+        if symbol == base['symbol']:
+            return Amount(amount=self.sim_market.engine.base, asset=base)
+        return 0.0
+
+    @property
+    def balances(self):
+        return [self.balance(self.sim_market['quote']), self.balance(self.sim_market['base'])]
+
+
+class SimTxBuffer:
+
+    def clear(self):
+        pass
+
+    def broadcast(self):
+        return {}
+
+
+class SimRPC:
+    """ Stands in for BitShares.rpc: answers the asset lookups python-bitshares
+        makes (Amount(1, 'USD') loads the asset) from the SimMarket's assets
+    """
+
+    def __init__(self, bitshares):
+        self.bitshares = bitshares
+
+    def rpcexec(self, payload):
+        api, name, args = payload['params']
+        return getattr(self, name)(*args)
+
+    def get_asset(self, identifier):
+        market = self.bitshares.market
+        for asset in (market['quote'], market['base']):
+            if identifier in (asset['id'], asset['symbol']):
+                return {'id': asset['id'], 'symbol': asset['symbol'], 'precision': asset['precision'],
+                        'options': {'issuer_permissions': 0, 'flags': 0, 'description': ''}}
+        return None
+
+    def get_assets(self, identifiers):
+        return [self.get_asset(identifier) for identifier in identifiers]
+
+
+class SimBitShares:
+    """ Stands in for the BitShares instance """
+
+    def __init__(self, market=None):
+        self.market = market
+        self.txbuffer = SimTxBuffer()
+        self.bundle = False
+        self.blocking = False
+        self.rpc = SimRPC(self)
+
+    def cancel(self, orderNumbers, account=None, **kwargs):
+        self.market.cancel(orderNumbers)
@@ -0,0 +1,309 @@
+"""
+Run a strategy against historical data
+
+::
+
+    test = Backtest(config, 'worker1', ['trades.csv.gz', 'books.csv.gz'], quote=100, base=1000)
+    result = test.run()
+    print(result.summary())
+
+The strategy class is the one named in the worker's config (``module``), run
+unmodified apart from a mixin that keeps its storage in memory instead of the
+sqlite database. Events are grouped into blocks of ``block_interval``
+seconds of feed time. For each block the strategy gets ``onMarketUpdate``
+for each of its fills, one ``onAccount`` if anything filled, then ``ontick``.
+
+Strategies that throttle themselves on ``datetime.now()`` see wall-clock
+time, not feed time, so their throttles behave differently in a backtest.
+"""
+
+import datetime
+import importlib
+import json
+import logging
+import time
+
+from bitshares.instance import set_shared_bitshares_instance
+
+from dexbot import storage
+from dexbot.backtest import feed
+from dexbot.backtest.engine import MatchingEngine, Fill
+from dexbot.backtest.objects import (
+    SimAsset, SimMarket, SimAccount, SimBitShares, SimOrder, SimFilledOrder,
+    SimAccountUpdate, FOREIGN_ACCOUNT_ID
+)
+
+log = logging.getLogger(__name__)
+
+BLOCK_INTERVAL = 3  # seconds, as on the BitShares chain
+
+
+class SimOrdersMixin:
+    """ Mixed into a strategy class: order lookups go to the matching engine
+        of its SimMarket
+    """
+
+    def sim_now(self):
+        return datetime.datetime.fromtimestamp(self.market.engine.now)
+
+    def get_order(self, order_id, return_none=True):
+        if not order_id:
+            return None
+        if 'id' in order_id:
+            order_id = order_id['id']
+        order = self.market.engine.orders.get(order_id)
+        if order is None:
+            if return_none:
+                return None
+            return SimOrder({'id': order_id, 'deleted': True}, self.market.market)
+        return SimOrder.from_engine(order, self.market)
+
+    @property
+    def updated_open_orders(self):
+        return self.market.accountopenorders()
+
+    @property
+    def orders(self):
+        return self.market.accountopenorders()
+
+    def write_order_log(self, worker_name, order):
+        # don't write simulated trades to the real orders log
+        pass
+
+
+class SimStrategyMixin(SimOrdersMixin):
+    """ Mixed into a strategy class for backtesting: storage is kept in memory
+        and order lookups go to the matching engine
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.sim_storage = {}
+        self.sim_orders = {}
+        self.sim_journal = []
+        super().__init__(*args, **kwargs)
+
+    # Storage
+    def __setitem__(self, key, value):
+        # same round trip as the database
+        self.sim_storage[key] = json.loads(json.dumps(value))
+
+    def __getitem__(self, key):
+        return self.sim_storage.get(key)
+
+    def __delitem__(self, key):
+        del self.sim_storage[key]
+
+    def __contains__(self, key):
+        return key in self.sim_storage
+
+    def items(self):
+        return [(k, json.dumps(v)) for k, v in self.sim_storage.items()]
+
+    def clear(self):
+        self.sim_storage.clear()
+
+    def save_journal(self, amounts):
+        now = self.sim_now()
+        for key, amount in amounts:
+            self.sim_journal.append((now, key, float(amount)))
+
+    def query_journal(self, start, end_=None):
+        return [row for row in self.sim_journal if row[0] > start and (end_ is None or row[0] < end_)]
+
+    def query_journal_arrays(self, start, end_=None, resolution='auto', value='last'):
+        return storage.journal_arrays(self.query_journal_buckets(start, end_, resolution, value))
+
+    def query_journal_buckets(self, start, end_=None, resolution='auto', value='last'):
+        start, auto = self.journal_window(start, end_)
+        if resolution == 'auto':
+            resolution = auto
+        return storage.bucket_rows(self.query_journal(start, end_), resolution, value)
+
+    def journal_window(self, start, end_=None):
+        start = storage.parse_start(start, self.sim_now())
+        return start, storage.pick_resolution(start, end_ or self.sim_now(), {})
+
+    def journal_high_water(self):
+        return len(self.sim_journal)
+
+    def query_log(self, start, end_=None):
+        return []
+
+    def iter_log(self, start, end_=None, chunk=None):
+        return iter(())
+
+    def query_log_tail(self, start, end_=None, limit=100):
+        return []
+
+    def query_log_summary(self, start, end_=None, top=10):
+        return {}, []
+
+    def save_order(self, order):
+        self.sim_orders[order['id']] = json.loads(json.dumps(order))
+
+    def remove_order(self, order):
+        self.sim_orders.pop(order['id'], None)
+
+    def clear_orders(self):
+        self.sim_orders.clear()
+
+    def fetch_orders(self, worker=None):
+        return dict(self.sim_orders) or None
+
+
+class BacktestResult:
+
+    def __init__(self, start, end, price, engine, events, elapsed, disabled):
+        """ start, end: (quote, base) total balances before and after """
+        self.start = start
+        self.end = end
+        self.price = price
+        self.fills = len(engine.fills)
+        self.orders_placed = engine.orders_placed
+        self.events = events
+        self.elapsed = elapsed
+        self.disabled = disabled
+
+    def value(self, balances):
+        """ The value of (quote, base) balances in base, at the final price """
+        return balances[0] * (self.price or 0.0) + balances[1]
+
+    @property
+    def profit(self):
+        """ Percentage gain in value over the run, at the final price """
+        start = self.value(self.start)
+        if not start:
+            return 0.0
+        return (self.value(self.end) - start) / start * 100
+
+    def as_dict(self):
+        return {
+            'start_quote': self.start[0],
+            'start_base': self.start[1],
+            'end_quote': self.end[0],
+            'end_base': self.end[1],
+            'final_price': self.price,
+            'profit': self.profit,
+            'fills': self.fills,
+            'orders_placed': self.orders_placed,
+            'events': self.events,
+            'elapsed': self.elapsed,
+            'disabled': self.disabled
+        }
+
+    def summary(self):
+        return ("{events} events in {elapsed:.1f}s, {orders_placed} orders placed, {fills} fills\n"
+                "quote {start_quote:.8g} -> {end_quote:.8g}, base {start_base:.8g} -> {end_base:.8g}\n"
+                "profit at final price {final_price}: {profit:.3f}%\n"
+                "disabled: {disabled}".format(**self.as_dict()))
+
+
+class Backtest:
+
+    def __init__(self, config, worker_name, feeds, quote=0.0, base=0.0, fee=0.0,
+                 block_interval=BLOCK_INTERVAL, notify_trades=False, precision=8):
+        """
+        config: dexbot config dict (only the worker's entry is used)
+        feeds: feed file path(s), see dexbot.backtest.feed
+        quote, base: starting balances
+        fee: market fee, as a fraction of amounts received
+        notify_trades: also send every historical trade to onMarketUpdate (slow)
+        """
+        self.worker_name = worker_name
+        self.worker = config['workers'][worker_name]
+        self.config = {'node': 'backtest', 'workers': {worker_name: self.worker}}
+        self.feeds = feeds
+        self.block_interval = block_interval
+        self.notify_trades = notify_trades
+
+        self.engine = MatchingEngine(quote=quote, base=base, fee=fee)
+        self.bitshares = SimBitShares()
+        quote_symbol, base_symbol = self.worker['market'].replace('/', ':').split(':')
+        self.market = SimMarket(
+            self.worker['market'], self.engine,
+            SimAsset('1.3.1', quote_symbol, precision, self.bitshares),
+            SimAsset('1.3.0', base_symbol, precision, self.bitshares))
+        self.bitshares.market = self.market
+        self.account = SimAccount(self.worker['account'], self.market)
+        self.strategy = None
+
+    def strategy_class(self, mixin=SimStrategyMixin):
+        strategy_class = getattr(importlib.import_module(self.worker['module']), 'Strategy')
+        return type('Backtest' + strategy_class.__name__, (mixin, strategy_class), {})
+
+    def totals(self):
+        quote, base = self.engine.locked()
+        return quote + self.engine.quote, base + self.engine.base
+
+    def dispatch(self, event, data):
+        """ Call the strategy's handlers for event, like WorkerInfrastructure does """
+        strategy = self.strategy
+        if strategy.disabled:
+            return
+        try:
+            getattr(strategy, event)(data)
+        except Exception as e:
+            strategy.log.exception("in {}()".format(event))
+            try:
+                getattr(strategy, 'error_' + event)(e)
+            except Exception:
+                strategy.log.exception("in error_{}()".format(event))
+
+    def end_block(self, block_num):
+        """ Deliver the block's fills and the tick """
+        fills = self.engine.fills
+        if self.delivered < len(fills):
+            for fill in fills[self.delivered:]:
+                self.dispatch('onMarketUpdate', SimFilledOrder.from_fill(fill, self.market))
+            self.delivered = len(fills)
+            self.dispatch('onAccount', SimAccountUpdate(self.account))
+        self.dispatch('ontick', '{:08x}'.format(block_num))
+
+    def run(self):
+        set_shared_bitshares_instance(self.bitshares)
+        started = time.time()
+        engine = self.engine
+        start = self.totals()
+        self.delivered = 0
+        block_end = None
+        block_num = 0
+        count = 0
+
+        for event in feed.events(self.feeds):
+            count += 1
+            stamp = event[1]
+            if self.strategy is not None and stamp >= block_end:
+                self.end_block(block_num)
+                block_num += 1
+                block_end = stamp - stamp % self.block_interval + self.block_interval
+            engine.now = stamp
+
+            if event[0] == feed.TRADE:
+                engine.trade(event[3], event[4], event[2])
+                if self.notify_trades and self.strategy is not None:
+                    trade = Fill(None, event[2], event[3], event[4], stamp, False)
+                    self.dispatch('onMarketUpdate',
+                                  SimFilledOrder.from_fill(trade, self.market, FOREIGN_ACCOUNT_ID))
+            else:
+                engine.set_book(event[2], event[3])
+
+            if self.strategy is None and engine.ready():
+                # the strategy starts as soon as there's a market to look at
+                self.strategy = self.strategy_class()(
+                    name=self.worker_name,
+                    config=self.config,
+                    bitshares_instance=self.bitshares,
+                    account=self.account,
+                    market=self.market
+                )
+                block_end = stamp - stamp % self.block_interval + self.block_interval
+
+        if self.strategy is not None:
+            self.end_block(block_num)
+        else:
+            log.warning("The feed never had a price, the strategy wasn't started")
+
+        return BacktestResult(start, self.totals(), engine.last_price or engine.best_bid(), engine,
+                              count, time.time() - started,
+                              # not bool(self.strategy): a strategy is a Storage dict, empty here
+                              self.strategy is not None and bool(self.strategy.disabled))
@@ -14,12 +14,13 @@ import bitsharesapi.exceptions
 import bitshares.exceptions
 from bitshares.amount import Amount
 from bitshares.market import Market
-from bitshares.account import Account
 from bitshares.price import FilledOrder, Order, UpdateCallOrder
 from bitshares.instance import shared_bitshares_instance
 from .storage import Storage
 from .statemachine import StateMachine
+from .coalesce import CoalescedMarket, CoalescedAccount, account_key
 from . import graph
+from . import metrics
 
 
 ConfigElement = collections.namedtuple('ConfigElement', 'key type default description extra')
@@ -120,12 +121,17 @@ class BaseStrategy(Storage, StateMachine, Events):
         onUpdateCallOrder=None,
         ontick=None,
         bitshares_instance=None,
+        coalescer=None,
+        account=None,
+        market=None,
         *args,
         **kwargs
     ):
         # BitShares instance
         self.bitshares = bitshares_instance or shared_bitshares_instance()
 
+        self.name = name
+
         # Storage
         Storage.__init__(self, name)
 
@@ -157,15 +163,24 @@ class BaseStrategy(Storage, StateMachine, Events):
             self.config = config = Config.get_worker_config_file(name)
 
         self.worker = config["workers"][name]
-        self._account = Account(
-            self.worker["account"],
-            full=True,
-            bitshares_instance=self.bitshares
-        )
-        self._market = Market(
-            config["workers"][name]["market"],
-            bitshares_instance=self.bitshares
-        )
+        # Requests shared with the other workers (see dexbot.coalesce)
+        self.coalescer = coalescer
+        # account and market can be given as stand-ins (e.g. for backtesting)
+        if account is None:
+            account = CoalescedAccount(
+                self.worker["account"],
+                full=True,
+                bitshares_instance=self.bitshares,
+                coalescer=coalescer
+            )
+        if market is None:
+            market = CoalescedMarket(
+                config["workers"][name]["market"],
+                bitshares_instance=self.bitshares,
+                coalescer=coalescer
+            )
+        self._account = account
+        self._market = market
 
         # Recheck flag - Tell the strategy to check for updated orders
         self.recheck_orders = False
@@ -393,6 +408,10 @@ class BaseStrategy(Storage, StateMachine, Events):
                 self.log.exception("Unable to cancel order")
         except bitshares.exceptions.MissingKeyError:
             self.log.exception('Unable to cancel order(s), private key missing.')
+        finally:
+            if self.coalescer:
+                # Our open orders have changed, don't serve them from the cache
+                self.coalescer.invalidate(account_key(self.worker['account']))
 
         return True
 
@@ -529,14 +548,12 @@ class BaseStrategy(Storage, StateMachine, Events):
         More complex workers (arbitrage, etc) may need to override to provide
         meaningful graphs
         """
-        data = graph.query_to_dicts(self.query_journal(start, end_))
-        if len(data) < 2:
-            # not enough data to graph
-            return None
-        data = graph.rebase_data(data,
-                                 self.market['quote']['symbol'],
-                                 self.market['base']['symbol'])
-        return graph.do_graph(data)
+        # hourly or daily values: a few hundred points whatever the period
+        # (None if there's not enough data to graph), drawn again only when
+        # the journal has moved on. The file belongs to graph.cache
+        return graph.cache.journal_graph(self, start, end_,
+                                         self.market['quote']['symbol'],
+                                         self.market['base']['symbol'])
 
     @staticmethod
     def purge_worker_data(worker_name):
@@ -612,6 +629,15 @@ class BaseStrategy(Storage, StateMachine, Events):
         instead of bubbling the exception, it is quietly logged (level WARN), and try again
         tries a fixed number of times (MAX_TRIES) before failing
         """
+        op = getattr(action, '__name__', 'action')
+        with metrics.registry.timer('broadcast_seconds', worker=self.name, op=op):
+            result = self._retry_action(action, *args, **kwargs)
+        age = metrics.registry.event_age()
+        if age is not None:
+            metrics.registry.observe('order_latency_seconds', age, worker=self.name, op=op)
+        return result
+
+    def _retry_action(self, action, *args, **kwargs):
         tries = 0
         while True:
             try:
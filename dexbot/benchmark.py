@@ -0,0 +1,359 @@
+"""
+Micro-benchmarks of the paths the bot spends its time on
+
+Each benchmark is a function taking a ``benchmark`` fixture, in the style of
+pytest-benchmark::
+
+    @register('calculate_center_price')
+    def bench_center_price(benchmark):
+        worker = sim_worker('dexbot.strategies.echo')
+        benchmark(worker.calculate_center_price)
+
+The fixture calls the function it's given enough times to get a stable
+timing and keeps the statistics. Strategies run against the backtest
+stand-ins (:mod:`dexbot.backtest.objects`), so nothing goes to a node and
+the timings are of dexbot's own code.
+
+Every run can be appended to a history file, and compared with a stored
+baseline: a benchmark whose median got slower than the baseline by more
+than the threshold is a regression.
+"""
+
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+from appdirs import user_data_dir
+from bitshares.instance import set_shared_bitshares_instance
+
+from dexbot import APP_NAME, AUTHOR, VERSION
+from dexbot.backtest.engine import Fill, BUY
+from dexbot.backtest.objects import SimFilledOrder, SimAccountUpdate
+from dexbot.backtest.runner import Backtest, SimStrategyMixin
+
+log = logging.getLogger(__name__)
+
+data_dir = user_data_dir(APP_NAME, AUTHOR)
+HISTORY_FILE = os.path.join(data_dir, 'benchmarks.jsonl')
+BASELINE_FILE = os.path.join(data_dir, 'benchmark-baseline.json')
+
+# A benchmark whose median is this much slower than the baseline's is a regression
+THRESHOLD = 0.25
+
+BENCHMARKS = []
+
+
+class BenchmarkFixture:
+    """ Times a function: called like pytest-benchmark's ``benchmark`` fixture
+
+        Each round runs the function ``iterations`` times, enough for a round
+        to take at least min_time. Rounds go on until max_time is used up, but
+        there are always at least min_rounds.
+    """
+
+    def __init__(self, name, min_rounds=5, min_time=0.005, max_time=1.0, timer=time.perf_counter):
+        self.name = name
+        self.min_rounds = min_rounds
+        self.min_time = min_time
+        self.max_time = max_time
+        self.timer = timer
+        self.times = []
+        self.iterations = 1
+
+    def __call__(self, func, *args, **kwargs):
+        """ Benchmark func(*args, **kwargs), returns its result """
+        timer = self.timer
+        # warm up, and a first guess at how long one call takes
+        started = timer()
+        result = func(*args, **kwargs)
+        once = timer() - started
+        self.iterations = max(1, int(self.min_time / once)) if once > 0 else 1000
+        loops = range(self.iterations)
+
+        deadline = timer() + self.max_time
+        while len(self.times) < self.min_rounds or timer() < deadline:
+            started = timer()
+            for _ in loops:
+                func(*args, **kwargs)
+            self.times.append((timer() - started) / self.iterations)
+        return result
+
+    def pedantic(self, func, args=(), kwargs=None, setup=None, rounds=1):
+        """ Benchmark func with a setup before each round (not timed), one call per round
+
+            setup can return the (args, kwargs) for that round.
+        """
+        kwargs = kwargs or {}
+        result = None
+        for _ in range(rounds):
+            if setup is not None:
+                prepared = setup()
+                if prepared is not None:
+                    args, kwargs = prepared
+            started = self.timer()
+            result = func(*args, **kwargs)
+            self.times.append(self.timer() - started)
+        self.iterations = 1
+        return result
+
+    def stats(self):
+        times = self.times
+        median = statistics.median(times)
+        return {
+            'min': min(times),
+            'max': max(times),
+            'mean': statistics.mean(times),
+            'median': median,
+            'stddev': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'rounds': len(times),
+            'iterations': self.iterations,
+            'ops': 1 / median if median else 0.0
+        }
+
+
+def register(name, params=None):
+    """ Add a benchmark function to the suite
+
+        With params the function takes a second argument and is run once
+        for each value, named ``name[value]``.
+    """
+    def decorator(func):
+        if params is None:
+            BENCHMARKS.append((name, func, ()))
+        else:
+            for param in params:
+                BENCHMARKS.append(('{}[{}]'.format(name, param), func, (param,)))
+        return func
+    return decorator
+
+
+# Fixtures
+def sim_worker(module, name='bench', market='USD:TEST', quote=10000.0, base=10000.0, price=1.0, depth=50,
+               account=None, mixin=SimStrategyMixin, **settings):
+    """ A strategy running on the backtest stand-ins, with a market around price
+
+        account: the account name, the default is the worker's name
+        mixin: SimOrdersMixin to keep the strategy's storage in the database
+    """
+    worker = dict(settings, account=account or name, market=market, module=module)
+    test = Backtest({'workers': {name: worker}}, name, [], quote=quote, base=base)
+    bids = [(price * (1 - 0.01 * (i + 1)), 10.0) for i in range(depth)]
+    asks = [(price * (1 + 0.01 * (i + 1)), 10.0) for i in range(depth)]
+    test.engine.set_book(bids, asks)
+    test.engine.last_price = price
+    set_shared_bitshares_instance(test.bitshares)
+    test.strategy = test.strategy_class(mixin)(
+        name=name,
+        config=test.config,
+        bitshares_instance=test.bitshares,
+        account=test.account,
+        market=test.market
+    )
+    return test.strategy
+
+
+def staggered_worker():
+    return sim_worker('dexbot.strategies.staggered_orders', amount=1.0, center_price_dynamic=True,
+                      center_price=0.0, spread=2.0, increment=1.0, upper_bound=1.5, lower_bound=0.5)
+
+
+def sim_infrastructure(workers, markets=1, module='dexbot.strategies.echo'):
+    """ A WorkerInfrastructure with workers strategies spread over markets, not connected to anything
+        All the workers share one account, so an account update goes to every one of them
+    """
+    from dexbot.worker import WorkerInfrastructure
+
+    first = sim_worker(module, name='bench0', account='bench')
+    config = {'node': 'benchmark', 'workers': {}}
+    infrastructure = WorkerInfrastructure(config, bitshares_instance=first.bitshares)
+    infrastructure.reporters = []
+    for i in range(workers):
+        name = 'bench{}'.format(i)
+        market = 'USD{}:TEST'.format(i % markets) if markets > 1 else 'USD:TEST'
+        worker = first if i == 0 else sim_worker(module, name=name, market=market, account='bench')
+        infrastructure.config['workers'][name] = worker.worker
+        infrastructure.workers[name] = worker
+        infrastructure.markets.add(worker.worker['market'])
+        infrastructure.accounts.add(worker.worker['account'])
+    return infrastructure
+
+
+def sim_fill(worker, price=1.0, amount=1.0):
+    """ An onMarketUpdate notification for a fill on worker's market """
+    return SimFilledOrder.from_fill(Fill('1.7.999', BUY, price, amount, time.time(), True), worker.market)
+
+
+# The suite
+@register('calculate_center_price')
+def bench_center_price(benchmark):
+    worker = sim_worker('dexbot.strategies.echo')
+    benchmark(worker.calculate_center_price)
+
+
+@register('calculate_center_price_offset')
+def bench_center_price_offset(benchmark):
+    worker = staggered_worker()
+    order_ids = [order['id'] for order in worker.orders]
+    benchmark(worker.calculate_center_price, asset_offset=True, spread=0.02, order_ids=order_ids)
+
+
+@register('total_balance')
+def bench_total_balance(benchmark):
+    worker = staggered_worker()
+    order_ids = [order['id'] for order in worker.orders]
+    benchmark(worker.total_balance, order_ids)
+
+
+@register('orders_balance')
+def bench_orders_balance(benchmark):
+    worker = staggered_worker()
+    order_ids = [order['id'] for order in worker.orders]
+    benchmark(worker.orders_balance, order_ids)
+
+
+@register('staggered_orders.check_orders')
+def bench_check_orders(benchmark):
+    worker = staggered_worker()
+    benchmark(worker.check_orders)
+
+
+@register('ataxia.reassess')
+def bench_reassess(benchmark):
+    worker = sim_worker('dexbot.strategies.ataxia', size=1.0, spread=2.0, increment=1.0,
+                        upper_bound=1.5, lower_bound=0.5)
+    benchmark(worker.reassess)
+
+
+@register('on_market_fanout', params=[1, 10, 100])
+def bench_on_market(benchmark, workers):
+    infrastructure = sim_infrastructure(workers)
+    benchmark(infrastructure.on_market, sim_fill(infrastructure.workers['bench0']))
+
+
+@register('on_account_fanout', params=[1, 10, 100])
+def bench_on_account(benchmark, workers):
+    infrastructure = sim_infrastructure(workers)
+    benchmark(infrastructure.on_account, SimAccountUpdate(infrastructure.workers['bench0'].account))
+
+
+@register('database_worker', params=[100])
+def bench_database_worker(benchmark, writes):
+    """ writes set_items then a get_item, which waits for the queue to drain """
+    from dexbot.storage import DatabaseWorker
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = DatabaseWorker(os.path.join(directory, 'benchmark.sqlite'))
+
+        def write_then_read():
+            for i in range(writes):
+                db.set_item('benchmark', 'key{}'.format(i % 10), i)
+            return db.get_item('benchmark', 'key0')
+
+        try:
+            benchmark(write_then_read)
+        finally:
+            db.stop()
+
+
+@register('graph.journal_graph', params=[1000, 100000])
+def bench_journal_graph(benchmark, points):
+    """ a worker's balance graph from points journal entries, drawn and saved """
+    from dexbot import graph
+    import numpy
+
+    values = numpy.cumsum(numpy.random.default_rng(0).normal(size=points))
+    stamps = numpy.datetime64('2018-01-01T00:00:00') + numpy.arange(points).astype('timedelta64[m]')
+    series = {'price': 1 + values * 0.001, 'USD': numpy.full(points, 100.0), 'TEST': 1000 + values}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'graph.png')
+        benchmark(graph.journal_graph, stamps, series, 'TEST', 'USD', path)
+
+
+# Running
+def run(select=None, **options):
+    """ Run the benchmarks whose names contain any of the select strings (all by default)
+
+        options are passed to BenchmarkFixture. Returns {name: stats}
+    """
+    results = {}
+    # the strategies log every order they place: that's not what we are timing
+    logging.disable(logging.INFO)
+    try:
+        for name, func, params in BENCHMARKS:
+            if select and not any(s in name for s in select):
+                continue
+            fixture = BenchmarkFixture(name, **options)
+            try:
+                func(fixture, *params)
+            except Exception:
+                log.exception("Benchmark {} failed".format(name))
+                continue
+            if fixture.times:
+                results[name] = fixture.stats()
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+def record(results, path=HISTORY_FILE):
+    """ Append a run to the history file, one JSON object per line """
+    entry = {
+        'time': datetime.datetime.now().isoformat(),
+        'version': VERSION,
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'results': results
+    }
+    with open(path, 'a') as fd:
+        fd.write(json.dumps(entry) + '\n')
+
+
+def history(path=HISTORY_FILE):
+    """ The runs recorded so far, oldest first """
+    if not os.path.exists(path):
+        return []
+    with open(path) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    with open(path, 'w') as fd:
+        json.dump(results, fd, indent=2, sort_keys=True)
+
+
+def load_baseline(path=BASELINE_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """ Compare medians with the baseline's
+
+        Returns a list of (name, baseline median, median, change, regressed),
+        change being the fraction slower (negative: faster).
+        Benchmarks missing from either side are left out.
+    """
+    rows = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['median']
+        new = stats['median']
+        change = (new - old) / old if old else math.inf
+        rows.append((name, old, new, change, change > threshold))
+    return rows
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3f}{}'.format(seconds / scale, unit)
+    return '{:.1f}ns'.format(seconds / 1e-9)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import json
 import logging
 import os
 import os.path
 import signal
 import sys
+import time
 
 from dexbot.config import Config, DEFAULT_CONFIG_FILE
 from dexbot.helper import initialize_orders_log
@@ -14,6 +16,17 @@ from dexbot.ui import (
     configfile
 )
 from .worker import WorkerInfrastructure
+from .aio import AsyncWorkerInfrastructure, DEFAULT_THREADS
+from .backtest.runner import Backtest
+from . import sweep as sweeps
+from . import benchmark as benchmarks
+from . import metrics
+from . import tracing
+from . import storage
+from .exporter import Exporter, DEFAULT_PORT as DEFAULT_EXPORTER_PORT
+from .recording import Recorder, Replay
+from .localnode.ledger import Ledger, DEFAULT_GENESIS, TEST_WIF
+from .localnode.server import LocalNode
 from .cli_conf import configure_dexbot, dexbot_service_running
 from . import errors
 from . import helper
@@ -22,6 +35,7 @@ from . import helper
 if "LANG" not in os.environ:
     os.environ['LANG'] = 'C.UTF-8'
 import click
+from ruamel import yaml
 
 
 log = logging.getLogger(__name__)
@@ -66,19 +80,62 @@ def main(ctx, **kwargs):
 
 
 @main.command()
+@click.option(
+    '--asyncio/--no-asyncio',
+    'use_asyncio',
+    default=False,
+    help='Run the workers on an asyncio event loop')
+@click.option(
+    '--threads',
+    type=int,
+    default=DEFAULT_THREADS,
+    help='Size of the thread pool for blocking worker code (asyncio only)')
+@click.option(
+    '--record',
+    type=click.Path(dir_okay=False),
+    default=None,
+    help='Append the notifications received to this file (see dexbot-cli replay)')
+@click.option(
+    '--metrics-port',
+    type=int,
+    default=None,
+    help='Serve the metrics for Prometheus on this port (e.g. {})'.format(DEFAULT_EXPORTER_PORT))
+@click.option(
+    '--metrics-host',
+    default='127.0.0.1',
+    help='Address to serve the metrics on')
+@click.option(
+    '--trace-rpc',
+    is_flag=True,
+    help='Trace the calls to the node (see the chat command rpc)')
+@click.option(
+    '--trace-file',
+    type=click.Path(dir_okay=False),
+    default=None,
+    help='Trace the calls to the node, appending them to this file (see dexbot-cli trace)')
 @click.pass_context
 @configfile
 @chain
 @unlock
 @verbose
-def run(ctx):
+def run(ctx, use_asyncio, threads, record, metrics_port, metrics_host, trace_rpc, trace_file):
     """ Continuously run the worker
     """
     if ctx.obj['pidfile']:
         with open(ctx.obj['pidfile'], 'w') as fd:
             fd.write(str(os.getpid()))
+    exporter = None
     try:
-        worker = WorkerInfrastructure(ctx.config)
+        if trace_rpc or trace_file:
+            tracing.enable(path=trace_file)
+        if use_asyncio:
+            worker = AsyncWorkerInfrastructure(ctx.config, max_threads=threads)
+        else:
+            worker = WorkerInfrastructure(ctx.config)
+        if record:
+            worker.recorder = Recorder(record)
+        if metrics_port is not None:
+            exporter = worker.exporter = Exporter(worker, host=metrics_host, port=metrics_port).start()
         # Set up signalling. do it here as of no relevance to GUI
         kill_workers = worker_job(worker, lambda: worker.stop(pause=True))
         # These first two UNIX & Windows
@@ -87,8 +144,8 @@ def run(ctx):
         try:
             # These signals are UNIX-only territory, will ValueError here on Windows
             signal.signal(signal.SIGHUP, kill_workers)
-            # TODO: reload config on SIGUSR1
-            # signal.signal(signal.SIGUSR1, lambda x, y: worker.do_next_tick(worker.reread_config))
+            # Reload the config: only the workers whose settings changed are restarted
+            signal.signal(signal.SIGUSR1, worker_job(worker, lambda: reread_config(worker, ctx.obj['configfile'])))
         except ValueError:
             log.debug("Cannot set all signals -- not available on this platform")
         if ctx.obj['systemd']:
@@ -103,10 +160,283 @@ def run(ctx):
         worker.shutdown()
         sys.exit(70)  # 70= "Software error" in /usr/include/sysexts.h
     finally:
+        if exporter:
+            exporter.stop()
+        tracing.disable()
         if ctx.obj['pidfile']:
             helper.remove(ctx.obj['pidfile'])
 
 
+@main.command()
+@click.argument('worker')
+@click.argument('feeds', nargs=-1, required=True)
+@click.option('--quote', type=float, default=0.0, help='Starting balance of the quote asset')
+@click.option('--base', type=float, default=0.0, help='Starting balance of the base asset')
+@click.option('--fee', type=float, default=0.0, help='Market fee, in percent')
+@click.option('--notify-trades', is_flag=True, help='Pass every historical trade to the worker (slow)')
+@click.pass_context
+@configfile
+@verbose
+def backtest(ctx, worker, feeds, quote, base, fee, notify_trades):
+    """ Run a configured worker against historical market data
+    """
+    if worker not in ctx.config['workers']:
+        click.echo("No such worker: {}".format(worker))
+        sys.exit(78)
+    test = Backtest(ctx.config, worker, list(feeds), quote=quote, base=base, fee=fee / 100,
+                    notify_trades=notify_trades)
+    click.echo(test.run().summary())
+
+
+@main.command()
+@click.argument('recording', type=click.Path(exists=True, dir_okay=False))
+@click.option('--realtime', is_flag=True, help='Keep the original time between events')
+@click.option('--speed', type=float, default=1.0, help='Speed up (or slow down) --realtime by this factor')
+@click.pass_context
+@configfile
+@chain
+@unlock
+@verbose
+def replay(ctx, recording, realtime, speed):
+    """ Feed recorded notifications to the configured workers
+
+        The workers act on them like on live ones, orders included: point the
+        config at a test node unless that's what you want.
+    """
+    worker = WorkerInfrastructure(ctx.config)
+    worker.init_workers(worker.config)
+    if not worker.workers:
+        click.echo("No workers running")
+        sys.exit(70)
+    try:
+        count, elapsed = Replay(recording, worker, realtime=realtime, speed=speed).run()
+    finally:
+        worker.shutdown()
+    click.echo("Replayed {} events in {:.2f}s".format(count, elapsed))
+
+
+@main.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', type=int, default=8090, help='Port to listen on')
+@click.option('--genesis', type=click.Path(exists=True, dir_okay=False),
+              help='YAML file with the assets and accounts to start with')
+@click.option('--block-interval', type=float, default=3.0, help='Seconds between blocks')
+@click.option('--latency', type=float, default=0.0, help='Seconds to wait before answering a call')
+@click.option('--jitter', type=float, default=0.0, help='Up to this many more seconds of random latency')
+@click.option('--error-rate', type=float, default=0.0, help='Fraction of calls that fail')
+@click.option('--error-method', 'error_methods', multiple=True, help='Only fail these calls')
+@click.option('--disconnect-rate', type=float, default=0.0, help='Fraction of calls that drop the connection')
+@click.option('--seed', type=int, default=None, help='Random seed for the injected failures')
+def localnode(host, port, genesis, block_interval, latency, jitter, error_rate, error_methods, disconnect_rate,
+              seed):
+    """ Run a local stand-in BitShares node to test workers against
+    """
+    if genesis:
+        with open(genesis) as fd:
+            genesis = yaml.safe_load(fd)
+    ledger = Ledger.from_genesis(genesis or DEFAULT_GENESIS)
+    node = LocalNode(ledger, host=host, port=port, block_interval=block_interval, latency=latency, jitter=jitter,
+                     error_rate=error_rate, error_methods=error_methods, disconnect_rate=disconnect_rate, seed=seed)
+    node.start()
+    click.echo("Listening on {}".format(node.url))
+    click.echo("Accounts: {}".format(', '.join(sorted(ledger.account_names))))
+    click.echo("Their key: {}".format(TEST_WIF))
+    try:
+        while node.thread.is_alive():
+            node.thread.join(1)
+    except KeyboardInterrupt:
+        node.stop()
+
+
+@main.command()
+@click.argument('worker')
+@click.argument('feeds', nargs=-1, required=True)
+@click.option('--param', '-p', 'params', multiple=True, required=True,
+              help='Parameter to sweep: KEY (its configured range), KEY=LO:HI or KEY=A,B,C')
+@click.option('--steps', type=int, default=5, help='Values per numeric range in a grid')
+@click.option('--samples', type=int, default=0, help='Random samples to run instead of a grid')
+@click.option('--seed', type=int, default=None, help='Random seed for --samples')
+@click.option('--processes', type=int, default=None, help='Backtests to run at once (default: all cores)')
+@click.option('--output', '-o', default='sweep.csv', help='CSV file for the results')
+@click.option('--top', type=int, default=10, help='How many of the best configurations to show')
+@click.option('--quote', type=float, default=0.0, help='Starting balance of the quote asset')
+@click.option('--base', type=float, default=0.0, help='Starting balance of the base asset')
+@click.option('--fee', type=float, default=0.0, help='Market fee, in percent')
+@click.pass_context
+@configfile
+@verbose
+def sweep(ctx, worker, feeds, params, steps, samples, seed, processes, output, top, quote, base, fee):
+    """ Backtest a worker over a range of settings and rank them
+    """
+    if worker not in ctx.config['workers']:
+        click.echo("No such worker: {}".format(worker))
+        sys.exit(78)
+    elements = sweeps.config_elements(ctx.config['workers'][worker]['module'])
+    try:
+        ranges = dict(sweeps.parse_spec(spec, elements, ctx.config['workers'][worker]) for spec in params)
+    except (sweeps.SweepError, ValueError) as e:
+        click.echo(str(e))
+        sys.exit(78)
+    if samples:
+        combinations = sweeps.random_samples(ranges, elements, samples, seed)
+    else:
+        combinations = sweeps.grid(ranges, elements, steps)
+    results = sweeps.sweep(ctx.config, worker, list(feeds), combinations, output, processes,
+                           quote=quote, base=base, fee=fee / 100)
+    disabled = sum(1 for params, result in results if result['disabled'])
+    click.echo("{} backtests succeeded ({} disabled the worker and aren't ranked), results in {}".format(
+        len(results), disabled, output))
+    for params, result in sweeps.rank(results, top=top):
+        settings = ', '.join('{}={:.6g}'.format(k, v) if isinstance(v, float) else '{}={}'.format(k, v)
+                             for k, v in params.items())
+        click.echo("{:8.3f}%  {} fills  {}".format(result['profit'], result['fills'], settings))
+
+
+@main.command()
+@click.argument('select', nargs=-1)
+@click.option('--max-time', type=float, default=1.0, help='Seconds to spend timing each benchmark')
+@click.option('--baseline', type=click.Path(dir_okay=False), default=benchmarks.BASELINE_FILE,
+              help='Baseline file to compare with')
+@click.option('--save-baseline', is_flag=True, help='Make this run the new baseline')
+@click.option('--threshold', type=float, default=benchmarks.THRESHOLD * 100,
+              help='Percent slower than the baseline that counts as a regression')
+@click.option('--no-history', is_flag=True, help="Don't add this run to the history file")
+def benchmark(select, max_time, baseline, save_baseline, threshold, no_history):
+    """ Time the hot paths, and compare with the baseline
+
+        SELECT: only run benchmarks whose names contain one of these
+    """
+    results = benchmarks.run(select, max_time=max_time)
+    if not no_history:
+        benchmarks.record(results)
+    old = benchmarks.load_baseline(baseline)
+    changes = {}
+    regressions = []
+    if old:
+        for name, old_median, median, change, regressed in benchmarks.compare(results, old, threshold / 100):
+            changes[name] = '{:+.1f}%{}'.format(change * 100, ' REGRESSION' if regressed else '')
+            if regressed:
+                regressions.append(name)
+    for name, stats in results.items():
+        click.echo("{:40} {:>12} {:>12.1f}/s  {}".format(
+            name, benchmarks.format_time(stats['median']), stats['ops'], changes.get(name, '')))
+    if save_baseline:
+        benchmarks.save_baseline(results, baseline)
+        click.echo("Saved as the baseline in {}".format(baseline))
+    elif old is None:
+        click.echo("No baseline to compare with, make one with --save-baseline")
+    if regressions:
+        click.echo("{} benchmarks slower than the baseline".format(len(regressions)))
+        sys.exit(1)
+
+
+@main.command()
+@click.option('--workers', '-n', type=int, multiple=True, default=[100],
+              help='Number of workers (give several to compare scales)')
+@click.option('--markets', '-m', type=int, default=10, help='Markets the workers are spread over')
+@click.option('--accounts', type=int, default=10, help='Accounts the workers are spread over')
+@click.option('--blocks', type=int, default=100, help='Blocks to send')
+@click.option('--fills', type=int, default=5, help='Markets that trade in each block')
+@click.option('--module', default=None, help='Strategy the workers run (default: relative_orders)')
+@click.option('--setting', '-s', 'settings', multiple=True, help='Worker setting KEY=VALUE')
+@click.option('--block-interval', type=float, default=0.0, help='Seconds between blocks (0: as fast as possible)')
+@click.option('--seed', type=int, default=None, help='Random seed for the price moves')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Write the results here as JSON')
+def loadtest(workers, markets, accounts, blocks, fills, module, settings, block_interval, seed, output):
+    """ Run many workers against a synthetic event stream and measure the runtime
+    """
+    from .loadtest import LoadTest, DEFAULT_MODULE
+
+    module = module or DEFAULT_MODULE
+    elements = sweeps.config_elements(module)
+    values = {}
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        if key not in elements:
+            click.echo("{} has no setting {}".format(module, key))
+            sys.exit(78)
+        values[key] = sweeps.convert(elements[key], value)
+    results = []
+    for count in workers:
+        result = LoadTest(count, markets, accounts, blocks, fills, module, values, block_interval, seed=seed).run()
+        results.append(result)
+        events = result['events']
+        click.echo("{} workers: {:.1f} blocks/s, market p99 {:.1f}ms, block p99 {:.1f}ms, "
+                   "cpu {:.2f}ms/worker, queue max {}, {:.0f}kB/worker".format(
+                       count, result['blocks']['per_second'],
+                       events.get('market', {}).get('p99', 0) * 1000, events['block']['p99'] * 1000,
+                       result['dispatch']['cpu_per_worker_mean'] * 1000, result['storage']['queue_max'],
+                       result['memory']['per_worker_bytes'] / 1024))
+    if output:
+        with open(output, 'w') as fd:
+            json.dump(results, fd, indent=2)
+    else:
+        click.echo(json.dumps(results, indent=2))
+
+
+@main.command('metrics')
+@click.argument('workers', nargs=-1)
+@click.option('--json', 'as_json', is_flag=True, help='Print the whole snapshot as JSON')
+@click.option('--file', 'path', default=metrics.SNAPSHOT_FILE, type=click.Path(dir_okay=False),
+              help='Snapshot file written by the running bot')
+def show_metrics(workers, as_json, path):
+    """ Show the running bot's latency, error, RPC and storage metrics
+
+        The bot saves them once a minute (and when it stops).
+    """
+    snapshot = metrics.load_snapshot(path)
+    if snapshot is None:
+        click.echo("No metrics in {}: is the bot running?".format(path))
+        sys.exit(66)  # "cannot open input"
+    if as_json:
+        click.echo(json.dumps(snapshot, indent=2))
+        return
+    age = time.time() - snapshot['time']
+    click.echo("Saved {:.0f}s ago, collecting for {:.0f}s".format(age, snapshot['time'] - snapshot['started']))
+    for worker_name, summary in sorted(metrics.snapshot_summaries(snapshot).items()):
+        if workers and worker_name not in workers:
+            continue
+        click.echo(worker_name if worker_name != metrics.NO_WORKER else '(outside workers)')
+        for line in metrics.format_summary(summary):
+            click.echo("    " + line)
+
+
+@main.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--by', default='worker,caller,method', help='What to group the calls by, from '
+              'worker, caller, method, digest')
+@click.option('--worker', 'worker_names', multiple=True, help='Only the calls of this worker')
+@click.option('--top', type=int, default=20, help='How many groups to show')
+def trace(path, by, worker_names, top):
+    """ Sum up a trace of the calls to the node (written by run --trace-file)
+    """
+    by = tuple(key.strip() for key in by.split(','))
+    calls = tracing.load(path)
+    if worker_names:
+        calls = [call for call in calls if call['worker'] in worker_names]
+    if not calls:
+        click.echo("No calls")
+        return
+    seconds = calls[-1]['time'] - calls[0]['time']
+    click.echo("{} calls over {:.0f}s".format(len(calls), seconds))
+    for line in tracing.format_rows(tracing.summarize(calls, by)[:top], by):
+        click.echo(line)
+
+
+@main.command()
+@click.pass_context
+@configfile
+def compact(ctx):
+    """ Roll up and prune the journal and logs now, as the bot does when idle
+    """
+    db = storage.db_worker
+    db.set_retention(**(ctx.config.get('retention') or {}))
+    before = os.path.getsize(storage.sqlDataBaseFile)
+    db.compact()
+    after = os.path.getsize(storage.sqlDataBaseFile)
+    click.echo("{}: {:.0f}kB, was {:.0f}kB".format(storage.sqlDataBaseFile, after / 1024, before / 1024))
+
+
 @main.command()
 @click.pass_context
 def configure(ctx):
@@ -147,5 +477,16 @@ def worker_job(worker, job):
     return lambda x, y: worker.do_next_tick(job)
 
 
+def reread_config(worker, path):
+    """ Read the config file again and change the running workers to it """
+    try:
+        with open(path) as fd:
+            config = yaml.safe_load(fd)
+    except (OSError, yaml.YAMLError):
+        log.exception("Cannot reload the config from {}".format(path))
+        return
+    worker.reload_config(config)
+
+
 if __name__ == '__main__':
     main()
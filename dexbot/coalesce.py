@@ -0,0 +1,191 @@
+"""
+Request coalescing between workers and the BitShares node
+
+Several workers trading the same market all ask for ``market.ticker()``
+within the same block, and several workers on one account all refresh it.
+The ``RequestCoalescer`` sits between the strategies and the node so that
+identical requests made while one is already in flight, or made again within
+the same block, are answered from a single RPC round trip.
+
+Cached results are dropped on every new block, and selectively when a
+notification or one of our own broadcasts makes them stale. Shared results
+are handed to every caller, so treat them as read-only.
+"""
+
+import threading
+import logging
+
+from bitshares.market import Market
+from bitshares.account import Account
+
+log = logging.getLogger(__name__)
+
+
+class _Flight:
+    """ A request currently being executed, other callers wait on it
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+    def finish(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class RequestCoalescer:
+    """ Single-flight cache for read-only RPC requests
+
+        Keys are tuples, the first items identify the object the request is
+        about (e.g. ``('market', 'USD:BTS')``) so related entries can be
+        invalidated together with :meth:`invalidate`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, key, func, *args, **kwargs):
+        """ Return func(*args, **kwargs), sharing the result with identical
+            requests in flight or already made in this block
+        """
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                return self.results[key]
+            flight = self.inflight.get(key)
+            if flight is not None and not flight.stale:
+                self.hits += 1
+                leader = False
+            else:
+                flight = self.inflight[key] = _Flight()
+                self.misses += 1
+                leader = True
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            value = func(*args, **kwargs)
+        except BaseException as e:
+            with self.lock:
+                if self.inflight.get(key) is flight:
+                    del self.inflight[key]
+            flight.finish(error=e)
+            raise
+
+        with self.lock:
+            if self.inflight.get(key) is flight:
+                del self.inflight[key]
+            if not flight.stale:
+                self.results[key] = value
+        flight.finish(value)
+        return value
+
+    def invalidate(self, prefix=()):
+        """ Forget results whose key starts with prefix (everything by default)
+            Requests still in flight are answered but not kept.
+        """
+        n = len(prefix)
+        with self.lock:
+            for key in [k for k in self.results if k[:n] == prefix]:
+                del self.results[key]
+            for key, flight in self.inflight.items():
+                if key[:n] == prefix:
+                    flight.stale = True
+
+    def new_block(self):
+        """ Called on every block, cached results only live for one block
+        """
+        self.invalidate()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def account_key(account):
+    """ The invalidation prefix for an account, given an Account or a name
+    """
+    if account is None:
+        return ('account',)
+    if isinstance(account, Account):
+        account = account['name']
+    return ('account', account)
+
+
+class CoalescedMarket(Market):
+    """ A Market whose ticker and orderbook requests go through a RequestCoalescer
+
+        Placing orders invalidates what is cached for the account used.
+    """
+
+    def __init__(self, *args, coalescer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.coalescer = coalescer
+        if args and isinstance(args[0], str):
+            self.coalesce_name = args[0]
+        else:
+            self.coalesce_name = self.get_string()
+
+    def ticker(self):
+        if not self.coalescer:
+            return super().ticker()
+        return self.coalescer.call(
+            ('market', self.coalesce_name, 'ticker'),
+            super().ticker)
+
+    def orderbook(self, limit=25):
+        if not self.coalescer:
+            return super().orderbook(limit)
+        return self.coalescer.call(
+            ('market', self.coalesce_name, 'orderbook', limit),
+            super().orderbook, limit)
+
+    def buy(self, *args, **kwargs):
+        try:
+            return super().buy(*args, **kwargs)
+        finally:
+            if self.coalescer:
+                self.coalescer.invalidate(account_key(kwargs.get('account')))
+
+    def sell(self, *args, **kwargs):
+        try:
+            return super().sell(*args, **kwargs)
+        finally:
+            if self.coalescer:
+                self.coalescer.invalidate(account_key(kwargs.get('account')))
+
+
+class CoalescedAccount(Account):
+    """ An Account whose refresh() is shared with other workers on the same account
+    """
+
+    def __init__(self, account, coalescer=None, **kwargs):
+        # refresh() is called from the ancestor constructor so set these first
+        self.coalescer = coalescer
+        self.coalesce_key = account_key(account) + (kwargs.get('full', False),)
+        super().__init__(account, **kwargs)
+
+    def refresh(self):
+        if not self.coalescer:
+            return super().refresh()
+        data = self.coalescer.call(self.coalesce_key, self._fetch)
+        dict.update(self, data)
+
+    def _fetch(self):
+        super().refresh()
+        return dict(self)
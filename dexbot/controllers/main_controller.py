@@ -2,6 +2,7 @@ import logging
 import sys
 
 from dexbot import VERSION
+from dexbot import metrics
 from dexbot.helper import initialize_orders_log
 from dexbot.worker import WorkerInfrastructure
 from dexbot.views.errors import PyQtHandler
@@ -46,6 +47,11 @@ class MainController:
             self.worker_manager.daemon = True
             self.worker_manager.start()
 
+    @staticmethod
+    def worker_metrics(worker_name):
+        """ Lines describing the worker's callback times, errors, RPC calls... """
+        return metrics.format_summary(metrics.registry.worker_summary(worker_name))
+
     def pause_worker(self, worker_name):
         self.worker_manager.stop(worker_name, pause=True)
 
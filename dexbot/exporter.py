@@ -0,0 +1,236 @@
+"""
+Serve the bot's metrics over HTTP, in the Prometheus text format
+
+::
+
+    dexbot-cli run --metrics-port 9585
+
+    $ curl localhost:9585/metrics
+    dexbot_worker_disabled{worker="worker1"} 0
+    dexbot_callback_seconds_bucket{event="ontick",le="0.001",worker="worker1"} 42
+    ...
+
+The counters and histograms are those of :mod:`dexbot.metrics`. On top of
+them the exporter keeps gauges that need the node: each worker's open
+orders and balances (from the workers' snapshots, see
+WorkerInfrastructure.snapshot) and how far the node's head block is
+behind the clock. Those are refreshed from the bot's own thread, on a
+block, at most every ``interval`` seconds, as the RPC connection can't be
+shared with the HTTP server's thread. What is cheap is read when scraped: the database
+queue depth, the time since the last block, whether each worker is
+disabled.
+"""
+
+import datetime
+import http.server
+import logging
+import socketserver
+import threading
+import time
+
+from dexbot import metrics
+from dexbot import storage
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9585
+GAUGE_INTERVAL = 15  # seconds
+PREFIX = 'dexbot_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+NODE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+HELP = {
+    'callback_seconds': 'Time taken by the workers\' event handlers',
+    'callback_errors': 'Event handlers that raised',
+    'rpc_calls': 'Calls to the node',
+    'rpc_errors': 'Calls to the node that failed',
+    'broadcast_seconds': 'Time to place or cancel orders, retries included',
+    'order_latency_seconds': 'Time from the start of handling an event to the order being broadcast',
+    'storage_ops': 'Database operations',
+    'worker_open_orders': 'Open orders of the worker in its market',
+    'worker_balance': 'Balance of the worker\'s account in the assets of its market',
+    'node_head_block': 'Head block number of the node',
+    'node_lag_seconds': 'How far the node\'s head block is behind the clock',
+    'last_block_timestamp_seconds': 'When the bot last got a block',
+    'seconds_since_last_block': 'Time since the bot last got a block',
+    'storage_queue_depth': 'Tasks waiting for the database thread',
+    'worker_disabled': '1 if the worker is disabled',
+    'worker_running': '1 for each worker that is running',
+    'start_time_seconds': 'When the metrics started',
+}
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ http.server.ThreadingHTTPServer, which Python < 3.7 doesn't have """
+    daemon_threads = True
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in sorted(labels.items())) + '}'
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(collected):
+    """ The Prometheus text for [(name, labels, metric)] as given by Registry.collect() """
+    lines = []
+    families = {}
+    for name, labels, metric in collected:
+        families.setdefault(name, []).append((labels, metric))
+    for name, members in families.items():
+        kind = type(members[0][1])
+        full_name = PREFIX + name
+        if kind is metrics.Counter:
+            full_name += '_total'
+        type_name = {metrics.Counter: 'counter', metrics.Histogram: 'histogram'}.get(kind, 'gauge')
+        if name in HELP:
+            lines.append('# HELP {} {}'.format(full_name, HELP[name]))
+        lines.append('# TYPE {} {}'.format(full_name, type_name))
+        for labels, metric in members:
+            if isinstance(metric, metrics.Histogram):
+                total = 0
+                for bound, count in zip(list(metric.buckets) + [float('inf')], metric.counts):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(
+                        full_name, format_labels(labels, le=format_number(bound)), total))
+                lines.append('{}_sum{} {}'.format(full_name, format_labels(labels), format_number(metric.sum)))
+                lines.append('{}_count{} {}'.format(full_name, format_labels(labels), metric.count))
+            else:
+                lines.append('{}{} {}'.format(full_name, format_labels(labels), format_number(metric.value)))
+    return '\n'.join(lines) + '\n'
+
+
+def node_time(value):
+    """ Unix time of a node's timestamp (UTC, no zone) """
+    stamp = datetime.datetime.strptime(value, NODE_TIME_FORMAT)
+    return stamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class Exporter:
+    """ The HTTP server, on its own daemon thread, and the gauges it serves
+
+        :param infrastructure: the WorkerInfrastructure to watch
+    """
+
+    def __init__(self, infrastructure, host='127.0.0.1', port=DEFAULT_PORT, interval=GAUGE_INTERVAL,
+                 registry=None):
+        self.infrastructure = infrastructure
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.registry = registry or metrics.registry
+        self.refreshed = 0
+        self.last_block = None
+        self.exported_workers = set()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/metrics'.format(self.host, self.port)
+
+    def start(self):
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                try:
+                    body = exporter.scrape().encode('utf-8')
+                except Exception:
+                    log.exception("Metrics scrape")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        # with port 0 the system picks one
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-exporter', daemon=True)
+        self.thread.start()
+        log.info("Serving metrics on {}".format(self.url))
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    # Read when scraped
+    def scrape(self):
+        registry = self.registry
+        now = time.time()
+        registry.set('storage_queue_depth', storage.db_worker.task_queue.qsize())
+        registry.set('start_time_seconds', registry.started)
+        if self.last_block is not None:
+            registry.set('last_block_timestamp_seconds', self.last_block)
+            registry.set('seconds_since_last_block', now - self.last_block)
+        # a copy: the bot's thread may be adding or removing workers
+        workers = dict(self.infrastructure.workers)
+        for worker_name, worker in workers.items():
+            registry.set('worker_running', 1, worker=worker_name)
+            registry.set('worker_disabled', int(bool(worker.disabled)), worker=worker_name)
+        for worker_name in self.exported_workers - set(workers):
+            self.forget_worker(worker_name)
+        self.exported_workers = set(workers)
+        return render(registry.collect())
+
+    def forget_worker(self, worker_name):
+        """ Drop the gauges of a worker that was stopped """
+        for name, labels, metric in self.registry.collect():
+            if isinstance(metric, metrics.Gauge) and labels.get('worker') == worker_name:
+                self.registry.remove(name, **labels)
+
+    # Called from the bot's thread
+    def on_block(self):
+        """ Note the block, and refresh the gauges that need the node if they are due """
+        now = time.time()
+        self.last_block = now
+        if now - self.refreshed < self.interval:
+            return
+        self.refreshed = now
+        self.refresh_node()
+        with self.infrastructure.config_lock:
+            workers = list(self.infrastructure.workers.items())
+        for worker_name, worker in workers:
+            self.refresh_worker(worker_name, worker)
+
+    def refresh_node(self):
+        try:
+            properties = self.infrastructure.bitshares.rpc.get_dynamic_global_properties()
+            self.registry.set('node_head_block', properties['head_block_number'])
+            self.registry.set('node_lag_seconds', max(0.0, time.time() - node_time(properties['time'])))
+        except Exception:
+            log.warning("Cannot get the node's head block for the metrics", exc_info=True)
+
+    def refresh_worker(self, worker_name, worker):
+        # from the worker's snapshot, taken on this thread too
+        snapshot = self.infrastructure.snapshot(worker_name)
+        if worker.disabled or snapshot is None:
+            return
+        self.registry.set('worker_open_orders', len(snapshot.orders), worker=worker_name)
+        for symbol, amount in snapshot.balances.items():
+            self.registry.set('worker_balance', amount, worker=worker_name, asset=symbol)
@@ -18,26 +18,307 @@ and then graph these two plus their total.
 This conversion is to try to factor out capital gains/losses over the graphed
 period (which usually swamp bot profits)
 
+The data is columnar all the way: one query gives numpy arrays
+(see Storage.query_journal_arrays), they are rebased as arrays and cut
+down to about one point per pixel with LTTB before matplotlib sees them.
+The old dictionary-of-dictionaries functions are kept for the callers
+that use them.
+
+Workers' graphs go through a cache (GraphCache, the module's ``cache``):
+the same worker and period is only drawn again when the journal has moved
+on, and then only the new buckets are read from the database.
+
 In the long run
 - some API to access from the GUI: need to discuss with GUI devs
 - CLI will generate HTML reports with graphs and e-mail to the user at regular intervals
 """
 
 from dexbot import storage
-from os.path import join
+from dexbot import helper
+from dexbot import APP_NAME, AUTHOR
+import collections
+import hashlib
 import os
 import tempfile
+import threading
+import time
 import sys
 import numpy
+from appdirs import user_data_dir
 
 import datetime
-import time
-import matplotlib
-matplotlib.use('AGG')  # anti-Grain Geometry: the backend for PNG files
-import matplotlib.pyplot as plt
+# The object-oriented API, not pyplot: no global state, so graphs can be
+# drawn from any thread without touching the GUI's backend
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.dates as mdates
 
+# Points per line after decimation: about the width of the graph in pixels
+SCREEN_POINTS = 800
+SIZE = (8, 5)  # inches
+DPI = 100
+
+GRAPH_DIR = os.path.join(user_data_dir(APP_NAME, AUTHOR), 'graphs')
+CACHE_BYTES = 20 * 1024 * 1024  # of PNG files
+CACHE_ENTRIES = 100
+CACHE_AGE = 2 * 24 * 60 * 60  # seconds since last used
+
+
+# Columnar data
+def query_to_arrays(rows):
+    """Translate SQLAlchemy rows result (from Journal) into
+    (stamps, {key: values}) numpy arrays, like Storage.query_journal_arrays
+    """
+    return storage.journal_arrays([(i.stamp, i.key, i.amount) for i in rows])
+
+
+def dicts_to_arrays(data):
+    """Translate the dictionaries of query_to_dicts into (stamps, {key: values})
+    """
+    dates = sorted(data.keys())
+    keys = list(data[dates[0]].keys()) if dates else []
+    stamps = numpy.array(dates, dtype='datetime64[s]')
+    return stamps, {k: numpy.array([data[d].get(k, numpy.nan) for d in dates], dtype=float) for k in keys}
+
+
+def rebase_arrays(series, quote, base):
+    """Rebase the series in the quote unit using the final price, like rebase_data,
+    and add the total
+    """
+    price = series['price']
+    known = price[~numpy.isnan(price)]
+    finalprice = known[-1]
+    rebased = {quote: series[quote], base: series[base] / finalprice}
+    rebased['total'] = rebased[quote] + rebased[base]
+    return rebased
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indexes of at most threshold points of (x, y)
+    keeping the shape of the line (Steinarsson 2013)
+
+    x and y are float arrays, x increasing. The first and last points are always kept.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return numpy.arange(n)
+    # the points between the first and the last, in threshold - 2 buckets
+    edges = numpy.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = numpy.empty(threshold, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # the average of the next bucket (or the last point)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        # the point of this bucket making the largest triangle with a and the average
+        area = numpy.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(numpy.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def decimate(stamps, series, points=SCREEN_POINTS):
+    """Cut each series down to at most points points with LTTB, NaNs left out
+
+    Returns {key: (stamps, values)}, the stamps of each key may differ
+    """
+    x = stamps.astype('datetime64[s]').astype(float)
+    lines = {}
+    for key, values in series.items():
+        present = ~numpy.isnan(values)
+        kept = lttb(x[present], values[present], points)
+        lines[key] = (stamps[present][kept], values[present][kept])
+    return lines
+
+
+def plot_arrays(plot, stamps, series, points=SCREEN_POINTS):
+    """Draw the series, decimated to points, on a matplotlib Axes
+    """
+    for key, (x, y) in decimate(stamps, series, points).items():
+        plot.plot(x.astype(datetime.datetime), y, label=key)
+    plot.set_xlim(stamps[0].astype(datetime.datetime), stamps[-1].astype(datetime.datetime))
+
+
+def graph_arrays(stamps, series, path=None, points=SCREEN_POINTS):
+    """Produce a graph of the (stamps, {key: values}) arrays
+    Returns: path to the file (a new temporary file if path isn't given)
+    """
+    # from originally the examples in the matplotlib docs
+    fig = Figure(figsize=SIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    plot_arrays(ax, stamps, series, points)
+
+    # format the ticks
+    locator = mdates.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+
+    # format the coords message box
+    def price(x):
+        return '$%1.2f' % x
+    ax.format_ydata = price
+    ax.grid(True)
+    ax.legend()
+    # rotates and right aligns the x labels, and moves the bottom of the
+    # axes up to make room for them
+    fig.autofmt_xdate()
+
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+    fig.savefig(path, bbox_inches='tight')
+    return path
+
+
+def journal_graph(stamps, series, quote, base, path=None):
+    """Graph a worker's journal arrays rebased to quote, None if there are fewer than 2 points
+    """
+    if len(stamps) < 2 or 'price' not in series or numpy.isnan(series['price']).all():
+        return None
+    return graph_arrays(stamps, rebase_arrays(series, quote, base), path)
+
+
+class GraphCache:
+    """ Journal graphs of workers, kept as PNG files in directory with the rows they were drawn from
+
+        A graph is keyed by worker, period, quote and base. It is drawn again
+        only when the worker's journal high-water mark has moved (and then only
+        the buckets from the last one on are read: the rest are kept) or when
+        a relative period such as '7d' has moved on by a bucket.
+        A new period reuses the rows of a longer one of the same worker.
+        The least recently used graphs go when there are more than
+        max_entries or max_bytes of them, and any not used for max_age seconds.
+    """
+
+    def __init__(self, directory=GRAPH_DIR, max_bytes=CACHE_BYTES, max_entries=CACHE_ENTRIES,
+                 max_age=CACHE_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.swept = False
+
+    def journal_graph(self, source, start, end_, quote, base):
+        """ Path to the graph of source's journal (a Storage, usually the worker),
+            like journal_graph(); None if there's not enough data
+            The file belongs to the cache: don't delete it
+        """
+        key = (source.category, start, end_, quote, base)
+        high_water = source.journal_high_water()
+        # a relative start ('7d') moves with the clock: a bucket at a time
+        window_start, resolution = source.journal_window(start, end_)
+        since = storage.BUCKET_STARTS[resolution](window_start)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['high_water'] == high_water and \
+                    entry['resolution'] == resolution and entry['since'] == since and \
+                    (entry['path'] is None or os.path.exists(entry['path'])):
+                entry['used'] = time.time()
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry['path']
+            self.misses += 1
+            if entry is None:
+                entry = self.reusable(key, resolution, since)
+        rows = self.rows(source, entry, resolution, since, end_, high_water)
+        stamps, series = storage.journal_arrays(rows)
+        path = self.render(key, stamps, series, quote, base)
+        size = os.path.getsize(path) if path else 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old and old['path'] and old['path'] != path:
+                self.remove_file(old['path'])
+            self.entries[key] = {'high_water': high_water, 'rows': rows, 'resolution': resolution,
+                                 'since': since, 'path': path, 'size': size, 'used': time.time()}
+            self.evict()
+        return path
+
+    def reusable(self, key, resolution, since):
+        """ An entry of the same worker, end and resolution going back to since or further (call with lock held) """
+        for other_key, entry in self.entries.items():
+            if other_key[0] == key[0] and other_key[2] == key[2] and \
+                    entry['resolution'] == resolution and entry['since'] <= since:
+                return entry
+        return None
+
+    def rows(self, source, entry, resolution, since, end_, high_water):
+        """ The entry's rows from since, and the new ones from the source """
+        if entry is None or entry['resolution'] != resolution or not entry['rows']:
+            return source.query_journal_buckets(since, end_, resolution)
+        rows = [row for row in entry['rows'] if row[0] >= since]
+        if entry['high_water'] == high_water:
+            return rows
+        # the last bucket may have grown: read it again and any after it
+        last = entry['rows'][-1][0]
+        return [row for row in rows if row[0] < last] + source.query_journal_buckets(last, end_, resolution)
+
+    def render(self, key, stamps, series, quote, base):
+        if len(stamps) < 2 or 'price' not in series or numpy.isnan(series['price']).all():
+            return None
+        self.sweep()
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        path = os.path.join(self.directory, name + '.png')
+        # drawn beside it and moved: a report may be reading the old one
+        temp = os.path.join(self.directory, '{}.{}.tmp.png'.format(name, threading.get_ident()))
+        journal_graph(stamps, series, quote, base, temp)
+        os.replace(temp, path)
+        return path
+
+    def sweep(self):
+        """ Make the directory, and remove the graphs an earlier run left in it """
+        if self.swept:
+            return
+        helper.mkdir(self.directory)
+        with self.lock:
+            known = {entry['path'] for entry in self.entries.values()}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.png') and path not in known:
+                self.remove_file(path)
+        self.swept = True
+
+    def evict(self):
+        """ Drop the old and the least recently used entries (call with lock held) """
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if now - entry['used'] > self.max_age]:
+            self.drop(key)
+        while self.entries and (len(self.entries) > self.max_entries or
+                                sum(entry['size'] for entry in self.entries.values()) > self.max_bytes):
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        entry = self.entries.pop(key)
+        if entry['path']:
+            self.remove_file(entry['path'])
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.drop(key)
 
+    @staticmethod
+    def remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+cache = GraphCache()
+
+
+# Dictionaries keyed by datetime (the original interface)
 def query_to_dicts(rows):
     """Translate SQLAlchemy rows result (from Journal) into
     dictionary keyed by datetime, of dictionaries keyed by 'key' value
@@ -56,12 +337,7 @@ def apply_dicts_to_graph(plot, data):
     Graph a dictionary of dictionaries originally from query_to_dicts
     (possibly with intervening modifications)
     """
-    dates = sorted(list(data.keys()))
-    all_keys = list(data[dates[0]].keys())
-    for k in all_keys:
-        ydata = [data[d][k] for d in dates]
-        plot.plot(dates, ydata, label=k)
-    plot.set_xlim(min(dates), max(dates))
+    plot_arrays(plot, *dicts_to_arrays(data))
 
 
 def do_graph(data):
@@ -69,32 +345,7 @@ def do_graph(data):
     (possibly modified), and produce a graph
     Returns: path to temporary file
     """
-    # from originally the examples in the matplotlib docs
-    daylocator = mdates.DayLocator()
-    daysFmt = mdates.DateFormatter('%b %d')
-
-    fig, ax = plt.subplots()
-
-    apply_dicts_to_graph(ax, data)
-    # format the ticks
-    ax.xaxis.set_major_locator(daylocator)
-    ax.xaxis.set_major_formatter(daysFmt)
-
-    # format the coords message box
-    def price(x):
-        return '$%1.2f' % x
-    #ax.format_xdata = mdates.DateFormatter('%Y-%m-%d')
-    ax.format_ydata = price
-    ax.grid(True)
-    ax.legend()
-    # rotates and right aligns the x labels, and moves the bottom of the
-    # axes up to make room for them
-    fig.autofmt_xdate()
-
-    fd, plotfile = tempfile.mkstemp(suffix='.png')
-    os.close(fd)
-    plt.savefig(plotfile, bbox_inches='tight')
-    return plotfile
+    return graph_arrays(*dicts_to_arrays(data))
 
 
 def rebase_data(data, quote, base):
@@ -119,6 +370,4 @@ if __name__ == '__main__':
     quote = sys.argv[3]
     base = sys.argv[4]
     s = storage.Storage(botname)
-    data = query_to_dicts(s.query_journal(start))
-    data = rebase_data(data, quote, base)
-    print(do_graph(data))
+    print(journal_graph(*s.query_journal_arrays(start), quote, base))
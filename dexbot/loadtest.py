@@ -0,0 +1,252 @@
+"""
+Load test the worker runtime: many workers on many markets, fed a synthetic
+stream of blocks, fills and account updates
+
+::
+
+    result = LoadTest(workers=300, markets=30, accounts=10, blocks=200).run()
+    print(json.dumps(result, indent=2))
+
+The workers are real strategies (relative orders by default) inside a real
+WorkerInfrastructure, with their storage in a scratch sqlite database. Their
+markets and accounts are the backtest stand-ins, so nothing goes to a node.
+Each market's price takes a random walk, trades at the new price fill the
+orders it crosses, and the infrastructure gets what Notify would have sent:
+a fill on each traded market, an update for each account that had a fill,
+then the block.
+
+The result is a dict, ready for JSON, with
+
+``events``
+    per kind (block, market, account), how long the infrastructure took to
+    handle each event: percentiles, mean and max, in seconds
+``dispatch``
+    the same for each call of one worker's handlers, and the CPU time the
+    handlers used, in total and per worker
+``storage``
+    the depth of the database queue after each event, and how long it took
+    to drain at the end
+``memory``
+    memory allocated by setting the workers up, per worker, and the peak
+    resident size (not on Windows)
+``blocks``
+    with a block_interval, how many blocks started late and the worst lag
+"""
+
+import collections
+import importlib
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from bitshares.instance import set_shared_bitshares_instance
+
+from dexbot import storage
+from dexbot.backtest.objects import SimAccountUpdate
+from dexbot.backtest.runner import SimOrdersMixin
+from dexbot.benchmark import sim_worker, sim_fill
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MODULE = 'dexbot.strategies.relative_orders'
+PERCENTILES = (50, 90, 99)
+
+
+def percentiles(values):
+    """ Summary of a list of timings """
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    summary = {'count': len(values), 'mean': sum(values) / len(values), 'max': values[-1]}
+    for p in PERCENTILES:
+        # nearest rank
+        summary['p{}'.format(p)] = values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+    return summary
+
+
+def default_settings(module):
+    """ The worker settings a strategy's configure() gives by default """
+    strategy = getattr(importlib.import_module(module), 'Strategy')
+    return {elem.key: elem.default for elem in strategy.configure() if elem.key not in ('account', 'market')}
+
+
+class LoadTest:
+
+    def __init__(self, workers=100, markets=10, accounts=10, blocks=100, fills=5, module=DEFAULT_MODULE,
+                 settings=None, block_interval=0.0, volatility=0.01, seed=None):
+        """
+        fills: markets that trade in each block
+        settings: worker settings, on top of the strategy's defaults
+        block_interval: seconds between blocks, 0 to send them as fast as they are handled
+        volatility: standard deviation of each price move, as a fraction of the price
+        """
+        self.workers = workers
+        self.markets = max(1, min(markets, workers))
+        self.accounts = max(1, min(accounts, workers))
+        self.blocks = blocks
+        self.fills = min(fills, self.markets)
+        self.module = module
+        self.settings = dict(default_settings(module), **(settings or {}))
+        self.block_interval = block_interval
+        self.volatility = volatility
+        self.random = random.Random(seed)
+        self.infrastructure = None
+        self.prices = {}
+        self.market_workers = collections.defaultdict(list)
+        self.event_times = collections.defaultdict(list)
+        self.dispatch_times = []
+        self.cpu = collections.Counter()
+        self.queue_depths = []
+
+    def options(self):
+        return {'workers': self.workers, 'markets': self.markets, 'accounts': self.accounts,
+                'blocks': self.blocks, 'fills': self.fills, 'module': self.module,
+                'settings': self.settings, 'block_interval': self.block_interval,
+                'volatility': self.volatility}
+
+    # Setting up
+    def setup(self):
+        """ Create the workers, returns the memory they took, in bytes """
+        from dexbot.worker import WorkerInfrastructure
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        first = None
+        for i in range(self.workers):
+            name = 'load{}'.format(i)
+            market = 'M{}:TEST'.format(i % self.markets)
+            worker = sim_worker(self.module, name=name, market=market, account='account{}'.format(i % self.accounts),
+                                mixin=SimOrdersMixin, **self.settings)
+            if first is None:
+                first = worker
+                self.infrastructure = WorkerInfrastructure({'node': 'loadtest', 'workers': {}},
+                                                           bitshares_instance=worker.bitshares)
+                self.infrastructure.reporters = []
+            self.infrastructure.config['workers'][name] = worker.worker
+            self.infrastructure.workers[name] = worker
+            self.infrastructure.markets.add(market)
+            self.infrastructure.accounts.add(worker.worker['account'])
+            self.market_workers[market].append(worker)
+            self.prices[market] = 1.0
+        self.drain()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        # the strategies' own calls go through the shared instance, as in the bot
+        set_shared_bitshares_instance(first.bitshares)
+        self.infrastructure.dispatch = self.timed_dispatch(self.infrastructure.dispatch)
+        return used
+
+    def timed_dispatch(self, dispatch):
+        def wrapper(worker_name, event, data):
+            cpu = time.thread_time()
+            started = time.perf_counter()
+            dispatch(worker_name, event, data)
+            self.dispatch_times.append(time.perf_counter() - started)
+            self.cpu[worker_name] += time.thread_time() - cpu
+        return wrapper
+
+    @staticmethod
+    def drain():
+        """ Wait for the database queue to empty, returns the seconds it took """
+        started = time.perf_counter()
+        storage.db_worker.get_item('loadtest', 'drain')
+        return time.perf_counter() - started
+
+    # The stream
+    def trade(self, market):
+        """ Move market's price and trade there, returns the workers that got fills """
+        price = self.prices[market] * (1 + self.random.gauss(0, self.volatility))
+        self.prices[market] = price
+        filled = []
+        for worker in self.market_workers[market]:
+            engine = worker.market.engine
+            engine.set_book([(price * (1 - 0.01 * (i + 1)), 10.0) for i in range(5)],
+                            [(price * (1 + 0.01 * (i + 1)), 10.0) for i in range(5)])
+            fills_before = len(engine.fills)
+            engine.trade(price, 1e9)
+            if len(engine.fills) > fills_before:
+                filled.append(worker)
+        return price, filled
+
+    def send(self, kind, handler, data):
+        started = time.perf_counter()
+        handler(data)
+        self.event_times[kind].append(time.perf_counter() - started)
+        self.queue_depths.append(storage.db_worker.task_queue.qsize())
+
+    def block(self, num):
+        infrastructure = self.infrastructure
+        accounts = {}
+        for market in self.random.sample(sorted(self.market_workers), self.fills):
+            price, filled = self.trade(market)
+            self.send('market', infrastructure.on_market, sim_fill(self.market_workers[market][0], price))
+            for worker in filled:
+                accounts.setdefault(worker.worker['account'], worker.account)
+        for account in accounts.values():
+            self.send('account', infrastructure.on_account, SimAccountUpdate(account))
+        self.send('block', infrastructure.on_block, '{:08x}'.format(num))
+
+    def memory(self, allocated):
+        """ The memory measurements, from the bytes allocated setting the workers up """
+        result = {'workers_bytes': allocated, 'per_worker_bytes': allocated / self.workers}
+        try:
+            import resource  # Unix only
+        except ImportError:
+            return result
+        result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return result
+
+    def run(self):
+        """ Set up, stream the blocks and return the measurements """
+        db_worker = storage.db_worker
+        directory = tempfile.TemporaryDirectory()
+        storage.db_worker = storage.DatabaseWorker(os.path.join(directory.name, 'loadtest.sqlite'))
+        # the strategies log every order: that's not what we are measuring
+        logging.disable(logging.INFO)
+        try:
+            started = time.perf_counter()
+            memory = self.setup()
+            setup_time = time.perf_counter() - started
+
+            late = 0
+            lags = []
+            started = time.perf_counter()
+            for num in range(self.blocks):
+                if self.block_interval:
+                    due = started + num * self.block_interval
+                    lag = time.perf_counter() - due
+                    if lag > 0:
+                        late += num > 0
+                        lags.append(lag)
+                    else:
+                        time.sleep(-lag)
+                self.block(num)
+            elapsed = time.perf_counter() - started
+            drain = self.drain()
+        finally:
+            logging.disable(logging.NOTSET)
+            storage.db_worker.stop()
+            storage.db_worker = db_worker
+            directory.cleanup()
+
+        cpu = list(self.cpu.values())
+        return {
+            'options': self.options(),
+            'setup': {'seconds': setup_time},
+            'events': {kind: percentiles(times) for kind, times in self.event_times.items()},
+            'dispatch': dict(percentiles(self.dispatch_times),
+                             cpu_total=sum(cpu),
+                             cpu_per_worker_mean=sum(cpu) / self.workers,
+                             cpu_per_worker_max=max(cpu) if cpu else 0.0),
+            'storage': {'queue_max': max(self.queue_depths, default=0),
+                        'queue_mean': sum(self.queue_depths) / len(self.queue_depths) if self.queue_depths else 0,
+                        'drain_seconds': drain},
+            'memory': self.memory(memory),
+            'blocks': {'count': self.blocks, 'seconds': elapsed,
+                       'per_second': self.blocks / elapsed if elapsed else 0.0,
+                       'late': late, 'max_lag': max(lags, default=0.0)},
+            'disabled_workers': sum(1 for w in self.infrastructure.workers.values() if w.disabled)
+        }
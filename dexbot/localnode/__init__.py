@@ -0,0 +1,3 @@
+"""
+A local stand-in for a BitShares node, for running dexbot offline
+"""
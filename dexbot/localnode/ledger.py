@@ -0,0 +1,534 @@
+"""
+The in-memory chain behind the local node
+
+Objects are kept as the plain dicts a graphene node returns, amounts as
+integers in the asset's smallest unit. Only what dexbot uses is modelled:
+assets, accounts with their balances and statistics, and limit orders, which
+are matched against each other like on the DEX (at the price of the order
+already on the book). Fees are always zero and signatures are not checked.
+
+Transactions take effect as soon as they are broadcast. The notifications
+they cause (market updates, changed account statistics) are queued and
+handed out by :meth:`Ledger.produce_block`.
+"""
+
+import copy
+import datetime
+import hashlib
+import threading
+from collections import defaultdict
+from fractions import Fraction
+from bisect import insort
+
+from bitsharesbase.account import PrivateKey
+from bitsharesbase.chains import known_chains
+
+CHAIN = known_chains['TEST']
+CHAIN_ID = CHAIN['chain_id']
+# The well known key of the graphene test genesis, every account gets it by default
+TEST_WIF = '5KQwrPbwdL6PhXujxW37FSSQZ1JiwsST4cqQzDeyXtP79zkvFD3'
+TEST_KEY = format(PrivateKey(TEST_WIF).pubkey, CHAIN['prefix'])
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+NEVER = '1970-01-01T00:00:00'
+
+OP_TRANSFER = 0
+OP_LIMIT_ORDER_CREATE = 1
+OP_LIMIT_ORDER_CANCEL = 2
+OP_FILL_ORDER = 4
+
+# What dexbot-cli localnode starts with when not given a genesis file
+DEFAULT_GENESIS = {
+    'assets': [{'symbol': 'USD', 'precision': 4}],
+    'accounts': [
+        {'name': 'dexbot', 'balances': {'TEST': 100000, 'USD': 10000}},
+        {'name': 'trader', 'balances': {'TEST': 100000, 'USD': 10000}}
+    ]
+}
+
+
+class LedgerError(Exception):
+    """ A transaction or call the node rejects, worded like a graphene assert """
+
+    def __init__(self, condition, message):
+        super().__init__("Assert Exception: {}: {}".format(condition, message))
+
+
+def now():
+    return datetime.datetime.utcnow().strftime(TIME_FORMAT)
+
+
+def block_id(num):
+    return '{:08x}'.format(num) + hashlib.sha1(str(num).encode()).hexdigest()[8:]
+
+
+def market_key(asset_a, asset_b):
+    return frozenset((asset_a, asset_b))
+
+
+def authority(key):
+    return {'weight_threshold': 1, 'account_auths': [], 'key_auths': [[key, 1]], 'address_auths': []}
+
+
+class Ledger:
+
+    def __init__(self, core_symbol=CHAIN['core_symbol'], core_precision=5):
+        self.lock = threading.RLock()
+        self.objects = {}
+        self.instances = defaultdict(int)
+        self.account_names = {}
+        self.asset_symbols = {}
+        # (account id, asset id) -> balance object
+        self.balances = {}
+        # (asset sold, asset received) -> sorted [(price, seq, order id)], best offer first
+        self.books = defaultdict(list)
+        self.seq = 0
+        # market key -> (time, {asset id: amount}) of the last fill, and traded volumes
+        self.last_trade = {}
+        self.volume = defaultdict(lambda: defaultdict(int))
+        # waiting for the next block
+        self.market_updates = defaultdict(list)
+        self.changed = {}
+        self.block_transactions = []
+
+        self.head_block_number = 0
+        self.last_block = None
+        self.create_object('2.0.0', {
+            'parameters': {'current_fees': {'parameters': [], 'scale': 10000}, 'block_interval': 3},
+            'next_available_vote_id': 0, 'active_committee_members': [], 'active_witnesses': []})
+        self.create_object('2.1.0', {})
+        self.update_head()
+        self.core = self.create_asset(core_symbol, core_precision)
+        self.create_account('committee-account')
+
+    # Objects
+    def create_object(self, object_id, data):
+        data['id'] = object_id
+        self.objects[object_id] = data
+        return data
+
+    def new_id(self, space_type):
+        instance = self.instances[space_type]
+        self.instances[space_type] += 1
+        return '{}.{}'.format(space_type, instance)
+
+    def get_object(self, object_id):
+        return self.objects.get(object_id)
+
+    def touch(self, account_id):
+        """ Note an operation on an account: its statistics object changes """
+        stats = self.objects[self.objects[account_id]['statistics']]
+        stats['total_ops'] += 1
+        stats['most_recent_op'] = '2.9.{}'.format(stats['total_ops'])
+        self.changed[stats['id']] = stats
+
+    # Assets
+    def create_asset(self, symbol, precision, issuer='1.2.0', market_fee_percent=0):
+        if symbol in self.asset_symbols:
+            raise LedgerError('asset_symbol_itr == asset_indx.end()', '{} already exists'.format(symbol))
+        asset_id = self.new_id('1.3')
+        dynamic_id = '2.3.' + asset_id.split('.')[2]
+        self.create_object(dynamic_id, {'current_supply': 0, 'confidential_supply': 0,
+                                        'accumulated_fees': 0, 'fee_pool': 0})
+        asset = self.create_object(asset_id, {
+            'symbol': symbol,
+            'precision': precision,
+            'issuer': issuer,
+            'options': {
+                'max_supply': '1000000000000000',
+                'market_fee_percent': market_fee_percent,
+                'max_market_fee': '1000000000000000',
+                'issuer_permissions': 0,
+                'flags': 0,
+                'core_exchange_rate': {'base': {'amount': 1, 'asset_id': asset_id},
+                                       'quote': {'amount': 1, 'asset_id': '1.3.0'}},
+                'whitelist_authorities': [],
+                'blacklist_authorities': [],
+                'whitelist_markets': [],
+                'blacklist_markets': [],
+                'description': '',
+                'extensions': []
+            },
+            'dynamic_asset_data_id': dynamic_id
+        })
+        self.asset_symbols[symbol] = asset_id
+        return asset
+
+    def get_asset(self, symbol_or_id):
+        return self.objects.get(self.asset_symbols.get(symbol_or_id, symbol_or_id))
+
+    def to_units(self, asset_id, amount):
+        return int(round(float(amount) * 10 ** self.objects[asset_id]['precision']))
+
+    def from_units(self, asset_id, units):
+        return units / 10 ** self.objects[asset_id]['precision']
+
+    # Accounts
+    def create_account(self, name, key=TEST_KEY):
+        if name in self.account_names:
+            raise LedgerError('acnt_indx.indices().get<by_name>().find(name) == end()',
+                              'account {} already exists'.format(name))
+        account_id = self.new_id('1.2')
+        stats_id = '2.6.' + account_id.split('.')[2]
+        self.create_object(stats_id, {'owner': account_id, 'most_recent_op': '2.9.0', 'total_ops': 0,
+                                      'removed_ops': 0, 'total_core_in_orders': 0, 'lifetime_fees_paid': 0,
+                                      'pending_fees': 0, 'pending_vested_fees': 0})
+        account = self.create_object(account_id, {
+            'membership_expiration_date': NEVER,
+            'registrar': '1.2.0',
+            'referrer': '1.2.0',
+            'lifetime_referrer': '1.2.0',
+            'network_fee_percentage': 2000,
+            'lifetime_referrer_fee_percentage': 3000,
+            'referrer_rewards_percentage': 0,
+            'name': name,
+            'owner': authority(key),
+            'active': authority(key),
+            'options': {'memo_key': key, 'voting_account': '1.2.5', 'num_witness': 0, 'num_committee': 0,
+                        'votes': [], 'extensions': []},
+            'statistics': stats_id,
+            'whitelisting_accounts': [],
+            'blacklisting_accounts': [],
+            'whitelisted_accounts': [],
+            'blacklisted_accounts': [],
+            'owner_special_authority': [0, {}],
+            'active_special_authority': [0, {}],
+            'top_n_control_flags': 0
+        })
+        self.account_names[name] = account_id
+        return account
+
+    def get_account(self, name_or_id):
+        return self.objects.get(self.account_names.get(name_or_id, name_or_id))
+
+    def key_references(self, key):
+        return [account['id'] for account in map(self.objects.get, self.account_names.values())
+                if any(k == key for k, w in account['active']['key_auths'] + account['owner']['key_auths'])]
+
+    def full_account(self, name_or_id):
+        account = self.get_account(name_or_id)
+        if account is None:
+            return None
+        return {
+            'account': account,
+            'statistics': self.objects[account['statistics']],
+            'registrar_name': 'committee-account',
+            'referrer_name': 'committee-account',
+            'lifetime_referrer_name': 'committee-account',
+            'votes': [],
+            'balances': [b for (owner, asset), b in self.balances.items() if owner == account['id']],
+            'vesting_balances': [],
+            'limit_orders': self.account_orders(account['id']),
+            'call_orders': [],
+            'settle_orders': [],
+            'proposals': [],
+            'assets': [],
+            'withdraws': []
+        }
+
+    # Balances
+    def balance(self, account_id, asset_id):
+        balance = self.balances.get((account_id, asset_id))
+        return balance['balance'] if balance else 0
+
+    def adjust_balance(self, account_id, asset_id, delta):
+        balance = self.balances.get((account_id, asset_id))
+        if balance is None:
+            balance = self.create_object(self.new_id('2.5'), {
+                'owner': account_id, 'asset_type': asset_id, 'balance': 0})
+            self.balances[(account_id, asset_id)] = balance
+        if balance['balance'] + delta < 0:
+            raise LedgerError('insufficient_balance', 'Insufficient Balance: {}\'s balance of {} is less than '
+                              'required {}'.format(self.objects[account_id]['name'], balance['balance'], -delta))
+        balance['balance'] += delta
+
+    def fund(self, name, symbol, amount):
+        """ Give an account amount (in whole units) of an asset """
+        with self.lock:
+            account = self.get_account(name)
+            asset = self.get_asset(symbol)
+            units = self.to_units(asset['id'], amount)
+            self.adjust_balance(account['id'], asset['id'], units)
+            self.objects[asset['dynamic_asset_data_id']]['current_supply'] += units
+            self.touch(account['id'])
+
+    def account_balances(self, account_id, assets=()):
+        if assets:
+            return [{'amount': self.balance(account_id, a), 'asset_id': a} for a in assets]
+        return [{'amount': b['balance'], 'asset_id': asset} for (owner, asset), b in self.balances.items()
+                if owner == account_id]
+
+    # Orders
+    def account_orders(self, account_id):
+        return [o for o in self.objects.values() if o['id'].startswith('1.7.') and o['seller'] == account_id]
+
+    @staticmethod
+    def order_price(order):
+        """ What the order asks, in the asset it receives per unit sold """
+        price = order['sell_price']
+        return Fraction(int(price['quote']['amount']), int(price['base']['amount']))
+
+    def place_order(self, seller, amount_to_sell, min_to_receive, expiration=None, fill_or_kill=False):
+        sell_asset = amount_to_sell['asset_id']
+        receive_asset = min_to_receive['asset_id']
+        for_sale = int(amount_to_sell['amount'])
+        to_receive = int(min_to_receive['amount'])
+        if for_sale <= 0:
+            raise LedgerError('amount_to_sell.amount > 0', '')
+        if to_receive <= 0:
+            raise LedgerError('min_to_receive.amount > 0', '')
+        if sell_asset == receive_asset:
+            raise LedgerError('amount_to_sell.asset_id != min_to_receive.asset_id', '')
+        if self.get_account(seller) is None or sell_asset not in self.objects or receive_asset not in self.objects:
+            raise LedgerError('maybe_found != nullptr', 'Unable to find Object')
+        self.adjust_balance(seller, sell_asset, -for_sale)
+        self.touch(seller)
+
+        order_id = self.new_id('1.7')
+        order = self.create_object(order_id, {
+            'expiration': expiration or '2106-02-07T06:28:15',
+            'seller': seller,
+            'for_sale': for_sale,
+            'sell_price': {'base': dict(amount_to_sell, amount=for_sale),
+                           'quote': dict(min_to_receive, amount=to_receive)},
+            'deferred_fee': 0
+        })
+        key = market_key(sell_asset, receive_asset)
+        self.market_updates[key].append(order_id)
+        self.match(order)
+
+        if order['for_sale'] and fill_or_kill:
+            raise LedgerError('!op.fill_or_kill || filled', 'Killing limit order due to unable to fill')
+        if order_id in self.objects:
+            self.seq += 1
+            insort(self.books[(sell_asset, receive_asset)], (self.order_price(order), self.seq, order_id))
+        return order_id
+
+    def match(self, taker):
+        """ Fill a new order against the book, at the prices of the orders on it """
+        sell_asset = taker['sell_price']['base']['asset_id']
+        receive_asset = taker['sell_price']['quote']['asset_id']
+        book = self.books[(receive_asset, sell_asset)]
+        key = market_key(sell_asset, receive_asset)
+        # the most the taker pays per unit received
+        limit = 1 / self.order_price(taker)
+        while book and taker['for_sale'] > 0:
+            price, seq, maker_id = book[0]
+            if price > limit:
+                break
+            maker = self.objects[maker_id]
+            # the maker sells receive_asset at price (in sell_asset per unit)
+            received = min(maker['for_sale'], int(taker['for_sale'] / price))
+            paid = int(received * price)
+            if received <= 0 or paid <= 0:
+                break
+            # fill() takes finished orders off the book
+            self.fill(maker, received, paid, True, maker['sell_price'])
+            self.fill(taker, paid, received, False, maker['sell_price'])
+            self.last_trade[key] = (now(), {receive_asset: received, sell_asset: paid})
+            self.volume[key][receive_asset] += received
+            self.volume[key][sell_asset] += paid
+            if maker_id in self.objects:
+                break
+
+    def fill(self, order, paid, received, is_maker, fill_price):
+        """ Record order having paid (its sell asset) and received (the other) """
+        seller = order['seller']
+        sell_asset = order['sell_price']['base']['asset_id']
+        receive_asset = order['sell_price']['quote']['asset_id']
+        order['for_sale'] -= paid
+        self.adjust_balance(seller, receive_asset, received)
+        self.touch(seller)
+        self.market_updates[market_key(sell_asset, receive_asset)].append({
+            'fee': {'amount': 0, 'asset_id': receive_asset},
+            'order_id': order['id'],
+            'account_id': seller,
+            'pays': {'amount': paid, 'asset_id': sell_asset},
+            'receives': {'amount': received, 'asset_id': receive_asset},
+            'fill_price': fill_price,
+            'is_maker': is_maker
+        })
+        # what's left can't buy anything more: refund it
+        if order['for_sale'] <= 0 or int(order['for_sale'] * self.order_price(order)) <= 0:
+            self.remove_order(order)
+
+    def remove_order(self, order):
+        """ Take an order off the books, refunding what's left of it """
+        sell_asset = order['sell_price']['base']['asset_id']
+        receive_asset = order['sell_price']['quote']['asset_id']
+        if order['for_sale'] > 0:
+            self.adjust_balance(order['seller'], sell_asset, order['for_sale'])
+        del self.objects[order['id']]
+        book = self.books[(sell_asset, receive_asset)]
+        for i, entry in enumerate(book):
+            if entry[2] == order['id']:
+                del book[i]
+                break
+        self.market_updates[market_key(sell_asset, receive_asset)].append(order['id'])
+
+    def cancel_order(self, account_id, order_id):
+        order = self.objects.get(order_id)
+        if order is None or not order_id.startswith('1.7.'):
+            raise LedgerError('maybe_found != nullptr', 'Unable to find Object')
+        if order['seller'] != account_id:
+            raise LedgerError('order->seller == o.fee_paying_account', '')
+        self.remove_order(order)
+        self.touch(account_id)
+
+    # Markets
+    def book(self, base, quote, limit=50):
+        """ The order book of the base/quote market, as get_order_book returns it """
+        base_asset = self.get_asset(base)
+        quote_asset = self.get_asset(quote)
+        base_id, quote_id = base_asset['id'], quote_asset['id']
+        scale = Fraction(10 ** base_asset['precision'], 10 ** quote_asset['precision'])
+        bids = []
+        for price, seq, order_id in self.books[(base_id, quote_id)][:limit]:
+            order = self.objects[order_id]
+            bids.append({'price': '{:.12g}'.format(float(1 / price / scale)),
+                         'base': str(self.from_units(base_id, order['for_sale'])),
+                         'quote': str(self.from_units(quote_id, int(order['for_sale'] * price)))})
+        asks = []
+        for price, seq, order_id in self.books[(quote_id, base_id)][:limit]:
+            order = self.objects[order_id]
+            asks.append({'price': '{:.12g}'.format(float(price / scale)),
+                         'base': str(self.from_units(base_id, int(order['for_sale'] * price))),
+                         'quote': str(self.from_units(quote_id, order['for_sale']))})
+        return {'base': base_id, 'quote': quote_id, 'bids': bids, 'asks': asks}
+
+    def ticker(self, base, quote):
+        base_asset = self.get_asset(base)
+        quote_asset = self.get_asset(quote)
+        base_id, quote_id = base_asset['id'], quote_asset['id']
+        book = self.book(base_id, quote_id, 1)
+        key = market_key(base_id, quote_id)
+        latest = '0'
+        if key in self.last_trade:
+            amounts = self.last_trade[key][1]
+            latest = '{:.12g}'.format(self.from_units(base_id, amounts[base_id]) /
+                                      self.from_units(quote_id, amounts[quote_id]))
+        return {
+            'time': now(),
+            'base': base_asset['symbol'],
+            'quote': quote_asset['symbol'],
+            'latest': latest,
+            'lowest_ask': book['asks'][0]['price'] if book['asks'] else '0',
+            'highest_bid': book['bids'][0]['price'] if book['bids'] else '0',
+            'percent_change': '0',
+            'base_volume': str(self.from_units(base_id, self.volume[key][base_id])),
+            'quote_volume': str(self.from_units(quote_id, self.volume[key][quote_id]))
+        }
+
+    # Transactions
+    def apply_operation(self, op_type, op):
+        if op_type == OP_LIMIT_ORDER_CREATE:
+            return self.place_order(op['seller'], op['amount_to_sell'], op['min_to_receive'],
+                                    op.get('expiration'), op.get('fill_or_kill', False))
+        if op_type == OP_LIMIT_ORDER_CANCEL:
+            self.cancel_order(op['fee_paying_account'], op['order'])
+            return None
+        if op_type == OP_TRANSFER:
+            amount = op['amount']
+            if self.get_account(op['to']) is None:
+                raise LedgerError('maybe_found != nullptr', 'Unable to find Object')
+            self.adjust_balance(op['from'], amount['asset_id'], -int(amount['amount']))
+            self.adjust_balance(op['to'], amount['asset_id'], int(amount['amount']))
+            self.touch(op['from'])
+            self.touch(op['to'])
+            return None
+        raise LedgerError('false', 'operation type {} is not supported by the local node'.format(op_type))
+
+    def apply_transaction(self, tx):
+        """ Apply all the operations of a transaction or none, returns the operation results """
+        with self.lock:
+            operations = tx['operations']
+            # single operations fail before changing anything, except fill or kill orders
+            saved = None
+            if len(operations) > 1 or any(op.get('fill_or_kill') for op_type, op in operations):
+                saved = self.save()
+            try:
+                results = []
+                for op_type, op in operations:
+                    result = self.apply_operation(op_type, op)
+                    results.append([1, result] if result else [0, {}])
+            except Exception:
+                if saved is not None:
+                    self.restore(saved)
+                raise
+            self.block_transactions.append(dict(tx, operation_results=results))
+            return results
+
+    def save(self):
+        return copy.deepcopy((self.objects, self.instances, self.account_names, self.asset_symbols, self.books,
+                              self.seq, self.last_trade, self.volume, self.market_updates, self.changed))
+
+    def restore(self, saved):
+        (self.objects, self.instances, self.account_names, self.asset_symbols, self.books,
+         self.seq, self.last_trade, self.volume, self.market_updates, self.changed) = saved
+        # the balance index points into objects
+        self.balances = {(b['owner'], b['asset_type']): b for b in self.objects.values() if b['id'].startswith('2.5.')}
+
+    # Blocks
+    def update_head(self):
+        self.objects['2.1.0'].update({
+            'head_block_number': self.head_block_number,
+            'head_block_id': block_id(self.head_block_number),
+            'time': now(),
+            'current_witness': '1.6.0',
+            'next_maintenance_time': NEVER,
+            'last_budget_time': NEVER,
+            'witness_budget': 0,
+            'accounts_registered_this_interval': 0,
+            'recently_missed_count': 0,
+            'current_aslot': self.head_block_number,
+            'recent_slots_filled': '340282366920938463463374607431768211455',
+            'dynamic_flags': 0,
+            'last_irreversible_block_num': self.head_block_number
+        })
+
+    def produce_block(self):
+        """ Close the current block
+            Returns (block id, {market key: updates}, [changed objects])
+        """
+        with self.lock:
+            self.head_block_number += 1
+            self.update_head()
+            self.last_block = {
+                'previous': block_id(self.head_block_number - 1),
+                'timestamp': self.objects['2.1.0']['time'],
+                'witness': '1.6.0',
+                'transaction_merkle_root': '0' * 40,
+                'extensions': [],
+                'witness_signature': '',
+                'transactions': self.block_transactions
+            }
+            market_updates, changed = dict(self.market_updates), list(self.changed.values())
+            self.market_updates = defaultdict(list)
+            self.changed = {}
+            self.block_transactions = []
+            return block_id(self.head_block_number), market_updates, changed
+
+    def block(self, num):
+        if num == self.head_block_number and self.head_block_number:
+            return self.last_block
+        return None
+
+    # Set up
+    @classmethod
+    def from_genesis(cls, genesis):
+        """ A ledger set up from a dict::
+
+                {'assets': [{'symbol': 'USD', 'precision': 4}],
+                 'accounts': [{'name': 'alice', 'balances': {'TEST': 10000, 'USD': 100}}]}
+
+            Accounts can have a 'key' (public key), the default is TEST_KEY
+        """
+        ledger = cls()
+        for asset in genesis.get('assets', []):
+            ledger.create_asset(asset['symbol'], asset.get('precision', 5),
+                                market_fee_percent=asset.get('market_fee_percent', 0))
+        for account in genesis.get('accounts', []):
+            ledger.create_account(account['name'], account.get('key', TEST_KEY))
+            for symbol, amount in account.get('balances', {}).items():
+                ledger.fund(account['name'], symbol, amount)
+        return ledger
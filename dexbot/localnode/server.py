@@ -0,0 +1,390 @@
+"""
+A websocket server speaking the part of the graphene API dexbot uses
+
+::
+
+    ledger = Ledger.from_genesis({'assets': [{'symbol': 'USD', 'precision': 4}],
+                                  'accounts': [{'name': 'alice', 'balances': {'TEST': 1000, 'USD': 100}}]})
+    with LocalNode(ledger, block_interval=0.5) as node:
+        bitshares = BitShares(node.url, keys=[TEST_WIF])
+        ...
+
+The node runs on its own thread and event loop. Every call, on any API, is
+answered from the :class:`dexbot.localnode.ledger.Ledger`; subscriptions
+(``set_subscribe_callback`` with ``get_full_accounts``,
+``subscribe_to_market`` and ``set_block_applied_callback``) get their
+notices when a block is produced, every ``block_interval`` seconds, or when
+:meth:`LocalNode.produce_block` is called.
+
+To see how the bot copes with a bad node, calls can be slowed down
+(``latency`` seconds, plus up to ``jitter``), fail with an RPC error
+(``error_rate``, optionally only for ``error_methods``) or drop the
+connection (``disconnect_rate``).
+"""
+
+import asyncio
+import json
+import logging
+import random
+import threading
+
+import websockets
+
+from dexbot.localnode.ledger import Ledger, LedgerError, CHAIN_ID, market_key
+
+log = logging.getLogger(__name__)
+
+# Calls that are never delayed or failed: logging in and picking APIs
+SETUP_CALLS = {'login', 'database', 'network_broadcast', 'history', 'network_node', 'crypto', 'asset', 'orders'}
+
+
+class Session:
+    """ The subscriptions of one client connection """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.object_callback = None
+        self.block_callback = None
+        self.accounts = set()
+        self.markets = {}
+
+    def cancel(self):
+        self.object_callback = None
+        self.block_callback = None
+        self.accounts = set()
+        self.markets = {}
+
+
+class LocalNode:
+
+    def __init__(self, ledger=None, host='127.0.0.1', port=0, block_interval=3.0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, disconnect_rate=0.0, error_methods=None, error_message='injected failure',
+                 seed=None):
+        """
+        port: 0 picks a free port, see url
+        block_interval: seconds between blocks, 0 to only make them with produce_block()
+        """
+        self.ledger = ledger or Ledger()
+        self.host = host
+        self.port = port
+        self.block_interval = block_interval
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.error_methods = set(error_methods) if error_methods else None
+        self.error_message = error_message
+        self.random = random.Random(seed)
+        self.sessions = set()
+        self.calls = 0
+        self.injected = 0
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+        self.failed = None
+
+    @property
+    def url(self):
+        return 'ws://{}:{}'.format(self.host, self.port)
+
+    # Running
+    def start(self):
+        """ Start serving on a background thread, returns once it's listening """
+        self.thread = threading.Thread(target=self.run, name='dexbot-localnode', daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.failed:
+            raise self.failed
+        return self
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.listen())
+        except Exception as e:
+            self.failed = e
+            self.started.set()
+            self.loop.close()
+            return
+        self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            # asyncio.all_tasks is new in Python 3.7
+            all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+            tasks = [task for task in all_tasks(self.loop) if not task.done()]
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def listen(self):
+        self.server = await websockets.serve(self.serve, self.host, self.port)
+        self.port = next(iter(self.server.sockets)).getsockname()[1]
+        if self.block_interval:
+            self.loop.create_task(self.produce_blocks())
+        log.info("Local node listening on {}".format(self.url))
+
+    def stop(self):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def call(self, func, *args):
+        """ Run func(*args) on the node's thread (e.g. to change the ledger), returns its result """
+        async def wrapper():
+            return func(*args)
+        return asyncio.run_coroutine_threadsafe(wrapper(), self.loop).result()
+
+    # Blocks
+    async def produce_blocks(self):
+        while True:
+            await asyncio.sleep(self.block_interval)
+            await self.new_block()
+
+    def produce_block(self):
+        """ Make a block now, and send out its notices """
+        asyncio.run_coroutine_threadsafe(self.new_block(), self.loop).result()
+
+    async def new_block(self):
+        block, market_updates, changed = self.ledger.produce_block()
+        for session in list(self.sessions):
+            try:
+                await self.notify(session, block, market_updates, changed)
+            except websockets.ConnectionClosed:
+                self.sessions.discard(session)
+
+    async def notify(self, session, block, market_updates, changed):
+        for key, callback in list(session.markets.items()):
+            if key in market_updates:
+                await self.send_notice(session, callback, [market_updates[key]])
+        if session.object_callback is not None:
+            objects = [o for o in changed if o.get('owner') in session.accounts]
+            if objects:
+                await self.send_notice(session, session.object_callback, [objects])
+        if session.block_callback is not None:
+            await self.send_notice(session, session.block_callback, [block])
+
+    @staticmethod
+    async def send_notice(session, callback, params):
+        await session.websocket.send(json.dumps({'method': 'notice', 'params': [callback, params]}))
+
+    # Calls
+    async def serve(self, websocket, path=None):
+        session = Session(websocket)
+        self.sessions.add(session)
+        try:
+            async for message in websocket:
+                reply = await self.handle(session, message)
+                if reply is None:
+                    await websocket.close()
+                    break
+                await websocket.send(reply)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.sessions.discard(session)
+
+    async def handle(self, session, message):
+        """ Answer one JSON-RPC message, None to drop the connection """
+        request = json.loads(message)
+        request_id = request.get('id')
+        params = request.get('params', [])
+        if request.get('method') == 'call':
+            api, method, args = params
+        else:
+            method, args = request.get('method'), params
+        self.calls += 1
+
+        if method not in SETUP_CALLS:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            if self.disconnect_rate and self.random.random() < self.disconnect_rate:
+                self.injected += 1
+                return None
+            if (self.error_rate and (self.error_methods is None or method in self.error_methods) and
+                    self.random.random() < self.error_rate):
+                self.injected += 1
+                return self.error(request_id, self.error_message)
+
+        handler = getattr(self, 'api_' + method, None)
+        if handler is None:
+            return self.error(request_id, "no method with name '{}'".format(method))
+        try:
+            with self.ledger.lock:
+                result = handler(session, *args)
+        except LedgerError as e:
+            return self.error(request_id, str(e))
+        except Exception as e:
+            log.exception("in {}".format(method))
+            return self.error(request_id, "{}: {}".format(type(e).__name__, e))
+        return json.dumps({'id': request_id, 'jsonrpc': '2.0', 'result': result})
+
+    @staticmethod
+    def error(request_id, message):
+        return json.dumps({'id': request_id, 'jsonrpc': '2.0',
+                           'error': {'code': 1, 'message': message, 'data': {'code': 10, 'message': message}}})
+
+    # Login and APIs
+    def api_login(self, session, user='', password=''):
+        return True
+
+    def api_database(self, session):
+        return 2
+
+    def api_network_broadcast(self, session):
+        return 3
+
+    def api_history(self, session):
+        return 4
+
+    # Subscriptions
+    def api_set_subscribe_callback(self, session, callback, notify_remove_create=False):
+        session.object_callback = callback
+        return None
+
+    def api_set_block_applied_callback(self, session, callback):
+        session.block_callback = callback
+        return None
+
+    def api_set_pending_transaction_callback(self, session, callback):
+        return None
+
+    def api_subscribe_to_market(self, session, callback, asset_a, asset_b):
+        session.markets[market_key(asset_a, asset_b)] = callback
+        return None
+
+    def api_unsubscribe_from_market(self, session, asset_a, asset_b):
+        session.markets.pop(market_key(asset_a, asset_b), None)
+        return None
+
+    def api_cancel_all_subscriptions(self, session):
+        session.cancel()
+        return None
+
+    # Chain
+    def api_get_chain_properties(self, session):
+        return {'id': '2.11.0', 'chain_id': CHAIN_ID,
+                'immutable_parameters': {'min_committee_member_count': 11, 'min_witness_count': 11,
+                                         'num_special_accounts': 0, 'num_special_assets': 0}}
+
+    def api_get_chain_id(self, session):
+        return CHAIN_ID
+
+    def api_get_global_properties(self, session):
+        return self.ledger.get_object('2.0.0')
+
+    def api_get_dynamic_global_properties(self, session):
+        return self.ledger.get_object('2.1.0')
+
+    def api_get_config(self, session):
+        return {'GRAPHENE_SYMBOL': self.ledger.core['symbol'], 'GRAPHENE_ADDRESS_PREFIX': 'TEST'}
+
+    def api_get_block_header(self, session, num):
+        block = self.ledger.block(num)
+        return {k: v for k, v in block.items() if k != 'transactions'} if block else None
+
+    def api_get_block(self, session, num):
+        return self.ledger.block(num)
+
+    def api_get_objects(self, session, ids):
+        return [self.ledger.get_object(i) for i in ids]
+
+    # Accounts
+    def api_get_account_by_name(self, session, name):
+        return self.ledger.get_account(name)
+
+    def api_lookup_account_names(self, session, names):
+        return [self.ledger.get_account(name) for name in names]
+
+    def api_get_accounts(self, session, ids):
+        return [self.ledger.get_account(i) for i in ids]
+
+    def api_get_full_accounts(self, session, names, subscribe=False):
+        result = []
+        for name in names:
+            account = self.ledger.full_account(name)
+            if account is None:
+                continue
+            if subscribe:
+                session.accounts.add(account['account']['id'])
+            result.append([name, account])
+        return result
+
+    def api_get_account_balances(self, session, account_id, assets):
+        account = self.ledger.get_account(account_id)
+        if account is None:
+            raise LedgerError('maybe_found != nullptr', 'Unable to find Object')
+        return self.ledger.account_balances(account['id'], assets)
+
+    def api_get_named_account_balances(self, session, name, assets):
+        return self.api_get_account_balances(session, name, assets)
+
+    def api_get_key_references(self, session, keys):
+        return [self.ledger.key_references(key) for key in keys]
+
+    def api_get_account_count(self, session):
+        return len(self.ledger.account_names)
+
+    # Assets and markets
+    def api_lookup_asset_symbols(self, session, symbols):
+        return [self.ledger.get_asset(symbol) for symbol in symbols]
+
+    def api_get_assets(self, session, ids):
+        return [self.ledger.get_asset(i) for i in ids]
+
+    def api_get_ticker(self, session, base, quote):
+        return self.ledger.ticker(base, quote)
+
+    def api_get_order_book(self, session, base, quote, limit=50):
+        return self.ledger.book(base, quote, limit)
+
+    def api_get_limit_orders(self, session, asset_a, asset_b, limit):
+        books = self.ledger.books
+        ids = [entry[2] for entry in books[(asset_a, asset_b)][:limit] + books[(asset_b, asset_a)][:limit]]
+        return [self.ledger.get_object(i) for i in ids]
+
+    def api_get_call_orders(self, session, asset, limit):
+        return []
+
+    def api_get_settle_orders(self, session, asset, limit):
+        return []
+
+    def api_get_trade_history(self, session, base, quote, start, stop, limit=100):
+        return []
+
+    # Transactions
+    def api_get_required_fees(self, session, ops, asset_id):
+        return [{'amount': 0, 'asset_id': asset_id} for op in ops]
+
+    def api_get_potential_signatures(self, session, tx):
+        return []
+
+    def api_get_required_signatures(self, session, tx, keys):
+        return []
+
+    def api_verify_authority(self, session, tx):
+        return True
+
+    def api_broadcast_transaction(self, session, tx):
+        self.ledger.apply_transaction(tx)
+        return None
+
+    def api_broadcast_transaction_synchronous(self, session, tx):
+        results = self.ledger.apply_transaction(tx)
+        trx_num = len(self.ledger.block_transactions) - 1
+        return {'id': '{:040x}'.format(self.calls), 'block_num': self.ledger.head_block_number + 1,
+                'trx_num': trx_num, 'expired': False, 'trx': dict(tx, operation_results=results)}
+
+    def api_broadcast_transaction_with_callback(self, session, callback, tx):
+        return self.api_broadcast_transaction(session, tx)
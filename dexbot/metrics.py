@@ -0,0 +1,324 @@
+"""
+Counters and latency histograms for the running workers
+
+Everything goes into the module's :data:`registry`, keyed by a metric name
+and labels (mostly ``worker`` and ``event``)::
+
+    registry.inc('callback_errors', worker='worker1', event='ontick')
+    with registry.timer('callback_seconds', worker='worker1', event='ontick'):
+        ...
+
+What the bot records:
+
+``callback_seconds`` {worker, event}
+    time taken by a worker's ontick, onMarketUpdate and onAccount handlers
+``callback_errors`` {worker, event}
+    handlers that raised
+``rpc_calls`` / ``rpc_errors`` {worker, method}
+    calls to the node, worker is the one whose handler made the call
+    (``none`` outside handlers)
+``broadcast_seconds`` {worker, op}
+    time taken to place (``buy``, ``sell``) or cancel orders, retries included
+``order_latency_seconds`` {worker, op}
+    from the start of handling the event to the order being broadcast
+``storage_ops`` {worker, op}
+    database operations
+
+and, when the Prometheus exporter (:mod:`dexbot.exporter`) is on, gauges of
+each worker's state, open orders and balances and of the node's lag.
+
+The WorkerInfrastructure writes a snapshot to ``metrics.json`` in the data
+directory every minute, which is what ``dexbot-cli metrics`` shows.
+"""
+
+import bisect
+import copy
+import json
+import os
+import threading
+import time
+
+from appdirs import user_data_dir
+
+from dexbot import APP_NAME, AUTHOR
+
+try:
+    import contextvars
+except ImportError:  # Python < 3.7: the current event is kept per thread
+    contextvars = None
+
+SNAPSHOT_FILE = os.path.join(user_data_dir(APP_NAME, AUTHOR), 'metrics.json')
+SNAPSHOT_INTERVAL = 60  # seconds
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+NO_WORKER = 'none'
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def as_dict(self):
+        return {'value': self.value}
+
+
+class Gauge:
+    """ A value that goes up and down, the last one set """
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def as_dict(self):
+        return {'value': self.value}
+
+
+class Histogram:
+    """ Counts of observations per bucket, with their count and sum
+        (cumulative buckets like Prometheus' are made by as_dict)
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def __copy__(self):
+        other = Histogram(self.buckets)
+        other.counts = list(self.counts)
+        other.count = self.count
+        other.sum = self.sum
+        other.max = self.max
+        return other
+
+    def quantile(self, q):
+        """ Estimate of the q quantile (0-1), interpolating inside the bucket """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def as_dict(self):
+        cumulative = []
+        total = 0
+        for n in self.counts:
+            total += n
+            cumulative.append(total)
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': list(zip(list(self.buckets) + ['+Inf'], cumulative))}
+
+
+class ThreadLocalVar(threading.local):
+    """ The part of contextvars.ContextVar the Registry uses, per thread """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        # (worker name, time) of the event being handled, per thread or asyncio task
+        if contextvars is not None:
+            self.current = contextvars.ContextVar('dexbot_metrics_event', default=None)
+        else:
+            self.current = ThreadLocalVar('dexbot_metrics_event')
+        self.started = time.time()
+
+    def get(self, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics.setdefault(key, kind())
+        return metric
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            self.get(Counter, name, labels).inc(amount)
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.get(Histogram, name, labels).observe(value)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.get(Gauge, name, labels).set(value)
+
+    def remove(self, name, **labels):
+        """ Forget a metric, e.g. the gauges of a worker that was stopped """
+        with self.lock:
+            self.metrics.pop((name, tuple(sorted(labels.items()))), None)
+
+    def timer(self, name, **labels):
+        """ Context manager observing the time its block takes """
+        return _Timer(self, name, labels)
+
+    def clear(self):
+        with self.lock:
+            self.metrics.clear()
+            self.started = time.time()
+
+    # What the current thread is doing
+    def enter_event(self, worker_name):
+        """ Start handling an event for worker_name, returns a token for leave_event() """
+        return self.current.set((worker_name, time.time()))
+
+    def leave_event(self, token):
+        self.current.reset(token)
+
+    @property
+    def current_worker(self):
+        current = self.current.get()
+        return current[0] if current else NO_WORKER
+
+    def event_age(self):
+        """ Seconds since the current event started, None outside handlers """
+        current = self.current.get()
+        return None if current is None else time.time() - current[1]
+
+    # Reading
+    def collect(self):
+        """ [(name, labels dict, metric)] sorted by name
+
+            The metrics are copies, taken under the lock, so they can be read
+            while the workers go on recording.
+        """
+        with self.lock:
+            items = sorted(self.metrics.items(), key=lambda item: item[0])
+            return [(name, dict(labels), copy.copy(metric)) for (name, labels), metric in items]
+
+    def snapshot(self):
+        """ Everything as JSON-able dicts """
+        with self.lock:
+            metrics = [dict(name=name, labels=dict(labels), **metric.as_dict())
+                       for (name, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0])]
+        return {'time': time.time(), 'started': self.started, 'metrics': metrics}
+
+    def worker_summary(self, worker_name):
+        """ The metrics of one worker, as {name: {other label values: dict}} """
+        return snapshot_summaries(self.snapshot()).get(worker_name, {})
+
+    def save(self, path=SNAPSHOT_FILE):
+        """ Write a snapshot for dexbot-cli metrics """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self.snapshot(), fd)
+        os.replace(tmp, path)
+
+
+class _Timer:
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+def instrument_rpc(rpc, metrics=None):
+    """ Count the calls (and errors) made through a python-bitshares RPC connection """
+    metrics = metrics or registry
+    # vars(): the RPC classes answer any attribute with an API call
+    if rpc is None or vars(rpc).get('metrics_instrumented'):
+        return
+    rpcexec = rpc.rpcexec
+
+    def counted_rpcexec(payload):
+        params = payload.get('params') or [None, payload.get('method'), []]
+        method = params[1] if len(params) > 1 else payload.get('method')
+        worker = metrics.current_worker
+        metrics.inc('rpc_calls', worker=worker, method=method)
+        try:
+            return rpcexec(payload)
+        except Exception:
+            metrics.inc('rpc_errors', worker=worker, method=method)
+            raise
+
+    rpc.rpcexec = counted_rpcexec
+    rpc.metrics_instrumented = True
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def format_summary(metrics):
+    """ Lines describing a worker's metrics (from a snapshot or worker_summary), for people """
+    lines = []
+    for event, h in sorted(metrics.get('callback_seconds', {}).items()):
+        lines.append("{}: {} calls, p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            event, h['count'], h['p50'] * 1000, h['p99'] * 1000, h['max'] * 1000))
+    errors = sum(c['value'] for c in metrics.get('callback_errors', {}).values())
+    rpc = sum(c['value'] for c in metrics.get('rpc_calls', {}).values())
+    rpc_errors = sum(c['value'] for c in metrics.get('rpc_errors', {}).values())
+    storage = sum(c['value'] for c in metrics.get('storage_ops', {}).values())
+    lines.append("{} errors, {} RPC calls ({} failed), {} storage ops".format(errors, rpc, rpc_errors, storage))
+    for op, h in sorted(metrics.get('broadcast_seconds', {}).items()):
+        lines.append("{}: {} broadcasts, p50 {:.1f}ms, p99 {:.1f}ms".format(
+            op, h['count'], h['p50'] * 1000, h['p99'] * 1000))
+    for op, h in sorted(metrics.get('order_latency_seconds', {}).items()):
+        lines.append("{} event to broadcast: p50 {:.1f}ms, p99 {:.1f}ms".format(op, h['p50'] * 1000, h['p99'] * 1000))
+    return lines
+
+
+def snapshot_summaries(snapshot):
+    """ {worker: {name: {other label values: dict}}} from a snapshot """
+    workers = {}
+    for m in snapshot['metrics']:
+        labels = dict(m['labels'])
+        worker = labels.pop('worker', NO_WORKER)
+        key = ','.join(str(v) for _, v in sorted(labels.items())) or '-'
+        values = {k: v for k, v in m.items() if k not in ('name', 'labels')}
+        workers.setdefault(worker, {}).setdefault(m['name'], {})[key] = values
+    return workers
+
+
+registry = Registry()
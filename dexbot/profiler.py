@@ -0,0 +1,185 @@
+"""
+A sampling profiler for the workers' event handlers
+
+Turned on per worker, with ``profile: true`` in the worker's config or the
+chat command ``profile on``. While one of its handlers runs, a background
+thread looks at the stack of the thread running it every ``interval``
+seconds (5ms by default). Nothing is done to the handler itself, so
+profiling costs the worker next to nothing.
+
+The samples are written as collapsed stacks, the input of flamegraph.pl
+and speedscope, to the ``profiles`` directory in the data directory::
+
+    worker1-cpu.folded        samples of the worker's own code running
+    worker1-rpc.folded        samples of the worker waiting for the node
+    worker1-storage.folded    samples of the worker waiting for the database
+
+A sample counts as waiting when the stack is inside a call to the node or
+a database query. Each line is a stack, outermost first, and how many samples found it::
+
+    dexbot.strategies.relative_orders:check_orders;dexbot.basestrategy:orders;... 12
+
+Handlers that are coroutines (see :mod:`dexbot.aio`) run on the event loop
+and aren't sampled.
+"""
+
+import collections
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from appdirs import user_data_dir
+
+from dexbot import APP_NAME, AUTHOR
+from dexbot import helper
+
+log = logging.getLogger(__name__)
+
+PROFILE_DIR = os.path.join(user_data_dir(APP_NAME, AUTHOR), 'profiles')
+INTERVAL = 0.005  # seconds between samples
+FLUSH_INTERVAL = 60  # seconds between writing the files
+MAX_DEPTH = 100
+
+# A stack going through one of these is waiting for the node or the database
+WAITS = {
+    'grapheneapi.graphenewsrpc:rpcexec': 'rpc',
+    'grapheneapi.graphenehttprpc:rpcexec': 'rpc',
+    'dexbot.storage:_get_result': 'storage',
+}
+KINDS = ('cpu', 'rpc', 'storage')
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(frame.f_globals.get('__name__', os.path.basename(code.co_filename)), code.co_name)
+
+
+class Profiler:
+    """ Samples the threads running profiled workers' handlers
+
+        :param directory: where to write the .folded files
+    """
+
+    def __init__(self, directory=PROFILE_DIR, interval=INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.workers = set()
+        # thread id -> worker name, for the handlers running now
+        self.running = {}
+        self.samples = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.flushed = time.time()
+
+    # Turning it on and off
+    def enabled(self, worker_name):
+        return worker_name in self.workers
+
+    def enable(self, worker_name):
+        self.workers.add(worker_name)
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.sample_loop, name='dexbot-profiler', daemon=True)
+            self.thread.start()
+
+    def disable(self, worker_name):
+        """ Stop profiling worker_name and write its files """
+        self.workers.discard(worker_name)
+        self.flush(worker_name)
+        if not self.workers:
+            self.stop_thread()
+
+    def stop(self):
+        self.stop_thread()
+        self.flush()
+
+    def stop_thread(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    # The handlers
+    def wrap(self, worker_name, handler):
+        """ handler, sampled while it runs if worker_name is profiled """
+        if worker_name not in self.workers:
+            return handler
+        return functools.partial(self.run, worker_name, handler)
+
+    def run(self, worker_name, handler, *args, **kwargs):
+        ident = threading.get_ident()
+        self.running[ident] = worker_name
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            self.running.pop(ident, None)
+
+    # Sampling
+    def sample_loop(self):
+        while not self.stopping.wait(self.interval):
+            if self.running:
+                self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, worker_name in list(self.running.items()):
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack, kind = self.collapse(frame)
+            if stack:
+                with self.lock:
+                    self.samples[(worker_name, kind)][stack] += 1
+
+    def collapse(self, frame):
+        """ (the stack below run(), outermost first, joined by ';', one of KINDS) """
+        names = []
+        kind = 'cpu'
+        run_code = Profiler.run.__code__
+        while frame is not None and len(names) < MAX_DEPTH:
+            if frame.f_code is run_code:
+                break
+            name = frame_name(frame)
+            if kind == 'cpu' and name in WAITS:
+                kind = WAITS[name]
+            names.append(name)
+            frame = frame.f_back
+        return ';'.join(reversed(names)), kind
+
+    # Writing
+    def path(self, worker_name, kind):
+        return os.path.join(self.directory, '{}-{}.folded'.format(re.sub(r'[^\w.-]', '_', worker_name), kind))
+
+    def maybe_flush(self):
+        """ Write the files if FLUSH_INTERVAL has passed, called on every block """
+        if self.workers and time.time() - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self, worker_name=None):
+        """ Write the samples so far (of worker_name, or all) """
+        self.flushed = time.time()
+        with self.lock:
+            samples = {key: dict(counts) for key, counts in self.samples.items()
+                       if worker_name is None or key[0] == worker_name}
+        if not samples:
+            return
+        try:
+            helper.mkdir(self.directory)
+            for (name, kind), counts in samples.items():
+                path = self.path(name, kind)
+                with open(path + '.tmp', 'w') as fd:
+                    for stack, count in sorted(counts.items()):
+                        fd.write('{} {}\n'.format(stack, count))
+                os.replace(path + '.tmp', path)
+        except OSError:
+            log.exception("Cannot write the profiles")
+
+    def clear(self, worker_name):
+        with self.lock:
+            for key in [key for key in self.samples if key[0] == worker_name]:
+                del self.samples[key]
@@ -0,0 +1,175 @@
+"""
+Record the notifications a WorkerInfrastructure receives and play them back
+
+A recording is a file (gzipped if the name ends in .gz) with one JSON array
+per line::
+
+    [timestamp, kind, payload]
+
+kind is ``block`` (payload: the block id), ``market`` (payload: the order
+type and the raw object from the node) or ``account`` (payload: the raw
+account statistics object). Lines are only ever appended, so a recording
+can be copied off a running bot, and several runs can share a file.
+
+The payload is what the node sent, before python-bitshares turned it into
+Order, FilledOrder or AccountUpdate objects. Playing it back builds them
+again, so the node (or a stand-in) must be able to look up the assets and
+accounts involved.
+"""
+
+import gzip
+import json
+import logging
+import threading
+import time
+
+from bitshares.account import AccountUpdate
+from bitshares.price import Order, FilledOrder, UpdateCallOrder
+
+log = logging.getLogger(__name__)
+
+BLOCK = 'block'
+MARKET = 'market'
+ACCOUNT = 'account'
+
+# keys python-bitshares adds to the raw objects when parsing them
+PARSED_KEYS = ('base', 'quote', 'type', 'price')
+
+
+def open_recording(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def raw_market_event(data):
+    """ The (type, raw object) an on_market object was built from """
+    if data.get('deleted', False):
+        return 'deleted', {'id': data['id'], 'deleted': True}
+    raw = {k: v for k, v in data.items() if k not in PARSED_KEYS}
+    if isinstance(data, FilledOrder):
+        return 'filled', raw
+    if isinstance(data, UpdateCallOrder):
+        return 'call', raw
+    if 'sell_price' not in raw:
+        # Notify looked the order up by id, the price is all there is
+        raw['sell_price'] = data.json()
+    if isinstance(raw.get('for_sale'), dict):
+        raw['for_sale'] = raw['for_sale'].json()['amount']
+    return 'order', raw
+
+
+class DeletedOrder(dict):
+    """ Stands in for an Order that no longer exists """
+    pass
+
+
+def build_event(kind, payload, bitshares_instance=None):
+    """ Turn a recorded payload back into what Notify would have passed on """
+    if kind == BLOCK:
+        return payload
+    if kind == ACCOUNT:
+        return AccountUpdate(payload, bitshares_instance=bitshares_instance)
+    order_type, raw = payload
+    if order_type == 'filled':
+        return FilledOrder(raw, bitshares_instance=bitshares_instance)
+    if order_type == 'call':
+        return UpdateCallOrder(raw, bitshares_instance=bitshares_instance)
+    if order_type == 'deleted':
+        return DeletedOrder(raw)
+    return Order(raw, bitshares_instance=bitshares_instance)
+
+
+class Recorder:
+    """ Appends the notifications passed to on_block, on_market and on_account to a file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = open_recording(path, 'a')
+        self.count = 0
+
+    def record(self, kind, payload):
+        line = json.dumps([time.time(), kind, payload], separators=(',', ':'), default=str)
+        with self.lock:
+            if self.fd is None:
+                return
+            self.fd.write(line + '\n')
+            self.fd.flush()
+            self.count += 1
+
+    def on_block(self, data):
+        self.record(BLOCK, data)
+
+    def on_market(self, data):
+        self.record(MARKET, raw_market_event(data))
+
+    def on_account(self, account_update):
+        self.record(ACCOUNT, dict(account_update))
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+        log.info("Recorded {} events to {}".format(self.count, self.path))
+
+
+def read_recording(path):
+    """ Yield (timestamp, kind, payload) from a recording """
+    with open_recording(path, 'r') as fd:
+        for line in fd:
+            if line.strip():
+                stamp, kind, payload = json.loads(line)
+                yield stamp, kind, payload
+
+
+class Replay:
+    """ Feeds a recording into a WorkerInfrastructure's event callbacks
+
+        ::
+
+            worker = WorkerInfrastructure(config)
+            worker.init_workers(worker.config)
+            Replay('incident.rec.gz', worker, realtime=True).run()
+
+        At full speed (the default) each event is passed on as soon as the last
+        one has been handled. With realtime the original gaps between events
+        are kept, divided by speed.
+    """
+
+    def __init__(self, path, worker_infrastructure, realtime=False, speed=1.0):
+        self.path = path
+        self.infrastructure = worker_infrastructure
+        self.realtime = realtime
+        self.speed = speed
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        """ Play the whole recording, returns (events, seconds taken) """
+        infrastructure = self.infrastructure
+        callbacks = {
+            BLOCK: infrastructure.on_block,
+            MARKET: infrastructure.on_market,
+            ACCOUNT: infrastructure.on_account
+        }
+        started = time.time()
+        first = None
+        count = 0
+        for stamp, kind, payload in read_recording(self.path):
+            if self.stopped:
+                break
+            event = build_event(kind, payload, infrastructure.bitshares)
+            if self.realtime:
+                if first is None:
+                    first = stamp
+                delay = started + (stamp - first) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            callbacks[kind](event)
+            count += 1
+        return count, time.time() - started
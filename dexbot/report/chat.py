@@ -1,13 +1,121 @@
 import dexbot
 import dexbot.report
+from dexbot import metrics
+from dexbot import tracing
+from dexbot.profiler import KINDS as profiler_kinds
+import collections
 import re
 import datetime
+import threading
 import time
 import logging
 from os.path import basename
 
 log = logging.getLogger(__name__)
 
+# Log records are sent in batches, one message per worker every BATCH_WINDOW seconds
+BATCH_WINDOW = 5.0
+# Lines per minute for each level and above, beyond that they are counted but not sent
+# (None: no limit)
+RATE_LIMITS = {
+    logging.DEBUG: 10,
+    logging.INFO: 20,
+    logging.WARNING: 30,
+    logging.ERROR: 60,
+    logging.CRITICAL: None
+}
+MAX_LINES = 50  # different lines kept per worker between batches
+
+
+class MessageAggregator:
+    """ Collects log lines per worker and sends them from its own thread, batched
+
+        The same line again in a batch is sent once, with how many times it came.
+        Lines over the rate limit of their level are dropped, and the next
+        batch says how many were.
+
+        :param send: called as send(message, worker_name=..., level=...)
+    """
+
+    def __init__(self, send, window=BATCH_WINDOW, limits=None):
+        self.send = send
+        self.window = window
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        # worker name -> {line: [count, level]}
+        self.pending = collections.OrderedDict()
+        self.dropped = collections.Counter()
+        # the lines each level may still send, refilled at its limit per minute
+        self.allowance = {level: limit for level, limit in self.limits.items() if limit is not None}
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='dexbot-chat', daemon=True)
+        self.thread.start()
+
+    def add(self, line, worker_name='N/A', level=logging.INFO):
+        with self.lock:
+            lines = self.pending.setdefault(worker_name, collections.OrderedDict())
+            if line in lines:
+                lines[line][0] += 1
+                lines[line][1] = max(lines[line][1], level)
+            elif len(lines) < MAX_LINES:
+                lines[line] = [1, level]
+            else:
+                self.dropped[worker_name] += 1
+
+    def run(self):
+        while not self.stopping.wait(self.window):
+            self.flush()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.flush()
+
+    def limit_for(self, level):
+        """ The level of self.limits that applies to level, None if unlimited """
+        applies = [i for i in self.limits if i <= level]
+        return max(applies) if applies else min(self.limits)
+
+    def refill(self):
+        now = time.monotonic()
+        minutes = (now - self.refilled) / 60
+        self.refilled = now
+        for level in self.allowance:
+            self.allowance[level] = min(self.limits[level], self.allowance[level] + self.limits[level] * minutes)
+
+    def flush(self):
+        """ Send what has come since the last batch """
+        with self.lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+            dropped, self.dropped = self.dropped, collections.Counter()
+            self.refill()
+            batches = []
+            for worker_name in set(pending) | set(dropped):
+                lines = []
+                top = logging.NOTSET
+                for line, (count, level) in pending.get(worker_name, {}).items():
+                    limit = self.limit_for(level)
+                    if limit in self.allowance:
+                        if self.allowance[limit] < 1:
+                            dropped[worker_name] += count
+                            continue
+                        self.allowance[limit] -= 1
+                    lines.append(line if count == 1 else "{} (x{})".format(line, count))
+                    top = max(top, level)
+                if dropped[worker_name]:
+                    lines.append("({} more messages not sent)".format(dropped[worker_name]))
+                    top = max(top, logging.WARNING)
+                if lines:
+                    batches.append((worker_name, "\n".join(lines), top))
+        for worker_name, message, level in batches:
+            try:
+                self.send(message, worker_name=worker_name, level=level)
+            except Exception:
+                # not through the logging: it would come back here
+                with self.lock:
+                    self.dropped[worker_name] += 1
+
 
 class ChatReporter(dexbot.report.BaseReporter, logging.Handler):
 
@@ -15,21 +123,33 @@ class ChatReporter(dexbot.report.BaseReporter, logging.Handler):
     Base class for reporters that use a chat system (XMPP, Telegram, etc)
     """
 
-    def __init__(self, worker_inf):
+    def __init__(self, worker_inf, batch_window=BATCH_WINDOW, rate_limits=None):
         logging.Handler.__init__(self)
+        # log records go out in batches from the aggregator's thread, replies
+        # to commands straight away
+        self.aggregator = MessageAggregator(self.send_message, batch_window, rate_limits)
         logging.getLogger("dexbot").addHandler(self)
         logging.getLogger("dexbot.per_bot").addHandler(self)
         self.worker_inf = worker_inf
         dexbot.report.BaseReporter.__init__(self)
 
     def emit(self, record):
+        # the chat system logging about sending a batch
+        if threading.current_thread() is self.aggregator.thread:
+            return
         # Use default formatting:
         self.format(record)
-        notes = record.msg
+        notes = record.getMessage()
         if record.exc_info:
             notes += " " + \
                 logging._defaultFormatter.formatException(record.exc_info)
-        self.send_message(notes, level=record.levelno, worker_name=getattr(record,'worker_name','N/A'))
+        self.aggregator.add(notes, level=record.levelno, worker_name=getattr(record,'worker_name','N/A'))
+
+    def shutdown(self):
+        """Send what is waiting, and stop taking log records"""
+        logging.getLogger("dexbot").removeHandler(self)
+        logging.getLogger("dexbot.per_bot").removeHandler(self)
+        self.aggregator.stop()
 
     def send_message(self, message, worker_name='N/A', level=logging.INFO, reply_ref=None):
         """
@@ -64,10 +184,12 @@ class ChatReporter(dexbot.report.BaseReporter, logging.Handler):
             else:
                 worker_name = splits[0].strip()
                 if worker_name not in self.worker_inf.workers:
-                    self.send_message("No such worker", level=logging.ERROR, worker_name=worker_name, reply_ref=reply_ref)
+                    self.send_message("No such worker", level=logging.ERROR, worker_name=worker_name,
+                                      reply_ref=reply_ref)
                     return
                 message = splits[1]
-                self.worker = self.workers_inf.workers[workername]
+                self.worker = self.worker_inf.workers[worker_name]
+            self.worker_name = worker_name
             message = message.split()
             command = message[0].lower()
             # a few comand synonyms
@@ -84,7 +206,8 @@ class ChatReporter(dexbot.report.BaseReporter, logging.Handler):
             reply = reply.strip()
             self.send_message(reply, level=logging.INFO, reply_ref=reply_ref)
         except (IndexError, ValueError, KeyError, AttributeError, TypeError):
-            self.send_message("Invalid command, use 'help' for help", level=logging.ERROR, worker_name=worker_name, reply_ref=reply_ref)
+            self.send_message("Invalid command, use 'help' for help", level=logging.ERROR,
+                              worker_name=worker_name, reply_ref=reply_ref)
 
     def cmd_stop(self):
         """Stop a bot
@@ -146,17 +269,57 @@ class ChatReporter(dexbot.report.BaseReporter, logging.Handler):
         return ["{}: {}".format(*i) for i in self.worker.worker.items()]
 
     def cmd_status(self):
-        """Return current status and open orders
+        """Return current status and open orders (as of the last snapshot, at most a few blocks ago)
         """
-        if self.worker.disabled:
+        # from the snapshot: no calls to the node, nothing the worker may be changing
+        snapshot = self.worker_inf.snapshot(self.worker_name)
+        if snapshot is None:
+            return "no status yet, wait for the next block"
+        if snapshot.disabled:
             return "disabled (use 'kick')"
-        s = ["running in {} account {}".format(self.worker.worker['market'],self.worker.worker['account'])]
-        if "price" in self.worker:
-            s.append("base price is {}".format(self.worker['price']))
-        for o in self.worker.orders:
-            s.append(str(o))
+        s = ["running in {} account {}".format(snapshot.market, snapshot.account)]
+        if snapshot.base_price is not None:
+            s.append("base price is {}".format(snapshot.base_price))
+        s.append("balances: " + ", ".join("{} {}".format(amount, symbol)
+                                          for symbol, amount in snapshot.balances.items()))
+        s.extend(snapshot.orders)
+        if snapshot.last_tick is not None:
+            s.append("last block {:.0f}s ago".format(time.time() - snapshot.last_tick))
+        if snapshot.errors:
+            s.append("{} errors, the last: {}".format(snapshot.errors, snapshot.last_error))
+        s.append("as of {:.0f}s ago".format(time.time() - snapshot.time))
+        s.extend(metrics.format_summary(metrics.registry.worker_summary(self.worker_name)))
         return s
 
+    def cmd_profile(self, state='on'):
+        """'profile on|off|clear' Sample where the worker's handlers spend their time.
+        The flamegraph files are written to the profiles folder in the data folder.
+        """
+        profiler = self.worker_inf.profiler
+        state = state.lower()
+        if state == 'on':
+            profiler.enable(self.worker_name)
+        elif state == 'off':
+            profiler.disable(self.worker_name)
+        elif state == 'clear':
+            profiler.clear(self.worker_name)
+        else:
+            raise ValueError(state)
+        return "profiling is {}, files: {}".format(
+            "on" if profiler.enabled(self.worker_name) else "off",
+            ", ".join(profiler.path(self.worker_name, kind) for kind in profiler_kinds))
+
+    def cmd_rpc(self, top='5'):
+        """'rpc N' The N strategy methods making the most calls to the node lately
+        (needs tracing: run with --trace-rpc)
+        """
+        if tracing.tracer is None:
+            return "tracing is off (run with --trace-rpc)"
+        calls = tracing.tracer.recent(self.worker_name)
+        by = ('caller', 'method')
+        return ["{} calls traced".format(len(calls))] + \
+            tracing.format_rows(tracing.summarize(calls, by)[:int(top)], by)
+
     def cmd_set(self, key, value):
         """'set KEY VALUE' set configuration parameter KEY to VALUE. 
         This will not make the worker enter new orders: use 'reset' when you are done changing values.
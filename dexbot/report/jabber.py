@@ -56,6 +56,7 @@ class Reporter(sleekxmpp.ClientXMPP, dexbot.report.chat.ChatReporter):
         self.shutdown()
 
     def shutdown(self):
+        dexbot.report.chat.ChatReporter.shutdown(self)
         sleekxmpp.ClientXMPP.disconnect(self)
 
     def send_message(self, message, worker_name='N/A', level=logging.INFO, reply_ref=None):
@@ -1,12 +1,19 @@
 import dexbot.storage
 import dexbot.report
+from dexbot import helper
 from dexbot.basestrategy import ConfigElement
 import re
+import base64
 import datetime
 import smtplib
 import getpass
 import socket
+import html
 import io
+import itertools
+import os
+import queue
+import threading
 import time
 import logging
 from os.path import basename
@@ -24,6 +31,15 @@ EMAIL_DEFAULT = {
     'port': 25,
     'subject': 'DEXBot Regular Report'}
 
+# Reports are built and sent on the reporter's own thread, the tick only queues them
+QUEUE_SIZE = 4
+SEND_ATTEMPTS = 4
+RETRY_DELAY = 60  # seconds before the first retry, doubled after each failure
+SMTP_TIMEOUT = 60  # seconds, for each SMTP operation
+SHUTDOWN_TIMEOUT = 30  # seconds to let a report being sent finish
+LOG_ENTRIES = 200  # of each worker's log in the e-mail, the last ones
+TOP_ERRORS = 10
+
 signalled = False
 
 INTRO = """
@@ -54,6 +70,121 @@ INTRO = """
 LOGLEVELS = {0: 'debug', 1: 'info', 2: 'warn', 3: 'critical'}
 
 
+class ReportWriter:
+    """Writes the HTML of a report to fd a worker at a time, as the rows are read
+
+    log_entries: how many of the last log entries to give, None for all of them
+    top_errors: how many of the most frequent warnings and errors to list
+    embed_graphs: put the graphs in the HTML (data: URIs) rather than link to
+    them: the graph cache's files don't last
+    """
+
+    def __init__(self, fd, start, log_entries=LOG_ENTRIES, top_errors=TOP_ERRORS, embed_graphs=False):
+        self.fd = fd
+        self.start = start
+        self.log_entries = log_entries
+        self.top_errors = top_errors
+        self.embed_graphs = embed_graphs
+
+    def write(self, text, *args):
+        self.fd.write(text.format(*(html.escape(str(i)) for i in args)))
+
+    def begin(self):
+        self.fd.write(INTRO)
+
+    def end(self):
+        self.fd.write("</body></html>")
+
+    def note(self, text):
+        self.write("<p>{}</p>", text)
+
+    def worker(self, workername, worker, settings, files=None):
+        """The worker's section
+        files: list to add the graph's file to, for a cid: link; if None the
+        graph is embedded or linked by its path"""
+        self.write("<h1>Worker {}</h1>\n", workername)
+        self.fd.write('<h2>Settings</h2><table id="worker">')
+        for key, value in settings.items():
+            self.write("<tr><td>{}</td><td>{}</td></tr>", key, value)
+        self.fd.write("</table><h2>Graph</h2>")
+        self.graph(worker, files)
+        self.fd.write("<h2>Balance History</h2>")
+        self.journal(worker)
+        self.fd.write("<h2>Log</h2>")
+        self.log(worker)
+
+    def graph(self, worker, files):
+        fname = worker.graph(start=self.start)
+        if fname is None:
+            self.fd.write("<p>Not enough data to graph.</p>")
+        elif files is None and self.embed_graphs:
+            try:
+                with open(fname, 'rb') as fd:
+                    data = base64.b64encode(fd.read()).decode('ascii')
+            except OSError:
+                log.exception("Cannot read the graph {}".format(fname))
+                self.fd.write("<p>The graph is not available.</p>")
+                return
+            self.write('<p><img src="data:image/png;base64,{}"></p>', data)
+        elif files is None:
+            self.write('<p><img src="{}"></p>', fname)
+        else:
+            self.write('<p><img src="cid:{}"></p>', basename(fname))
+            files.append(fname)
+
+    def journal(self, worker):
+        """The journal by the hour, or by the day over long periods"""
+        rows = worker.query_journal_buckets(self.start)
+        if not rows:
+            self.fd.write("<p>No data</p>")
+            return
+        cols = list(dict.fromkeys(row[1] for row in rows))
+        self.fd.write('<table id="journal"><tr><th>Date</th>')
+        for i in cols:
+            self.write('<th>{}</th>', i)
+        self.fd.write('</tr>')
+        for stamp, values in itertools.groupby(rows, key=lambda row: row[0]):
+            values = {key: value for _, key, value in values}
+            self.write('<tr><td>{}</td>', stamp)
+            for i in cols:
+                self.write('<td>{}</td>', values.get(i, ''))
+            self.fd.write('</tr>')
+        self.fd.write('</table>')
+
+    def log(self, worker):
+        """Entries per severity, the most frequent errors and the (last) entries"""
+        counts, errors = worker.query_log_summary(self.start, top=self.top_errors)
+        total = sum(counts.values())
+        if total == 0:
+            self.fd.write("<p>No entries</p>")
+            return
+        self.fd.write('<table id="severity"><tr>')
+        for severity, name in LOGLEVELS.items():
+            self.write('<th class="{}">{}</th>', name, name)
+        self.fd.write('</tr><tr>')
+        for severity in LOGLEVELS:
+            self.write('<td>{}</td>', counts.get(severity, 0))
+        self.fd.write('</tr></table>')
+        if errors:
+            self.fd.write('<h3>Most frequent warnings and errors</h3><table id="errors">'
+                          '<tr><th>Times</th><th>Last</th><th>Message</th></tr>')
+            for message, severity, count, last in errors:
+                self.write('<tr class="{}"><td>{}</td><td>{}</td><td>{}</td></tr>',
+                           LOGLEVELS.get(severity, 'critical'), count, last, message)
+            self.fd.write('</table>')
+        if self.log_entries is None:
+            entries = worker.iter_log(self.start)
+        else:
+            entries = worker.query_log_tail(self.start, limit=self.log_entries)
+            if total > len(entries):
+                self.write("<h3>The last {} of {} entries</h3>", len(entries), total)
+        self.fd.write('<table id="log">')
+        for _, severity, stamp, message in entries:
+            self.write('<tr class="{}"><td>{}</td><td>{}</td></tr>',
+                       LOGLEVELS.get(severity, 'critical'), stamp, message)
+        self.fd.write('</table>')
+
+
 class Reporter(dexbot.storage.Storage, dexbot.report.BaseReporter):
 
     @classmethod
@@ -79,8 +210,12 @@ class Reporter(dexbot.storage.Storage, dexbot.report.BaseReporter):
             self['lastrun'] = self.lastrun = time.time()
         else:
             self.lastrun = self['lastrun']
-        logging.getLogger("dexbot.per_bot").addHandler(
+        logging.getLogger("dexbot.per_worker").addHandler(
             dexbot.storage.SQLiteHandler())  # and log to SQLIte DB
+        self.jobs = queue.Queue(QUEUE_SIZE)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.report_loop, name='dexbot-reporter', daemon=True)
+        self.thread.start()
 
     def ontick(self):
         now = time.time()
@@ -88,74 +223,134 @@ class Reporter(dexbot.storage.Storage, dexbot.report.BaseReporter):
         # as well as one serialised via storage.Storage
         if now - self.lastrun > 24 * 60 * 60 * self.config['days']:
             try:
-                self.run_report(datetime.datetime.fromtimestamp(self.lastrun))
+                self.queue_report(datetime.datetime.fromtimestamp(self.lastrun))
             finally:
                 self['lastrun'] = self.lastrun = now
 
+    def shutdown(self):
+        """Stop the reporter thread, letting a report being sent finish"""
+        self.stopping.set()
+        try:
+            self.jobs.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(SHUTDOWN_TIMEOUT)
+        if self.thread.is_alive():
+            log.warning("Gave up waiting for the e-mail report to be sent")
+
     def run_report_week(self):
         """Generate report for the past week on-the-spot"""
-        self.run_report(datetime.datetime.fromtimestamp(
+        self.queue_report(datetime.datetime.fromtimestamp(
             time.time() - 7 * 24 * 60 * 60),
             subject="DEXBot on-the-spot report")
 
+    def queue_report(self, start, subject=None):
+        """Queue a report for the reporter thread, returns at once
+        The workers and their settings are copied here, under config_lock,
+        so the thread doesn't look at them while they change
+        """
+        with self.worker_inf.config_lock:
+            workers = [(workername, worker, dict(self.worker_inf.config['workers'][workername]))
+                       for workername, worker in self.worker_inf.workers.items()]
+        try:
+            self.jobs.put_nowait((start, subject, workers))
+        except queue.Full:
+            log.warning("E-mail reports are backed up, skipping the report from {}".format(start))
+
+    def report_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None or self.stopping.is_set():
+                return
+            start, subject, workers = job
+            # the graphs are graph.cache's files, left for the next report
+            files = []
+            try:
+                text = self.build_report(start, workers, files)
+                self.deliver(text, files, subject)
+            except Exception:
+                log.exception("Cannot build the e-mail report")
+
+    def deliver(self, text, files, subject):
+        """Send the report, retrying with a growing delay if the SMTP server fails"""
+        delay = RETRY_DELAY
+        for attempt in range(1, SEND_ATTEMPTS + 1):
+            try:
+                self.send_mail(text, files, subject)
+                return True
+            except (smtplib.SMTPException, OSError) as e:
+                if attempt == SEND_ATTEMPTS:
+                    log.error("Cannot send the e-mail report, giving up: {}".format(e))
+                    return False
+                log.warning("Cannot send the e-mail report (attempt {}), retrying in {}s: {}".format(
+                    attempt, delay, e))
+            if self.stopping.wait(delay):
+                log.warning("Shutting down, the e-mail report was not sent")
+                return False
+            delay *= 2
+
     def run_report(self, start, subject=None):
-        """Generate report
+        """Generate and send a report now, in this thread
         start: timestamp to begin"""
-        msg = io.StringIO()
+        with self.worker_inf.config_lock:
+            workers = [(workername, worker, dict(self.worker_inf.config['workers'][workername]))
+                       for workername, worker in self.worker_inf.workers.items()]
         files = []
-        msg.write(INTRO)
-        for workername, worker in self.worker_inf.workers.items():
-            msg.write("<h1>Worker {}</h1>\n".format(workername))
-            msg.write('<h2>Settings</h2><table id="worker">')
-            for key, value in self.worker_inf.config['workers'][workername].items():
-                msg.write("<tr><td>{}</td><td>{}</tr>".format(key, value))
-            msg.write("</table><h2>Graph</h2>")
-            fname = worker.graph(start=start)
-            if fname is not None:
-                msg.write("<p><img src=\"cid:{}\"></p>".format(basename(fname)))
-                files.append(fname)
-            else:
-                msg.write("<p>Not enough data to graph.<p>")
-            msg.write("<h2>Balance History</h2>")
-            data = graph.query_to_dicts(worker.query_journal(start=start))
-            if len(data) == 0:
-                msg.write("<p>No data</p>")
-            else:
-                msg.write('<table id="journal"><tr><th>Date</th>')
-                cols = data[max(data.keys())].keys()
-                for i in cols:
-                    msg.write('<th>{}</th>'.format(i))
-                msg.write('</tr>')
-                for stamp in sorted(data.keys()):
-                    msg.write('<tr><td>{}</td>'.format(stamp))
-                    for i in cols:
-                        msg.write('<td>{}</td>'.format(data[stamp][i]))
-                    msg.write('</tr>')
-                msg.write('</table>')
-            msg.write('<h2>Log</h2><table id="log">')
-            logs = worker.query_log(start=start)
-            for entry in logs:
-                msg.write('<tr class="{}"><td>{}</td><td>{}</td></tr>'.format(
-                    LOGLEVELS[entry.severity],
-                    entry.stamp,
-                    entry.message))
-        msg.write("</table></body></html>")
-        self.send_mail(msg.getvalue(), files, subject)
+        self.send_mail(self.build_report(start, workers, files), files, subject)
+
+    def build_report(self, start, workers, files):
+        """The report's HTML: the log is summed up and only its last entries are in it,
+        so the e-mail is much the same size however long the period
+        With save_to in the config, the whole report is also written to a file there
+        workers: [(name, worker, settings)]
+        files: list the graphs' files are added to"""
+        saved = None
+        if self.config.get('save_to'):
+            saved = self.save_report(start, workers)
+        msg = io.StringIO()
+        writer = ReportWriter(msg, start,
+                              log_entries=self.config.get('log_entries', LOG_ENTRIES),
+                              top_errors=self.config.get('top_errors', TOP_ERRORS))
+        writer.begin()
+        if saved:
+            writer.note("The whole report, with every log entry, is in {}".format(saved))
+        for workername, worker, settings in workers:
+            writer.worker(workername, worker, settings, files)
+        writer.end()
+        return msg.getvalue()
+
+    def save_report(self, start, workers):
+        """Write the report with the whole log to a file in save_to, returns its path"""
+        folder = self.config['save_to']
+        path = os.path.join(folder, "report-{:%Y%m%d-%H%M%S}.html".format(datetime.datetime.now()))
+        try:
+            helper.mkdir(folder)
+            with open(path, "w") as fd:
+                writer = ReportWriter(fd, start, log_entries=None,
+                                      top_errors=self.config.get('top_errors', TOP_ERRORS), embed_graphs=True)
+                writer.begin()
+                for workername, worker, settings in workers:
+                    writer.worker(workername, worker, settings)
+                writer.end()
+        except OSError:
+            log.exception("Cannot save the report to {}".format(folder))
+            return None
+        return path
 
     def send_mail(self, text, files=None, subject=None):
-        nc = EMAIL_DEFAULT.copy()
-        nc.update(self.config)
+        # a copy: reports may be sent from the reporter thread
+        config = EMAIL_DEFAULT.copy()
+        config.update(self.config)
         if subject is not None:
-            nc['subject'] = subject
-        self.config = nc
+            config['subject'] = subject
         msg = MIMEMultipart('related')
-        if not "send_from" in self.config:
-            self.config['send_from'] = getpass.getuser() + "@" + \
+        if not config.get("send_from"):
+            config['send_from'] = getpass.getuser() + "@" + \
                 socket.gethostname()
-        msg['From'] = self.config['send_from']
-        msg['To'] = self.config.get('send_to', self.config['send_from'])
+        msg['From'] = config['send_from']
+        msg['To'] = config.get('send_to') or config['send_from']
         msg['Date'] = formatdate(localtime=True)
-        msg['Subject'] = self.config['subject']
+        msg['Subject'] = config['subject']
 
         msg.attach(MIMEText(text, "html"))
 
@@ -171,10 +366,13 @@ class Reporter(dexbot.storage.Storage, dexbot.report.BaseReporter):
             part['Content-ID'] = '<{}>'.format(basename(f))
             msg.attach(part)
 
-        smtp = smtplib.SMTP(self.config['server'], port=self.config['port'])
-        if "user" in self.config:
-            smtp.ehlo()
-            smtp.starttls()
-            smtp.login(self.config['user'], self.config['password'])
-        smtp.send_message(msg)
-        smtp.close()
+        smtp = smtplib.SMTP(config['server'], port=config['port'],
+                            timeout=config.get('timeout', SMTP_TIMEOUT))
+        try:
+            if config.get("user"):
+                smtp.ehlo()
+                smtp.starttls()
+                smtp.login(config['user'], config['password'])
+            smtp.send_message(msg)
+        finally:
+            smtp.close()
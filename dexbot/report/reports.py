@@ -79,7 +79,7 @@ class EmailReporter(Storage,Reporter):
             self['lastrun'] = self.lastrun = time.time()
         else:
             self.lastrun = self['lastrun']
-        logging.getLogger("dexbot.per_bot").addHandler(
+        logging.getLogger("dexbot.per_worker").addHandler(
             SQLiteHandler())  # and log to SQLIte DB
 
     def ontick(self):
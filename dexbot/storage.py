@@ -1,5 +1,6 @@
 import os
 import json
+import collections
 import threading
 import queue
 import uuid
@@ -11,17 +12,39 @@ from appdirs import user_data_dir
 
 from . import helper
 from dexbot import APP_NAME, AUTHOR
+from dexbot import metrics
 
+import numpy
 import sqlalchemy
-from sqlalchemy import create_engine, Table, Column, String, Integer, MetaData, DateTime, Float
+from sqlalchemy import create_engine, Table, Column, String, Integer, MetaData, DateTime, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 Base = declarative_base()
 
+log = logging.getLogger(__name__)
+
 # For dexbot.sqlite file
 storageDatabase = "dexbot.sqlite"
 
+# How long rows are kept, in days (None: forever). Set from the retention
+# section of config.yml. Raw journal rows are rolled up into hourly and
+# daily buckets before they go, logs just go.
+RETENTION = {
+    'journal_days': 30,
+    'hourly_days': 365,
+    'daily_days': None,
+    'log_days': 90
+}
+# Compaction works on this many rows at a time, when the database thread has
+# been idle for COMPACT_IDLE seconds, and starts over every COMPACT_INTERVAL
+COMPACT_CHUNK = 1000
+COMPACT_IDLE = 1.0
+COMPACT_INTERVAL = 60 * 60
+VACUUM_INTERVAL = 7 * 24 * 60 * 60
+# The Config category of the database's own bookkeeping
+STORAGE_CATEGORY = '__storage__'
+
 
 class Config(Base):
     __tablename__ = 'config'
@@ -39,6 +62,7 @@ class Config(Base):
 
 class Journal(Base):
     __tablename__ = 'journal'
+    __table_args__ = (Index('ix_journal_category_stamp', 'category', 'stamp'),)
     id = Column(Integer, primary_key=True)
     category = Column(String)
     key = Column(String)
@@ -46,8 +70,26 @@ class Journal(Base):
     stamp = Column(DateTime, default=datetime.datetime.now)
 
 
+class JournalBucket(Base):
+    """ The journal entries of a key over an hour or a day """
+    __tablename__ = 'journal_bucket'
+    __table_args__ = (Index('ix_journal_bucket', 'category', 'resolution', 'start', 'key', unique=True),)
+    id = Column(Integer, primary_key=True)
+    category = Column(String)
+    key = Column(String)
+    resolution = Column(String)  # 'hour' or 'day'
+    start = Column(DateTime)
+    count = Column(Integer)
+    sum = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+    first = Column(Float)
+    last = Column(Float)
+
+
 class Log(Base):
     __tablename__ = 'log'
+    __table_args__ = (Index('ix_log_category_stamp', 'category', 'stamp'),)
     id = Column(Integer, primary_key=True)
     category = Column(String)
     severity = Column(Integer)
@@ -55,6 +97,73 @@ class Log(Base):
     stamp = Column(DateTime, default=datetime. datetime.now)
 
 
+BUCKET_STARTS = {
+    'hour': lambda stamp: stamp.replace(minute=0, second=0, microsecond=0),
+    'day': lambda stamp: stamp.replace(hour=0, minute=0, second=0, microsecond=0)
+}
+# query_journal_arrays(resolution='auto') picks the finest resolution giving at most this many points
+MAX_POINTS = 1000
+# Journal rows rolled up as they are written (more wait for compaction)
+ROLLUP_ON_WRITE = 100
+# log rows read at a time by Storage.iter_log
+LOG_CHUNK = 1000
+BUCKET_VALUES = ('last', 'first', 'mean', 'min', 'max', 'sum', 'count')
+
+
+def parse_start(start, now=None):
+    """ A datetime from a datetime or a period back from now, '3d' or '2w' """
+    if isinstance(start, str):
+        m = re.match("(\\d+)([dw])", start)
+        if m:
+            n = int(m.group(1))
+            start = now or datetime.datetime.now()
+            if m.group(2) == 'w':
+                n *= 7
+            start -= datetime.timedelta(days=n)
+    return start
+
+
+def pick_resolution(start, end_, retention=RETENTION):
+    """ 'hour' or 'day', for query_journal_arrays(resolution='auto') """
+    end_ = end_ or datetime.datetime.now()
+    hours = (end_ - start).total_seconds() / 3600
+    hourly_days = retention.get('hourly_days')
+    too_old = hourly_days is not None and start < datetime.datetime.now() - datetime.timedelta(days=hourly_days)
+    return 'day' if hours > MAX_POINTS or too_old else 'hour'
+
+
+def journal_arrays(rows):
+    """ (stamps, {key: values}) from (stamp, key, value) rows: numpy arrays, the
+        stamps as datetime64[s] sorted, the values float with NaN where a key has none
+    """
+    stamps = sorted({row[0] for row in rows})
+    index = {stamp: i for i, stamp in enumerate(stamps)}
+    series = {}
+    for stamp, key, value in rows:
+        values = series.get(key)
+        if values is None:
+            values = series[key] = numpy.full(len(stamps), numpy.nan)
+        values[index[stamp]] = numpy.nan if value is None else value
+    return numpy.array(stamps, dtype='datetime64[s]'), series
+
+
+def bucket_rows(rows, resolution, value='last'):
+    """ Journal (stamp, key, amount) rows in time order, aggregated into hour or day buckets
+        in Python, the same as the database does. Returns (start, key, value) rows
+    """
+    if resolution == 'raw':
+        return list(rows)
+    bucket_start = BUCKET_STARTS[resolution]
+    buckets = collections.OrderedDict()
+    for stamp, key, amount in rows:
+        buckets.setdefault((bucket_start(stamp), key), []).append(float(amount))
+    aggregate = {
+        'last': lambda a: a[-1], 'first': lambda a: a[0], 'mean': lambda a: sum(a) / len(a),
+        'min': min, 'max': max, 'sum': sum, 'count': len
+    }[value]
+    return [(start, key, aggregate(amounts)) for (start, key), amounts in buckets.items()]
+
+
 class Orders(Base):
     __tablename__ = 'orders'
 
@@ -79,53 +188,122 @@ class Storage(dict):
     def __init__(self, category):
         self.category = category
 
+    def count_op(self, op):
+        metrics.registry.inc('storage_ops', worker=self.category, op=op)
+
     def __setitem__(self, key, value):
+        self.count_op('set')
         db_worker.set_item(self.category, key, value)
 
     def __getitem__(self, key):
+        self.count_op('get')
         return db_worker.get_item(self.category, key)
 
     def __delitem__(self, key):
+        self.count_op('delete')
         db_worker.del_item(self.category, key)
 
     def __contains__(self, key):
+        self.count_op('contains')
         return db_worker.contains(self.category, key)
 
     def items(self):
+        self.count_op('items')
         return db_worker.get_items(self.category)
 
     def clear(self):
+        self.count_op('clear')
         db_worker.clear(self.category)
 
     def save_journal(self, amounts):
+        self.count_op('save_journal')
         db_worker.execute_noreturn(db_worker.save_journal, self.category, amounts)
 
     def query_journal(self, start, end_=None):
+        self.count_op('query_journal')
         return db_worker.execute(db_worker.query_journal, self.category, start, end_)
 
+    def query_journal_arrays(self, start, end_=None, resolution='auto', value='last'):
+        """ The journal as numpy arrays: (stamps, {key: values})
+
+            resolution: 'hour' or 'day' buckets, 'raw' for the entries as they were
+                written, or 'auto' for buckets giving at most MAX_POINTS points
+            value: what each bucket gives, one of BUCKET_VALUES ('last' is the
+                value at the end of the bucket)
+        """
+        self.count_op('query_journal_arrays')
+        return journal_arrays(self.query_journal_buckets(start, end_, resolution, value))
+
+    def query_journal_buckets(self, start, end_=None, resolution='auto', value='last'):
+        """ The (stamp, key, value) rows behind query_journal_arrays, in time order """
+        if value not in BUCKET_VALUES:
+            raise ValueError("value must be one of {}".format(', '.join(BUCKET_VALUES)))
+        return db_worker.execute(db_worker.query_journal_buckets, self.category, start, end_, resolution, value)
+
+    def journal_window(self, start, end_=None):
+        """ (start as a datetime, the resolution 'auto' picks) for a journal query """
+        start = parse_start(start)
+        return start, pick_resolution(start, end_, db_worker.retention)
+
+    def journal_high_water(self):
+        """ The id of the last journal entry in the buckets: it changes when they do """
+        self.count_op('journal_high_water')
+        return db_worker.execute(db_worker.journal_high_water, self.category)
+
     def query_log(self, start, end_=None):
+        self.count_op('query_log')
         return db_worker.execute(db_worker.query_log, self.category, start, end_)
 
+    def iter_log(self, start, end_=None, chunk=LOG_CHUNK):
+        """ The log entries, (id, severity, stamp, message) in the order they were written,
+            read chunk at a time
+        """
+        after = 0
+        while True:
+            self.count_op('query_log')
+            rows = db_worker.execute(db_worker.query_log_page, self.category, start, end_, after, chunk, False)
+            yield from rows
+            if len(rows) < chunk:
+                return
+            after = rows[-1][0]
+
+    def query_log_tail(self, start, end_=None, limit=100):
+        """ The last limit log entries, like iter_log """
+        self.count_op('query_log')
+        rows = db_worker.execute(db_worker.query_log_page, self.category, start, end_, 0, limit, True)
+        return rows[::-1]
+
+    def query_log_summary(self, start, end_=None, top=10):
+        """ ({severity: number of entries}, the top most frequent warnings and errors
+            as [(message, severity, count, last stamp)])
+        """
+        self.count_op('query_log_summary')
+        return db_worker.execute(db_worker.query_log_summary, self.category, start, end_, top)
+
     def save_order(self, order):
         """ Save the order to the database
         """
+        self.count_op('save_order')
         order_id = order['id']
         db_worker.save_order(self.category, order_id, order)
 
     def remove_order(self, order):
         """ Removes an order from the database
         """
+        self.count_op('remove_order')
         order_id = order['id']
         db_worker.remove_order(self.category, order_id)
 
     def clear_orders(self):
         """ Removes all worker's orders from the database
         """
+        self.count_op('clear_orders')
         db_worker.clear_orders(self.category)
 
     def fetch_orders(self, worker=None):
         """ Get all the orders (or just specific worker's orders) from the database
         """
+        self.count_op('fetch_orders')
         if not worker:
             worker = self.category
         return db_worker.fetch_orders(worker)
@@ -140,16 +318,29 @@ class DatabaseWorker(threading.Thread):
     """ Thread safe database worker
     """
 
-    def __init__(self):
+    def __init__(self, path=None):
+        """ path: the sqlite file, by default dexbot.sqlite in the user data directory """
         super().__init__()
 
         # Obtain engine and session
-        engine = create_engine('sqlite:///%s' % sqlDataBaseFile, echo=False)
+        engine = self.engine = create_engine('sqlite:///%s' % (path or sqlDataBaseFile), echo=False)
         Session = sessionmaker(bind=engine)
         self.session = Session()
-        Base.metadata.create_all(engine)
+        with engine.connect() as conn:
+            # only takes for a new file, older ones are switched by a VACUUM
+            conn.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+            Base.metadata.create_all(conn)
+            # the indexes of tables made before they were added
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+            self.incremental_vacuum = conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2
         self.session.commit()
 
+        self.retention = dict(RETENTION)
+        self.compacted = 0
+        self.compacting = False
+
         self.task_queue = queue.Queue()
         self.results = {}
         self.lock = threading.Lock()
@@ -158,10 +349,28 @@ class DatabaseWorker(threading.Thread):
         self.start()
 
     def run(self):
-        for func, args, token in iter(self.task_queue.get, None):
+        while True:
+            try:
+                task = self.task_queue.get(timeout=COMPACT_IDLE)
+            except queue.Empty:
+                self._idle()
+                continue
+            if task is None:
+                break
+            func, args, token = task
             if token is not None:
                 args = args + (token,)
-            func(*args)
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Database task {}".format(getattr(func, '__name__', func)))
+                self.session.rollback()
+        self.session.close()
+
+    def stop(self):
+        """ Finish the queued tasks and end the thread """
+        self.task_queue.put(None)
+        self.join()
 
     def _get_result(self, token):
         while True:
@@ -180,7 +389,7 @@ class DatabaseWorker(threading.Thread):
             self.event.set()
 
     def execute(self, func, *args):
-        token = str(uuid.uuid4)
+        token = str(uuid.uuid4())
         self.task_queue.put((func, args, token))
         return self._get_result(token)
 
@@ -265,6 +474,8 @@ class DatabaseWorker(threading.Thread):
             e = Journal(key=key, category=category, amount=amount, stamp=now_t)
             self.session.add(e)
         self.session.commit()
+        # keep the buckets up to date, unless compaction is still catching up
+        self._roll_up(ROLLUP_ON_WRITE)
 
     def query_journal(self, category, start, end_, token):
         """Query this bots journal
@@ -272,19 +483,39 @@ class DatabaseWorker(threading.Thread):
         end_: datetime of end (None means up to now)
         """
         r = self.session.query(Journal).filter(Journal.category == category)
-        if isinstance(start, str):
-            m = re.match("(\\d+)([dw])", start)
-            if m:
-                n = int(m.group(1))
-                start = datetime.datetime.now()
-                if m.group(2) == 'w':
-                    n *= 7
-                start -= datetime.timedelta(days=n)
+        start = parse_start(start)
         if end_:
             r = r.filter(Journal.stamp > start, Journal.stamp < end_)
         else:
             r = r.filter(Journal.stamp > start)
-        self.set_result(token, r.all())
+        self._set_result(token, r.all())
+
+    def query_journal_buckets(self, category, start, end_, resolution, value, token):
+        """ [(stamp, key, value)] of the journal's buckets (or raw entries) in time order """
+        start = parse_start(start)
+        if resolution == 'auto':
+            resolution = pick_resolution(start, end_, self.retention)
+        if resolution == 'raw':
+            r = self.session.query(Journal.stamp, Journal.key, Journal.amount).filter(
+                Journal.category == category, Journal.stamp > start)
+            if end_:
+                r = r.filter(Journal.stamp < end_)
+            self._set_result(token, [tuple(row) for row in r.order_by(Journal.stamp)])
+            return
+        column = (JournalBucket.sum / JournalBucket.count) if value == 'mean' else getattr(JournalBucket, value)
+        # a bucket is in the range if its start is: the first one may have begun before start
+        r = self.session.query(JournalBucket.start, JournalBucket.key, column).filter(
+            JournalBucket.category == category, JournalBucket.resolution == resolution,
+            JournalBucket.start >= BUCKET_STARTS[resolution](start))
+        if end_:
+            r = r.filter(JournalBucket.start < end_)
+        self._set_result(token, [tuple(row) for row in r.order_by(JournalBucket.start)])
+
+    def journal_high_water(self, category, token):
+        rolled_up = self._get_state('journal_rolled_up', 0)
+        r = self.session.query(sqlalchemy.func.max(Journal.id)).filter(
+            Journal.category == category, Journal.id <= rolled_up)
+        self._set_result(token, r.scalar() or 0)
 
     def save_log(self, category, severity, message, created, token=None):
         e = Log(
@@ -295,26 +526,167 @@ class DatabaseWorker(threading.Thread):
         self.session.add(e)
         self.session.commit()
 
+    def save_logs(self, rows, token=None):
+        """ Insert many log rows (dicts of the Log columns) with one commit """
+        if rows:
+            self.session.bulk_insert_mappings(Log, rows)
+            self.session.commit()
+
     def query_log(self, category, start, end_, token):
         """Query this bots log
         start: datetime of start time
         end_: datetime of end (None means up to now)
         """
         r = self.session.query(Log).filter(Log.category == category)
-        if isinstance(start, str):
-            m = re.match("(\\d+)([dw])", start)
-            if m:
-                n = int(m.group(1))
-                start = datetime.datetime.now()
-                if m.group(2) == 'w':
-                    n *= 7
-                start -= datetime.timedelta(days=n)
+        start = parse_start(start)
         if end_:
             r = r.filter(Log.stamp > start, Log.stamp < end_)
         else:
             r = r.filter(Log.stamp > start)
         r = r.order_by(Log.stamp)
-        self.set_result(token, r.all())
+        self._set_result(token, r.all())
+
+    def _log_range(self, query, category, start, end_):
+        query = query.filter(Log.category == category, Log.stamp > parse_start(start))
+        if end_:
+            query = query.filter(Log.stamp < end_)
+        return query
+
+    def query_log_page(self, category, start, end_, after, limit, newest, token):
+        """ limit log rows after the id after, the first or (newest) the last ones """
+        r = self._log_range(self.session.query(Log.id, Log.severity, Log.stamp, Log.message),
+                            category, start, end_)
+        if after:
+            r = r.filter(Log.id > after)
+        r = r.order_by(Log.id.desc() if newest else Log.id).limit(limit)
+        self._set_result(token, [tuple(row) for row in r])
+
+    def query_log_summary(self, category, start, end_, top, token):
+        count = sqlalchemy.func.count(Log.id)
+        counts = self._log_range(self.session.query(Log.severity, count), category, start, end_)
+        counts = dict(counts.group_by(Log.severity).all())
+        errors = self._log_range(
+            self.session.query(Log.message, sqlalchemy.func.max(Log.severity), count, sqlalchemy.func.max(Log.stamp)),
+            category, start, end_).filter(Log.severity >= MAP_LEVELS[logging.WARN])
+        errors = errors.group_by(Log.message).order_by(count.desc()).limit(top)
+        self._set_result(token, (counts, [tuple(row) for row in errors]))
+
+    # Retention
+    def set_retention(self, **retention):
+        """ Change how long rows are kept, see RETENTION """
+        unknown = set(retention) - set(RETENTION)
+        if unknown:
+            raise ValueError("Unknown retention settings: {}".format(', '.join(sorted(unknown))))
+        self.execute_noreturn(self.retention.update, retention)
+
+    def compact(self):
+        """ Do all the compaction due now, and return when it's done """
+        self.execute(self._compact_all)
+
+    def _compact_all(self, token):
+        while self._compact_step():
+            pass
+        self._set_result(token, None)
+
+    def _idle(self):
+        now = time.time()
+        if self.compacting or now - self.compacted >= COMPACT_INTERVAL:
+            self.compacted = now
+            try:
+                self.compacting = self._compact_step()
+            except Exception:
+                log.exception("Database compaction")
+                self.session.rollback()
+                self.compacting = False
+
+    def _compact_step(self):
+        """ Roll up, prune and vacuum a chunk, returns True if there's more to do """
+        more = self._roll_up(COMPACT_CHUNK) == COMPACT_CHUNK
+        now = datetime.datetime.now()
+        rolled_up = self._get_state('journal_rolled_up', 0)
+        deleted = 0
+        for table, days, condition in (
+                (Journal, 'journal_days', Journal.id <= rolled_up),
+                (JournalBucket, 'hourly_days', JournalBucket.resolution == 'hour'),
+                (JournalBucket, 'daily_days', JournalBucket.resolution == 'day'),
+                (Log, 'log_days', None)):
+            if self.retention[days] is None:
+                continue
+            cutoff = now - datetime.timedelta(days=self.retention[days])
+            stamp = table.start if table is JournalBucket else table.stamp
+            ids = self.session.query(table.id).filter(stamp < cutoff)
+            if condition is not None:
+                ids = ids.filter(condition)
+            ids = [row.id for row in ids.limit(COMPACT_CHUNK)]
+            if ids:
+                self.session.query(table).filter(table.id.in_(ids)).delete(synchronize_session=False)
+                deleted += len(ids)
+                more = more or len(ids) == COMPACT_CHUNK
+        self.session.commit()
+        if deleted:
+            self._vacuum()
+        return more
+
+    def _roll_up(self, limit):
+        """ Add up to limit journal rows not rolled up yet into the buckets, returns how many """
+        rolled_up = self._get_state('journal_rolled_up', 0)
+        rows = self.session.query(Journal).filter(Journal.id > rolled_up).order_by(Journal.id).limit(limit).all()
+        if not rows:
+            return 0
+        count, last_id = len(rows), rows[-1].id
+        rows = [row for row in rows if row.amount is not None and row.stamp is not None]
+        # the buckets these rows go into that exist already, in one query
+        buckets = {}
+        if rows:
+            existing = self.session.query(JournalBucket).filter(
+                JournalBucket.category.in_({row.category for row in rows}),
+                JournalBucket.start >= BUCKET_STARTS['day'](min(row.stamp for row in rows)),
+                JournalBucket.start <= max(row.stamp for row in rows))
+            buckets = {(b.category, b.resolution, b.start, b.key): b for b in existing}
+        for row in rows:
+            amount = float(row.amount)
+            for resolution, bucket_start in BUCKET_STARTS.items():
+                key = (row.category, resolution, bucket_start(row.stamp), row.key)
+                bucket = buckets.get(key)
+                if bucket is None:
+                    bucket = buckets[key] = JournalBucket(
+                        category=key[0], resolution=key[1], start=key[2], key=key[3],
+                        count=0, sum=0.0, min=amount, max=amount, first=amount)
+                    self.session.add(bucket)
+                bucket.count += 1
+                bucket.sum += amount
+                bucket.min = min(bucket.min, amount)
+                bucket.max = max(bucket.max, amount)
+                bucket.last = amount
+        self._set_state('journal_rolled_up', last_id)
+        self.session.commit()
+        return count
+
+    def _vacuum(self):
+        """ Give the free pages back, and VACUUM once in a while """
+        now = time.time()
+        if not self.incremental_vacuum or now - self._get_state('vacuumed', 0) >= VACUUM_INTERVAL:
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+                conn.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.exec_driver_sql('VACUUM')
+                self.incremental_vacuum = conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2
+            self._set_state('vacuumed', now)
+            self.session.commit()
+        else:
+            with self.engine.connect() as conn:
+                conn.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql('PRAGMA incremental_vacuum')
+
+    def _get_state(self, key, default=None):
+        e = self.session.query(Config).filter_by(category=STORAGE_CATEGORY, key=key).first()
+        return json.loads(e.value) if e else default
+
+    def _set_state(self, key, value):
+        e = self.session.query(Config).filter_by(category=STORAGE_CATEGORY, key=key).first()
+        if e:
+            e.value = json.dumps(value)
+        else:
+            self.session.add(Config(STORAGE_CATEGORY, key, json.dumps(value)))
 
     def save_order(self, worker, order_id, order):
         self.execute_noreturn(self._save_order, worker, order_id, order)
@@ -369,6 +741,12 @@ class DatabaseWorker(threading.Thread):
         self._set_result(token, result)
 
 
+# Log records written to the database in one go, and how often the buffer is written anyway
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 5.0  # seconds
+# Records waiting for the database before debug and info ones are dropped
+LOG_MAX_PENDING = 10000
+
 MAP_LEVELS = {
     logging.DEBUG: 0,
     logging.INFO: 1,
@@ -382,25 +760,113 @@ class SQLiteHandler(logging.Handler):
     """
     Logging handler for SQLite.
     Based on Vinay Sajip's DBHandler class (http://www.red-dove.com/python_logging.html)
+
+    Records are kept in a buffer and written in one insert when batch_size
+    of them have come or every flush_interval seconds, so logging doesn't
+    load the database thread with a commit per line.
+
+    At most max_pending records wait for the database (in the buffer or
+    queued). Over that, debug and info records are dropped, or with
+    policy='sample' one in sample_rate is kept; warnings and errors are
+    always kept. How many were dropped is logged with the next batch.
     """
     # used by email Reporter (but has to be here so it can access db_worker)
 
+    def __init__(self, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL,
+                 max_pending=LOG_MAX_PENDING, policy='drop', sample_rate=10):
+        super().__init__()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.buffer = []
+        # records handed to the database thread and not written yet
+        self.pending = 0
+        self.dropped = collections.Counter()
+        self.seen = 0
+        # not the Handler's lock: logging.shutdown() holds that while calling close()
+        self.buffer_lock = threading.Lock()
+        self.closing = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name='dexbot-log-flush', daemon=True)
+        self.flusher.start()
+
     def emit(self, record):
         # Use default formatting:
         self.format(record)
         level = MAP_LEVELS.get(record.levelno, 0)
-        notes = record.msg
+        category = getattr(record, 'worker_name', None) or getattr(record, 'botname', 'N/A')
+        if record.levelno < logging.WARNING and self._overloaded():
+            with self.buffer_lock:
+                self.dropped[category] += 1
+            metrics.registry.inc('log_records_dropped', worker=category)
+            return
+        notes = record.getMessage()
         if record.exc_info:
             notes += " " + \
                 logging._defaultFormatter.formatException(record.exc_info)
-        # Insert log record:
-        db_worker.execute_noreturn(
-            db_worker.save_log,
-            record.botname,
-            level,
-            notes,
-            datetime.datetime.fromtimestamp(
-                record.created))
+        row = {'category': category, 'severity': level, 'message': notes,
+               'stamp': datetime.datetime.fromtimestamp(record.created)}
+        with self.buffer_lock:
+            self.buffer.append(row)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def _overloaded(self):
+        if self.pending + len(self.buffer) < self.max_pending:
+            return False
+        if self.policy == 'sample':
+            self.seen += 1
+            return self.seen % self.sample_rate != 0
+        return True
+
+    def flush(self, wait=False):
+        """ Hand the buffered records to the database thread
+
+            wait: return once they are written
+        """
+        with self.buffer_lock:
+            rows, self.buffer = self.buffer, []
+            dropped, self.dropped = self.dropped, collections.Counter()
+            self.pending += len(rows)
+        # what _write takes off pending: the notices below weren't counted in it
+        written = len(rows)
+        now = datetime.datetime.now()
+        for category, dropped_count in dropped.items():
+            rows.append({'category': category, 'severity': MAP_LEVELS[logging.WARN], 'stamp': now,
+                         'message': "{} log records dropped, the database was too busy".format(dropped_count)})
+        if not rows and not wait:
+            return
+        if wait:
+            db_worker.execute(self._write, rows, written)
+        else:
+            db_worker.execute_noreturn(self._write, rows, written)
+
+    def _write(self, rows, count, token=None):
+        # on the database thread
+        try:
+            db_worker.save_logs(rows)
+        finally:
+            with self.buffer_lock:
+                self.pending -= count
+            if token is not None:
+                db_worker._set_result(token, None)
+
+    def _flush_loop(self):
+        while not self.closing.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Cannot write the log records to the database")
+
+    def close(self):
+        self.closing.set()
+        try:
+            if db_worker.is_alive():
+                self.flush(wait=True)
+        finally:
+            super().close()
 
 
 # Derive sqlite file directory
@@ -1,4 +1,5 @@
 import math
+from bisect import bisect_right
 from datetime import datetime
 from datetime import timedelta
 
@@ -8,6 +9,9 @@ from dexbot.basestrategy import BaseStrategy, ConfigElement
 from dexbot.errors import EmptyMarket
 from dexbot.qt_queue.idle_queue import idle_add
 
+# Order prices within 0.1% are treated as equal, as slight errors creep in due to rounding
+PRICE_TOLERANCE = 0.001
+
 
 class Strategy(BaseStrategy):
     """ Ataxia strategy, based on Staggered Orders
@@ -75,12 +79,17 @@ class Strategy(BaseStrategy):
                 return True
         return False
 
-    def check_at_price(self, price):
-        """True if no order in self.orderlist at this price"""
-        for o in self.orders:
-            if abs(o['price']-price)/price < 0.001:  # "within 0.1% means equal" as slight errors creep in due to rounding
-                return False
-        return True
+    def price_index(self):
+        """Sorted prices of our open orders, a snapshot for check_at_price()"""
+        return sorted(o['price'] for o in self.orders)
+
+    def check_at_price(self, price, index=None):
+        """True if no order in the price index at this price
+        (the index is fetched if not supplied)"""
+        if index is None:
+            index = self.price_index()
+        i = bisect_right(index, price * (1 - PRICE_TOLERANCE))
+        return i == len(index) or index[i] >= price * (1 + PRICE_TOLERANCE)
 
     def ladder(self):
         """Create the static ladder
@@ -149,14 +158,15 @@ class Strategy(BaseStrategy):
         total_orders = 0
         while new_order:
             new_order = False
-            self.account.refresh()
+            # one snapshot of our orders per pass (this refreshes the account)
+            index = self.price_index()
             highest_buy, lowest_sell = Strategy.spread_zone(self.spread, self.market)
             self.log.debug("highest_buy = {} lowest_sell = {}".format(highest_buy, lowest_sell))
             # do max one order on each side, then cycle outer loop (i.e. check back
             # with market whether things have shifted)
             for price, size in downladder:
                 if price > lowest_sell:
-                    if self.check_at_price(1/price):  # sell orders are inverted
+                    if self.check_at_price(1/price, index):  # sell orders are inverted
                         if float(self.balance(self.market['quote'])) > size:
                             new_order = True
                             total_orders += 1
@@ -168,7 +178,7 @@ class Strategy(BaseStrategy):
                     break
             for price, size in upladder:
                 if price < highest_buy:
-                    if self.check_at_price(price):
+                    if self.check_at_price(price, index):
                         if float(self.balance(self.market['base'])) > size*price:
                             new_order = True
                             total_orders += 1
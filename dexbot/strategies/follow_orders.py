@@ -4,7 +4,6 @@ from collections import Counter
 from bitshares.amount import Amount
 from bitshares.price import Price, Order, FilledOrder
 from dexbot.basestrategy import BaseStrategy, ConfigElement
-import time
 
 
 class Strategy(BaseStrategy):
@@ -91,8 +90,17 @@ class Strategy(BaseStrategy):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # States: 'idle' our orders are in place, 'filled' one of them has been
+        # (partly) filled, 'settling' orders have just been replaced and may
+        # have been filled while we were busy. The last two are dealt with
+        # on the next block, so at most one reassess happens per block however
+        # fast the market moves.
+        for state in ('idle', 'filled', 'settling'):
+            self.add_state(state)
+        self.set_state('idle')
         # Define Callbacks
         self.onMarketUpdate += self.onmarket
+        self.ontick += self.tick
         if self.worker.get("reset", False):
             self.cancel_all()
         self.reassess()
@@ -184,23 +192,30 @@ class Strategy(BaseStrategy):
         if isinstance(
                 data, FilledOrder) and data['account_id'] == self.account['id']:
             self.log.info("I sold {} for {}".format(data['quote'],data['base']))
-            self.reassess(data)
+            # the orders are reassessed on the next block
+            self.set_state('filled')
+
+    def tick(self, block):
+        if self.get_state() in ('filled', 'settling'):
+            self.reassess()
 
     def reassess(self, market_data=None):
+        """Check our orders once, replacing them if needed
+        """
         # sadly no smart way to match a FilledOrder to an existing order
         # even price-matching won't work as we can buy at a better price than we asked for
         # so look at what's missing
         self.log.debug("reassessing...")
         self.account.refresh()
         newprice = self.recalculate_price(market_data)
-        if newprice is not None:
-            if self.updateorders(newprice):
-                time.sleep(1)
-                # check if order has been filled while we were busy entering
-                # orders
-                self.reassess(None)
+        if newprice is not None and self.updateorders(newprice):
+            # check on the next block if an order has been filled while we were
+            # busy entering orders
+            self.set_state('settling')
         else:
-            self.log.info("Orders unchanged")
+            if newprice is None:
+                self.log.info("Orders unchanged")
+            self.set_state('idle')
 
     def recalculate_price(self, market_data=None):
         """Recalculate the base price according to the worker's rules
@@ -56,6 +56,20 @@ class Strategy(BaseStrategy):
         (so can be compared)"""
         return [MyOrder(o['quote']['amount'], o['quote']['asset']['symbol'], o['base']['amount'], o['base']['asset']['symbol']) for o in orders]
 
+    @staticmethod
+    def exclude_orders(orders, excluded):
+        """Return orders without excluded (both lists of MyOrder)
+        each excluded order removes one equal order, like list.remove() would,
+        but in linear time"""
+        counts = Counter(excluded)
+        result = []
+        for o in orders:
+            if counts[o] > 0:
+                counts[o] -= 1
+            else:
+                result.append(o)
+        return result
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Define Callbacks
@@ -85,12 +99,7 @@ class Strategy(BaseStrategy):
             self.market['quote']) * self.worker['wall_percent'] / 100.0
         sell_price = newprice + step1
 
-        bids = self.convert_orders(bids)
-        for o in my_orders:
-            try:
-                bids.remove(o)
-            except ValueError:
-                pass
+        bids = self.exclude_orders(self.convert_orders(bids), my_orders)
 
         bid_price = (bids[0].quote / bids[0].base) * ((100 + self.worker['diff'])/100.0)
 
@@ -106,12 +115,7 @@ class Strategy(BaseStrategy):
             self.market['quote'])
         buy_price = newprice - step1
 
-        asks = self.convert_orders(asks)
-        for o in my_orders:
-            try:
-                asks.remove(o)
-            except ValueError:
-                pass
+        asks = self.exclude_orders(self.convert_orders(asks), my_orders)
 
         ask_price = (asks[0].base / asks[0].quote) * ((100 - self.worker['diff'])/100.0)
 
@@ -0,0 +1,186 @@
+"""
+Parameter sweeps: backtest a worker over many combinations of its settings
+
+The values to try come from the strategy's ``configure()``: each swept
+parameter is given as
+
+``key``
+    use the (min, max) bounds of the ConfigElement (bools try both values,
+    choices try every choice). Most settings have no maximum: they are swept
+    from the minimum to twice the worker's current value (or the default)
+``key=lo:hi``
+    a range of its own
+``key=a,b,c``
+    a list of values
+
+Numeric ranges are split into ``steps`` values for a grid, or sampled
+uniformly for a random search. Backtests run in a process pool, each
+process with a database of its own (not the user's dexbot.sqlite), and each
+result is appended to a CSV file (one column per parameter and per result
+field) as soon as it is in, so an interrupted sweep keeps what it has done.
+CSV rather than a columnar format: it can be appended to a row at a time,
+and read without pyarrow or the like.
+"""
+
+import csv
+import copy
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import tempfile
+
+from dexbot import storage
+from dexbot.backtest.runner import Backtest
+
+log = logging.getLogger(__name__)
+
+RESULT_FIELDS = ['profit', 'end_quote', 'end_base', 'final_price', 'fills', 'orders_placed', 'disabled', 'elapsed']
+
+
+class SweepError(ValueError):
+    pass
+
+
+def config_elements(module):
+    """ The ConfigElements of a strategy module, by key """
+    strategy_class = getattr(importlib.import_module(module), 'Strategy')
+    return {elem.key: elem for elem in strategy_class.configure()}
+
+
+def convert(elem, value):
+    if elem.type == 'int':
+        return int(value)
+    if elem.type == 'float':
+        return float(value)
+    if elem.type == 'bool':
+        return value.lower() in ('1', 'yes', 'true', 'on') if isinstance(value, str) else bool(value)
+    return value
+
+
+def parse_spec(spec, elements, worker=None):
+    """ Parse a parameter spec (see module docs)
+        worker: the worker's config, for the current values of unbounded settings
+        Returns (key, list of values) or (key, (lo, hi)) for numeric ranges
+    """
+    key, _, values = spec.partition('=')
+    key = key.strip()
+    if key not in elements:
+        raise SweepError("{} is not a parameter of this strategy".format(key))
+    elem = elements[key]
+    if values:
+        if ':' in values:
+            lo, hi = values.split(':')
+            return key, (convert(elem, lo), convert(elem, hi))
+        return key, [convert(elem, v) for v in values.split(',')]
+    if elem.type == 'bool':
+        return key, [False, True]
+    if elem.type == 'choice':
+        return key, [tag for tag, label in elem.extra]
+    if elem.type in ('int', 'float'):
+        lo, hi = (elem.extra[0], elem.extra[1]) if elem.extra else (0, None)
+        if hi is None:
+            hi = 2 * convert(elem, (worker or {}).get(key, elem.default))
+        if hi <= lo:
+            raise SweepError("{} has no usable upper bound, give a range with {}=lo:hi".format(key, key))
+        return key, (lo, hi)
+    raise SweepError("can't sweep {} parameter {}".format(elem.type, key))
+
+
+def grid_values(elem, lo, hi, steps):
+    if steps < 2:
+        return [convert(elem, lo)]
+    values = [lo + (hi - lo) * i / (steps - 1) for i in range(steps)]
+    if elem.type == 'int':
+        return sorted(set(int(round(v)) for v in values))
+    return values
+
+
+def grid(ranges, elements, steps):
+    """ Every combination, numeric ranges split into steps values """
+    keys = list(ranges)
+    axes = []
+    for key in keys:
+        values = ranges[key]
+        if isinstance(values, tuple):
+            values = grid_values(elements[key], values[0], values[1], steps)
+        axes.append(values)
+    for combination in itertools.product(*axes):
+        yield dict(zip(keys, combination))
+
+
+def random_samples(ranges, elements, samples, seed=None):
+    """ samples random combinations, numeric ranges sampled uniformly """
+    rng = random.Random(seed)
+    for i in range(samples):
+        params = {}
+        for key, values in ranges.items():
+            if isinstance(values, tuple):
+                if elements[key].type == 'int':
+                    params[key] = rng.randint(values[0], values[1])
+                else:
+                    params[key] = rng.uniform(values[0], values[1])
+            else:
+                params[key] = rng.choice(values)
+        yield params
+
+
+def init_process(directory):
+    """ Pool initializer: the process's database is a file in directory """
+    if storage.db_worker.is_alive():
+        storage.db_worker.stop()
+    storage.db_worker = storage.DatabaseWorker(os.path.join(directory, 'sweep-{}.sqlite'.format(os.getpid())))
+
+
+def run_one(job):
+    """ Run one backtest in a pool process, returns (params, result dict or None, error) """
+    config, worker_name, feeds, params, options = job
+    config = copy.deepcopy(config)
+    config['workers'][worker_name].update(params)
+    try:
+        result = Backtest(config, worker_name, feeds, **options).run()
+        return params, result.as_dict(), None
+    except Exception as e:
+        return params, None, "{}: {}".format(type(e).__name__, e)
+
+
+def sweep(config, worker_name, feeds, combinations, output, processes=None, **options):
+    """ Backtest every combination of parameters, writing results to the output CSV
+        options are passed to Backtest (quote, base, fee...)
+        Returns the list of (params, result) that succeeded
+    """
+    combinations = list(combinations)
+    if not combinations:
+        return []
+    keys = list(combinations[0])
+    config = {'workers': {worker_name: dict(config['workers'][worker_name])}}
+    jobs = [(config, worker_name, feeds, params, options) for params in combinations]
+    results = []
+    with tempfile.TemporaryDirectory() as directory, open(output, 'w', newline='') as fd, \
+            multiprocessing.Pool(processes, init_process, (directory,)) as pool:
+        writer = csv.writer(fd)
+        writer.writerow(keys + RESULT_FIELDS + ['error'])
+        for n, (params, result, error) in enumerate(pool.imap_unordered(run_one, jobs), 1):
+            row = [params[k] for k in keys]
+            if result is None:
+                log.warning("{} failed: {}".format(params, error))
+                row += [''] * len(RESULT_FIELDS) + [error]
+            else:
+                results.append((params, result))
+                row += [result[f] for f in RESULT_FIELDS] + ['']
+            writer.writerow(row)
+            fd.flush()
+            log.info("{}/{} backtests done".format(n, len(jobs)))
+    return results
+
+
+def rank(results, key='profit', top=10, disabled=False):
+    """ The best top results, by key (highest first)
+        Runs where the strategy disabled itself are left out unless disabled is True:
+        a worker that stopped early can look good by having done nothing
+    """
+    if not disabled:
+        results = [r for r in results if not r[1]['disabled']]
+    return sorted(results, key=lambda r: r[1][key], reverse=True)[:top]
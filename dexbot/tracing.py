@@ -0,0 +1,175 @@
+"""
+Trace the calls made to the node
+
+With tracing on (``dexbot-cli run --trace-rpc``) every call to the node is
+recorded: the API method, a digest of its arguments, how long it took,
+the worker whose handler made it and the strategy method that made it.
+The last calls are kept in memory (the chat command ``rpc`` sums them up)
+and with ``--trace-file`` they are all appended to a file, one JSON object
+per line::
+
+    {"time": 1718000000.1, "method": "get_full_accounts", "api": 0,
+     "digest": "5f2c0a9e31d4", "seconds": 0.012, "worker": "worker1",
+     "caller": "dexbot.strategies.relative_orders:check_orders", "error": null}
+
+``dexbot-cli trace FILE`` shows which workers and strategy methods make the
+most calls. Calls with the same method and digest had the same arguments,
+so many of them for one caller in a block are a sign something could be
+cached.
+"""
+
+import collections
+import hashlib
+import json
+import sys
+import threading
+import time
+
+from dexbot import metrics
+from dexbot.profiler import frame_name
+
+BUFFER_SIZE = 10000
+DIGEST_LENGTH = 12
+
+# The Tracer recording the calls, None when tracing is off
+tracer = None
+
+
+def digest(args):
+    """ A short hash of an RPC call's arguments """
+    text = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:DIGEST_LENGTH]
+
+
+def strategy_caller(frame):
+    """ 'module:method' of the innermost strategy method on the stack, None if there isn't one """
+    from dexbot.basestrategy import BaseStrategy
+
+    while frame is not None:
+        code = frame.f_code
+        if code.co_argcount and code.co_varnames[0] == 'self':
+            this = frame.f_locals.get('self')
+            if isinstance(this, BaseStrategy):
+                return frame_name(frame)
+        frame = frame.f_back
+    return None
+
+
+class Tracer:
+    """ Keeps the last buffer_size calls, and writes them all to path if given """
+
+    def __init__(self, buffer_size=BUFFER_SIZE, path=None):
+        self.calls = collections.deque(maxlen=buffer_size)
+        self.path = path
+        self.file = open(path, 'a', buffering=1) if path else None
+        self.lock = threading.Lock()
+
+    def record(self, call):
+        with self.lock:
+            self.calls.append(call)
+            if self.file:
+                self.file.write(json.dumps(call) + '\n')
+
+    def recent(self, worker_name=None):
+        with self.lock:
+            calls = list(self.calls)
+        if worker_name is not None:
+            calls = [call for call in calls if call['worker'] == worker_name]
+        return calls
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+def enable(buffer_size=BUFFER_SIZE, path=None):
+    """ Start tracing, returns the Tracer """
+    global tracer
+    disable()
+    tracer = Tracer(buffer_size, path)
+    return tracer
+
+
+def disable():
+    global tracer
+    if tracer is not None:
+        tracer.close()
+        tracer = None
+
+
+def instrument_rpc(rpc):
+    """ Trace the calls made through a python-bitshares RPC connection, while tracing is on """
+    # vars(): the RPC classes answer any attribute with an API call
+    if rpc is None or vars(rpc).get('tracing_instrumented'):
+        return
+    rpcexec = rpc.rpcexec
+
+    def traced_rpcexec(payload):
+        current = tracer
+        if current is None:
+            return rpcexec(payload)
+        params = payload.get('params') or [None, payload.get('method'), []]
+        call = {
+            'time': time.time(),
+            'method': params[1] if len(params) > 1 else payload.get('method'),
+            'api': params[0],
+            'digest': digest(params[2:]),
+            'worker': metrics.registry.current_worker,
+            'caller': strategy_caller(sys._getframe(1)),
+            'error': None
+        }
+        started = time.perf_counter()
+        try:
+            return rpcexec(payload)
+        except Exception as e:
+            call['error'] = type(e).__name__
+            raise
+        finally:
+            call['seconds'] = time.perf_counter() - started
+            current.record(call)
+
+    rpc.rpcexec = traced_rpcexec
+    rpc.tracing_instrumented = True
+
+
+def load(path):
+    """ The calls in a trace file """
+    with open(path) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+
+def summarize(calls, by=('worker', 'caller', 'method')):
+    """ Calls grouped by the keys in by, the busiest first
+
+        Returns a list of dicts with the keys' values and count, seconds (total),
+        errors and repeats (calls with the same method and arguments as an
+        earlier one in the group)
+    """
+    groups = {}
+    for call in calls:
+        key = tuple(call.get(k) for k in by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = dict(zip(by, key), count=0, seconds=0.0, errors=0, seen=set())
+        group['count'] += 1
+        group['seconds'] += call.get('seconds', 0.0)
+        group['errors'] += call.get('error') is not None
+        group['seen'].add((call.get('method'), call.get('digest')))
+    rows = []
+    for group in groups.values():
+        group['repeats'] = group['count'] - len(group.pop('seen'))
+        rows.append(group)
+    rows.sort(key=lambda row: (row['count'], row['seconds']), reverse=True)
+    return rows
+
+
+def format_rows(rows, by=('worker', 'caller', 'method')):
+    """ Lines of a table of summarize()'s rows, for people """
+    lines = []
+    for row in rows:
+        name = ' '.join(str(row[k]) for k in by)
+        lines.append("{}: {} calls, {:.1f}ms total, {} repeated, {} failed".format(
+            name, row['count'], row['seconds'] * 1000, row['repeats'], row['errors']))
+    return lines
@@ -31,6 +31,12 @@ class WorkerItemWidget(QtWidgets.QWidget, Ui_widget):
 
         self.setup_ui_data(config)
 
+    def event(self, event):
+        if event.type() == QtCore.QEvent.ToolTip and self.running:
+            # the metrics are only looked at when the user hovers
+            self.setToolTip('\n'.join(self.main_ctrl.worker_metrics(self.worker_name)))
+        return super().event(event)
+
     def setup_ui_data(self, config):
         worker_name = self.worker_name
         self.set_worker_name(worker_name)
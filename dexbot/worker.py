@@ -1,14 +1,22 @@
+import collections
 import importlib
 import sys
 import logging
 import os.path
 import threading
+import time
+import types
 import copy
 
 import dexbot.errors as errors
 import dexbot.report
+from dexbot import metrics
+from dexbot import storage
+from dexbot import tracing
 
 from dexbot.basestrategy import BaseStrategy
+from dexbot.coalesce import RequestCoalescer, account_key
+from dexbot.profiler import Profiler
 
 from bitshares import BitShares
 from bitshares.notify import Notify
@@ -21,6 +29,23 @@ STRATEGIES = [('dexbot.strategies.echo', "Echo Test"),
               ('dexbot.strategies.follow_orders', "Haywood's Follow Orders")]
 
 
+SNAPSHOT_INTERVAL = 15  # seconds between the workers' snapshots
+
+
+class WorkerSnapshot(collections.namedtuple('WorkerSnapshot', [
+        'worker_name', 'time', 'disabled', 'account', 'market', 'orders', 'balances',
+        'base_price', 'last_tick', 'errors', 'last_error'])):
+    """ How a worker was at time, taken on the bot's thread (see WorkerInfrastructure.snapshot)
+
+        orders: tuple of the open orders' descriptions
+        balances: read-only {symbol: amount} of the market's assets
+        base_price: the worker's 'price', None if it hasn't one
+        last_tick: when the worker last got a block, None if it hasn't yet
+        errors: how many of its event handlers have raised, last_error the last one's message
+    """
+    __slots__ = ()
+
+
 log = logging.getLogger(__name__)
 log_workers = logging.getLogger('dexbot.per_worker')
 # NOTE this is the  special logger for per-worker events
@@ -46,6 +71,27 @@ class WorkerInfrastructure(threading.Thread):
         self.notify = None
         self.config_lock = threading.RLock()
         self.workers = {}
+        # Shares identical RPC requests between workers
+        self.coalescer = RequestCoalescer()
+        # A dexbot.recording.Recorder, to record the notifications
+        self.recorder = None
+        # A dexbot.exporter.Exporter serving the metrics over HTTP
+        self.exporter = None
+        # Samples the handlers of the workers with profiling on
+        self.profiler = Profiler()
+        # Count RPC calls per worker, see dexbot.metrics
+        metrics.instrument_rpc(getattr(self.bitshares, 'rpc', None))
+        # Trace them when tracing is on, see dexbot.tracing
+        tracing.instrument_rpc(getattr(self.bitshares, 'rpc', None))
+        self.metrics_saved = 0
+        # worker name -> WorkerSnapshot, for the chat reporters and the GUI
+        self.snapshots = {}
+        self.snapshots_taken = 0
+        self.last_tick = {}
+        self.errors = collections.Counter()
+        self.last_error = {}
+        # How long the database keeps the journal and logs
+        storage.db_worker.set_retention(**(self.config.get('retention') or {}))
 
         self.accounts = set()
         self.markets = set()
@@ -58,6 +104,14 @@ class WorkerInfrastructure(threading.Thread):
     def init_workers(self, config):
         """ Initialize the workers
         """
+        self.init_reporters()
+
+        # set up workers
+        with self.config_lock:
+            for worker_name in config["workers"]:
+                self.init_worker(worker_name, config)
+
+    def init_reporters(self):
         # set up reporting
         self.reporters = []
         for reporter_params in self.config.get("reports", []):
@@ -73,40 +127,42 @@ class WorkerInfrastructure(threading.Thread):
             reporter_instance = reporter_class(**reporter_params)
             self.reporters.append(reporter_instance)
 
-        # set up workers
-        self.config_lock.acquire()
-        for worker_name, worker in config["workers"].items():
-            if "account" not in worker:
-                log_workers.critical("Worker has no account", extra={
-                    'worker_name': worker_name, 'account': 'unknown',
-                    'market': 'unknown', 'is_disabled': (lambda: True)
-                })
-                continue
-            if "market" not in worker:
-                log_workers.critical("Worker has no market", extra={
-                    'worker_name': worker_name, 'account': worker['account'],
-                    'market': 'unknown', 'is_disabled': (lambda: True)
-                })
-                continue
-            try:
-                strategy_class = getattr(
-                    importlib.import_module(worker["module"]),
-                    'Strategy'
-                )
-                self.workers[worker_name] = strategy_class(
-                    config=config,
-                    name=worker_name,
-                    bitshares_instance=self.bitshares,
-                    view=self.view
-                )
-                self.markets.add(worker['market'])
-                self.accounts.add(worker['account'])
-            except BaseException:
-                log_workers.exception("Worker initialisation", extra={
-                    'worker_name': worker_name, 'account': worker['account'],
-                    'market': 'unknown', 'is_disabled': (lambda: True)
-                })
-        self.config_lock.release()
+    def init_worker(self, worker_name, config):
+        """ Start one worker of config (call with config_lock held) """
+        worker = config["workers"][worker_name]
+        if "account" not in worker:
+            log_workers.critical("Worker has no account", extra={
+                'worker_name': worker_name, 'account': 'unknown',
+                'market': 'unknown', 'is_disabled': (lambda: True)
+            })
+            return
+        if "market" not in worker:
+            log_workers.critical("Worker has no market", extra={
+                'worker_name': worker_name, 'account': worker['account'],
+                'market': 'unknown', 'is_disabled': (lambda: True)
+            })
+            return
+        try:
+            strategy_class = getattr(
+                importlib.import_module(worker["module"]),
+                'Strategy'
+            )
+            self.workers[worker_name] = strategy_class(
+                config=config,
+                name=worker_name,
+                bitshares_instance=self.bitshares,
+                view=self.view,
+                coalescer=self.coalescer
+            )
+            self.markets.add(worker['market'])
+            self.accounts.add(worker['account'])
+            if worker.get('profile'):
+                self.profiler.enable(worker_name)
+        except BaseException:
+            log_workers.exception("Worker initialisation", extra={
+                'worker_name': worker_name, 'account': worker['account'],
+                'market': 'unknown', 'is_disabled': (lambda: True)
+            })
 
     def update_notify(self):
         if not self.config['workers']:
@@ -130,11 +186,112 @@ class WorkerInfrastructure(threading.Thread):
             )
 
     def shutdown(self):
+        log.debug("Request coalescing: {hits} hits, {misses} misses".format(**self.coalescer.stats()))
         for i in self.reporters:
             i.shutdown()
+        if self.recorder:
+            self.recorder.close()
+        self.save_metrics(force=True)
+        self.profiler.stop()
 
     # Events
     def on_block(self, data):
+        if self.recorder:
+            self.recorder.on_block(data)
+        self.coalescer.new_block()
+        self.run_jobs()
+        self.save_metrics()
+        self.profiler.maybe_flush()
+
+        with self.config_lock:
+            for reporter in self.reporters:
+                reporter.ontick()
+            for worker_name in self.block_targets():
+                self.last_tick[worker_name] = time.time()
+                self.dispatch(worker_name, 'ontick', data)
+        self.take_snapshots()
+        if self.exporter:
+            self.exporter.on_block()
+
+    def on_market(self, data):
+        if self.recorder:
+            self.recorder.on_market(data)
+        if data.get("deleted", False):  # No info available on deleted orders
+            return
+
+        self.coalescer.invalidate(('market', data.market))
+        with self.config_lock:
+            for worker_name in self.market_targets(data.market):
+                self.dispatch(worker_name, 'onMarketUpdate', data)
+
+    def on_account(self, account_update):
+        if self.recorder:
+            self.recorder.on_account(account_update)
+        with self.config_lock:
+            account = account_update.account
+            self.coalescer.invalidate(account_key(account['name']))
+            for worker_name in self.account_targets(account['name']):
+                self.dispatch(worker_name, 'onAccount', account_update)
+
+    def save_metrics(self, force=False):
+        """ Write the metrics snapshot for dexbot-cli metrics, at most every SNAPSHOT_INTERVAL """
+        now = time.time()
+        if not force and now - self.metrics_saved < metrics.SNAPSHOT_INTERVAL:
+            return
+        self.metrics_saved = now
+        try:
+            metrics.registry.save()
+        except OSError:
+            log.exception("Cannot save the metrics")
+
+    # Snapshots
+    def snapshot(self, worker_name):
+        """ The worker's last WorkerSnapshot, None if there isn't one yet
+            Safe from any thread, and doesn't wait for the node
+        """
+        return self.snapshots.get(worker_name)
+
+    def take_snapshots(self, force=False):
+        """ Replace the workers' snapshots, at most every SNAPSHOT_INTERVAL """
+        now = time.time()
+        if not force and now - self.snapshots_taken < SNAPSHOT_INTERVAL:
+            return
+        self.snapshots_taken = now
+        with self.config_lock:
+            workers = list(self.workers.items())
+        snapshots = {}
+        for worker_name, worker in workers:
+            try:
+                snapshots[worker_name] = self.take_snapshot(worker_name, worker)
+            except Exception:
+                log.warning("Cannot take a snapshot of {}".format(worker_name), exc_info=True)
+                if worker_name in self.snapshots:
+                    snapshots[worker_name] = self.snapshots[worker_name]
+        # one assignment: readers see all the old snapshots or all the new ones
+        self.snapshots = snapshots
+
+    def take_snapshot(self, worker_name, worker):
+        balances = {}
+        orders = ()
+        if not worker.disabled:
+            orders = tuple(str(order) for order in worker.orders)
+            for symbol in (worker.market['quote']['symbol'], worker.market['base']['symbol']):
+                balances[symbol] = float(worker.balance(symbol))
+        return WorkerSnapshot(
+            worker_name=worker_name,
+            time=time.time(),
+            disabled=bool(worker.disabled),
+            account=worker.worker['account'],
+            market=worker.worker['market'],
+            orders=orders,
+            balances=types.MappingProxyType(balances),
+            base_price=worker['price'] if 'price' in worker else None,
+            last_tick=self.last_tick.get(worker_name),
+            errors=self.errors[worker_name],
+            last_error=self.last_error.get(worker_name))
+
+    def run_jobs(self):
+        """ Run the callables queued by do_next_tick() """
         if self.jobs:
             try:
                 for job in self.jobs:
@@ -142,66 +299,119 @@ class WorkerInfrastructure(threading.Thread):
             finally:
                 self.jobs = []
 
-        self.config_lock.acquire()
-        for reporter in self.reporters:
-            reporter.ontick()
-        for worker_name, worker in self.config["workers"].items():
-            if worker_name not in self.workers or self.workers[worker_name].disabled:
-                continue
-            try:
-                self.workers[worker_name].ontick(data)
-            except Exception as e:
-                self.workers[worker_name].log.exception("in ontick()")
-                try:
-                    self.workers[worker_name].error_ontick(e)
-                except Exception:
-                    self.workers[worker_name].log.exception("in error_ontick()")
-        self.config_lock.release()
+    def block_targets(self):
+        """ Names of the running workers that get ontick (call with config_lock held) """
+        return [worker_name for worker_name in self.config["workers"]
+                if worker_name in self.workers and not self.workers[worker_name].disabled]
 
-    def on_market(self, data):
-        if data.get("deleted", False):  # No info available on deleted orders
-            return
-
-        self.config_lock.acquire()
+    def market_targets(self, market):
+        """ Names of the running workers trading on market (call with config_lock held) """
+        targets = []
         for worker_name, worker in self.config["workers"].items():
+            if worker_name not in self.workers:
+                continue
             if self.workers[worker_name].disabled:
                 self.workers[worker_name].log.debug('Worker "{}" is disabled'.format(worker_name))
                 continue
-            if worker["market"] == data.market:
-                try:
-                    self.workers[worker_name].onMarketUpdate(data)
-                except Exception as e:
-                    self.workers[worker_name].log.exception("in onMarketUpdate()")
-                    try:
-                        self.workers[worker_name].error_onMarketUpdate(e)
-                    except Exception:
-                        self.workers[worker_name].log.exception("in error_onMarketUpdate()")
-        self.config_lock.release()
+            if worker["market"] == market:
+                targets.append(worker_name)
+        return targets
 
-    def on_account(self, account_update):
-        self.config_lock.acquire()
-        account = account_update.account
+    def account_targets(self, account_name):
+        """ Names of the running workers using account_name (call with config_lock held) """
+        targets = []
         for worker_name, worker in self.config["workers"].items():
+            if worker_name not in self.workers:
+                continue
             if self.workers[worker_name].disabled:
                 self.workers[worker_name].log.info('Worker "{}" is disabled'.format(worker_name))
                 continue
-            if worker["account"] == account["name"]:
-                try:
-                    self.workers[worker_name].onAccount(account_update)
-                except Exception as e:
-                    self.workers[worker_name].log.exception("in onAccountUpdate()")
-                    try:
-                        self.workers[worker_name].error_onAccount(e)
-                    except Exception:
-                        self.workers[worker_name].log.exception("in error_onAccountUpdate()")
-        self.config_lock.release()
+            if worker["account"] == account_name:
+                targets.append(worker_name)
+        return targets
+
+    def dispatch(self, worker_name, event, data):
+        """ Call a worker's event handlers, errors are logged and passed to the
+            worker's error_<event> handler
+        """
+        worker = self.workers[worker_name]
+        registry = metrics.registry
+        token = registry.enter_event(worker_name)
+        try:
+            with registry.timer('callback_seconds', worker=worker_name, event=event):
+                self.profiler.wrap(worker_name, getattr(worker, event))(data)
+        except Exception as e:
+            registry.inc('callback_errors', worker=worker_name, event=event)
+            self.errors[worker_name] += 1
+            self.last_error[worker_name] = "{}: {}".format(type(e).__name__, e)
+            worker.log.exception("in {}()".format(event))
+            try:
+                getattr(worker, 'error_' + event)(e)
+            except Exception:
+                worker.log.exception("in error_{}()".format(event))
+        finally:
+            registry.leave_event(token)
 
     def add_worker(self, worker_name, config):
         with self.config_lock:
             self.config['workers'][worker_name] = config['workers'][worker_name]
-            self.init_workers(config)
+            self.init_worker(worker_name, config)
         self.update_notify()
 
+    def reload_config(self, config):
+        """ Change to a new config (as read from config.yml), leaving the workers
+            whose settings are the same running
+
+            Workers whose settings changed are started again, new ones started, and
+            those no longer in config stopped with their orders cancelled, as on
+            exit. Those moving to another account, market or strategy have their
+            orders cancelled first too. Call from the bot's thread (do_next_tick)
+            Returns (added, changed, removed) worker names
+        """
+        if not config.get('workers'):
+            log.error("The new config has no workers, keeping the old one")
+            return [], [], []
+        for key in ('node', 'reports'):
+            if config.get(key) != self.config.get(key):
+                log.warning("Restart DEXBot for the new {} to be used".format(key))
+        with self.config_lock:
+            old, new = self.config['workers'], config['workers']
+            removed = [worker_name for worker_name in old if worker_name not in new]
+            changed = [worker_name for worker_name in new
+                       if worker_name in old and new[worker_name] != old[worker_name]]
+            added = [worker_name for worker_name in new if worker_name not in old]
+            subscriptions = (set(self.accounts), set(self.markets))
+            for worker_name in removed + changed:
+                moved = worker_name in removed or any(
+                    new[worker_name].get(key) != old[worker_name].get(key) for key in ('account', 'market', 'module'))
+                self.drop_worker(worker_name, pause=moved)
+            self.config = copy.deepcopy(config)
+            for worker_name in changed + added:
+                self.init_worker(worker_name, self.config)
+            running = [worker for worker_name, worker in self.config['workers'].items() if worker_name in self.workers]
+            self.accounts = {worker['account'] for worker in running}
+            self.markets = {worker['market'] for worker in running}
+        storage.db_worker.set_retention(**(self.config.get('retention') or {}))
+        # resubscribing drops all the subscriptions and makes them again: only when needed
+        if (self.accounts, self.markets) != subscriptions:
+            self.update_notify()
+        log.info("Config reloaded: {} added, {} changed, {} removed, {} unchanged".format(
+            len(added), len(changed), len(removed), len(new) - len(added) - len(changed)))
+        return added, changed, removed
+
+    def drop_worker(self, worker_name, pause=False):
+        """ Forget a running worker, pausing it (cancelling its orders) first if pause (call with config_lock held) """
+        worker = self.workers.pop(worker_name, None)
+        if worker is not None and pause:
+            try:
+                worker.pause()
+            except Exception:
+                worker.log.exception("Cannot pause the worker")
+        if self.profiler.enabled(worker_name):
+            self.profiler.disable(worker_name)
+        self.snapshots = {name: snapshot for name, snapshot in self.snapshots.items() if name != worker_name}
+        self.last_tick.pop(worker_name, None)
+
     def run(self):
         self.init_workers(self.config)
         self.update_notify()
@@ -223,7 +433,10 @@ class WorkerInfrastructure(threading.Thread):
             self.accounts.remove(account)
             if pause:
                 self.workers[worker_name].pause()
+            if self.profiler.enabled(worker_name):
+                self.profiler.disable(worker_name)
             self.workers.pop(worker_name, None)
+            self.snapshots = {name: snapshot for name, snapshot in self.snapshots.items() if name != worker_name}
             self.update_notify()
         else:
             # Kill all of the workers
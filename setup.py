@@ -12,6 +12,7 @@ install_requires = [
     "appdirs",
     "sdnotify",
     "matplotlib",
+    "numpy",
     "ruamel.yaml>=0.15.37"
 ]
 
@@ -3,11 +3,13 @@ import threading
 import unittest
 import logging
 import time
-import os
 
 from dexbot.worker import WorkerInfrastructure
+from dexbot.localnode.ledger import Ledger, TEST_WIF
+from dexbot.localnode.server import LocalNode
 
 from bitshares.bitshares import BitShares
+from bitshares.instance import set_shared_bitshares_instance
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,40 +17,66 @@ logging.basicConfig(
 )
 
 
+GENESIS = {
+    'assets': [{'symbol': 'USD', 'precision': 4}],
+    'accounts': [
+        {'name': 'dexbot-test', 'balances': {'TEST': 10000, 'USD': 1000}},
+        {'name': 'trader', 'balances': {'TEST': 10000, 'USD': 1000}}
+    ]
+}
+
 TEST_CONFIG = {
-    'node': 'wss://node.testnet.bitshares.eu',
-    'bots': {
+    'workers': {
         'echo':
         {
-            'account': 'aud.bot.test4',
-            'market': 'TESTUSD:TEST',
+            'account': 'dexbot-test',
+            'market': 'USD:TEST',
             'module': 'dexbot.strategies.echo'
         }
     }
 }
 
-# User needs to put a key in
-KEYS = [os.environ['DEXBOT_TEST_WIF']]
+# The local node's accounts all use this key
+KEYS = [TEST_WIF]
 
 
 class TestDexbot(unittest.TestCase):
 
-    def test_dexbot(self):
-        bitshares_instance = BitShares(node=TEST_CONFIG['node'], keys=KEYS)
-        worker_infrastructure = WorkerInfrastructure(config=TEST_CONFIG,
-                                                     bitshares_instance=bitshares_instance)
+    def setUp(self):
+        self.node = LocalNode(Ledger.from_genesis(GENESIS), block_interval=0.2).start()
+        self.bitshares = BitShares(node=self.node.url, keys=KEYS)
+        set_shared_bitshares_instance(self.bitshares)
 
-        import pdb
-        pdb.set_trace()
+    def tearDown(self):
+        self.node.stop()
+
+    def test_dexbot(self):
+        config = dict(TEST_CONFIG, node=self.node.url)
+        worker_infrastructure = WorkerInfrastructure(config=config, bitshares_instance=self.bitshares)
+        blocks = []
+        worker_infrastructure.on_block = _counted(worker_infrastructure.on_block, blocks)
 
         def wait_then_stop():
-            time.sleep(20)
+            time.sleep(2)
             worker_infrastructure.do_next_tick(worker_infrastructure.stop)
 
         stopper = threading.Thread(target=wait_then_stop)
         stopper.start()
         worker_infrastructure.run()
         stopper.join()
+        self.assertGreater(len(blocks), 3)
+        self.assertIn('echo', worker_infrastructure.workers)
+        snapshot = worker_infrastructure.snapshot('echo')
+        self.assertIsNotNone(snapshot)
+        self.assertEqual(snapshot.market, 'USD:TEST')
+        self.assertIsNotNone(snapshot.last_tick)
+
+
+def _counted(func, calls):
+    def wrapper(*args):
+        calls.append(args)
+        return func(*args)
+    return wrapper
 
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+import asyncio
+import logging
+import time
+import types
+import unittest
+
+from dexbot import aio, metrics
+from dexbot.aio import AsyncWorkerInfrastructure, get_running_loop
+from dexbot.backtest.objects import SimBitShares
+
+
+class Worker:
+    """ Just enough of a strategy to have events dispatched to it """
+
+    def __init__(self, events):
+        self.disabled = False
+        self.log = logging.getLogger(__name__)
+        self.ontick = [lambda block: events.append('ontick')]
+        self.onMarketUpdate = [lambda data: events.append('onMarketUpdate')]
+        self.onAccount = [lambda update: events.append('onAccount')]
+        self.events = events
+
+    def pause(self):
+        self.events.append('pause')
+
+
+class TestAsyncWorkerInfrastructure(unittest.TestCase):
+
+    def setUp(self):
+        config = {'node': 'test', 'workers': {'worker 1': {'account': 'test', 'market': 'USD:BTS'}}}
+        self.infrastructure = AsyncWorkerInfrastructure(config, bitshares_instance=SimBitShares())
+        self.infrastructure.reporters = []
+        self.events = []
+        self.infrastructure.workers['worker 1'] = Worker(self.events)
+
+    @staticmethod
+    def run_loop(coro):
+        """ asyncio.run(), which Python < 3.7 hasn't got """
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            return loop.run_until_complete(coro)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_order(self):
+        # the block's housekeeping is slow: the market update arriving during it waits
+        self.infrastructure.do_next_tick(lambda: time.sleep(0.2))
+
+        async def arrive():
+            block = asyncio.ensure_future(self.infrastructure.on_block_async({}))
+            await asyncio.sleep(0.05)
+            market = self.infrastructure.on_market_async(types.SimpleNamespace(market='USD:BTS'))
+            account = self.infrastructure.on_account_async(types.SimpleNamespace(account={'name': 'test'}))
+            await asyncio.gather(block, market, account)
+        self.run_loop(arrive())
+        self.assertEqual(self.events, ['ontick', 'onMarketUpdate', 'onAccount'])
+
+    def test_other_account(self):
+        async def arrive():
+            await self.infrastructure.on_account_async(types.SimpleNamespace(account={'name': 'other'}))
+            await self.infrastructure.on_market_async(types.SimpleNamespace(market='USD:BTS'))
+        self.run_loop(asyncio.wait_for(arrive(), 5))
+        self.assertEqual(self.events, ['onMarketUpdate'])
+
+    def test_reload(self):
+        # the worker's orders aren't cancelled under a handler still running
+        async def slow_tick(block):
+            await asyncio.sleep(0.2)
+            self.events.append('ontick')
+        self.infrastructure.workers['worker 1'].ontick = [slow_tick]
+        self.infrastructure.init_worker = lambda worker_name, config: self.infrastructure.workers.update(
+            {worker_name: Worker(self.events)})
+        self.infrastructure.notify = types.SimpleNamespace(reset_subscriptions=lambda accounts, markets: None)
+        config = {'node': 'test', 'workers': {'worker 2': {'account': 'test', 'market': 'CNY:BTS'}}}
+
+        async def reload():
+            self.infrastructure.loop = get_running_loop()
+            block = asyncio.ensure_future(self.infrastructure.on_block_async({}))
+            await asyncio.sleep(0.05)
+            changes = await asyncio.wrap_future(self.infrastructure.reload_config(config))
+            await block
+            return changes
+        self.assertEqual(self.run_loop(reload()), (['worker 2'], [], ['worker 1']))
+        self.assertEqual(self.events, ['ontick', 'pause'])
+        self.assertEqual(list(self.infrastructure.workers), ['worker 2'])
+
+    def test_call_without_contextvars(self):
+        # as on Python < 3.7: the worker is handed to the pool thread by call()
+        registry_current, contextvars = metrics.registry.current, aio.contextvars
+        metrics.registry.current, aio.contextvars = metrics.ThreadLocalVar('test'), None
+
+        async def handler():
+            token = metrics.registry.enter_event('worker 1')
+            try:
+                return await aio.call(lambda: metrics.registry.current_worker)
+            finally:
+                metrics.registry.leave_event(token)
+        try:
+            self.assertEqual(self.run_loop(handler()), 'worker 1')
+        finally:
+            metrics.registry.current, aio.contextvars = registry_current, contextvars
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from dexbot.backtest import feed
+from dexbot.backtest.engine import BUY, SELL, MatchingEngine
+from dexbot.backtest.runner import Backtest
+from dexbot.errors import InsufficientFundsError
+
+
+class TestMatchingEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = MatchingEngine(quote=100.0, base=100.0)
+        self.engine.set_book([(0.99, 10.0), (0.98, 10.0)], [(1.01, 10.0), (1.02, 10.0)])
+
+    def test_resting_order(self):
+        order_id, fills = self.engine.place(BUY, 0.95, 10.0)
+        self.assertEqual(fills, [])
+        self.assertAlmostEqual(self.engine.base, 90.5)
+        self.assertEqual(self.engine.locked(), (0, 9.5))
+        self.assertEqual(self.engine.best_bid(), 0.99)
+
+    def test_taker_fill(self):
+        # eats the first ask level and part of the second, at the book's prices
+        order_id, fills = self.engine.place(BUY, 1.05, 15.0)
+        self.assertEqual([(f.price, f.amount, f.maker) for f in fills], [(1.01, 10.0, False), (1.02, 5.0, False)])
+        self.assertNotIn(order_id, self.engine.orders)
+        self.assertAlmostEqual(self.engine.quote, 115.0)
+        self.assertAlmostEqual(self.engine.base, 100.0 - 10.1 - 5.1)
+        self.assertEqual(self.engine.asks, [[1.02, 5.0]])
+
+    def test_maker_fill(self):
+        order_id, fills = self.engine.place(SELL, 1.0, 10.0)
+        self.assertEqual(fills, [])
+        # a sell prints below us: it doesn't fill a sell order
+        self.assertEqual(self.engine.trade(0.995, 4.0, side=SELL), [])
+        fills = self.engine.trade(1.0, 4.0, side=BUY)
+        self.assertEqual([(f.price, f.amount, f.maker) for f in fills], [(1.0, 4.0, True)])
+        self.assertAlmostEqual(self.engine.orders[order_id].amount, 6.0)
+        self.assertAlmostEqual(self.engine.base, 104.0)
+
+    def test_cancel(self):
+        order_id, fills = self.engine.place(SELL, 1.1, 10.0)
+        self.assertEqual(self.engine.quote, 90.0)
+        self.assertTrue(self.engine.cancel(order_id))
+        self.assertEqual(self.engine.quote, 100.0)
+        self.assertEqual(self.engine.own_asks, [])
+        self.assertFalse(self.engine.cancel(order_id))
+
+    def test_insufficient_funds(self):
+        with self.assertRaises(InsufficientFundsError):
+            self.engine.place(SELL, 1.1, 101.0)
+
+
+class TestBacktest(unittest.TestCase):
+
+    config = {
+        'workers': {
+            'worker 1': {
+                'account': 'backtest',
+                'market': 'USD:BTS',
+                'module': 'dexbot.strategies.staggered_orders',
+                'amount': 1,
+                'center_price_dynamic': True,
+                'center_price': 0,
+                'spread': 2,
+                'increment': 1,
+                'upper_bound': 2,
+                'lower_bound': 0.5
+            }
+        }
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        # a random walk around 1.0: a trade every 2 seconds and a book every 20
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.feed = os.path.join(cls.tmpdir, 'feed.csv')
+        rng = random.Random(1)
+        rows = []
+        stamp = 1500000000
+        price = 1.0
+        for i in range(3000):
+            stamp += 2
+            price *= 1 + rng.uniform(-0.01, 0.01)
+            if i % 10 == 0:
+                rows.append((stamp, 'book', 'bid', price * 0.99, 100))
+                rows.append((stamp, 'book', 'ask', price * 1.01, 100))
+            rows.append((stamp, 'trade', rng.choice([BUY, SELL]), price, 5))
+        feed.write_feed(cls.feed, rows)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_staggered_orders(self):
+        backtest = Backtest(self.config, 'worker 1', [self.feed], quote=1000, base=1000)
+        result = backtest.run()
+        # orders that fill as they are placed make the strategy look up assets
+        self.assertFalse(backtest.strategy.disabled)
+        self.assertFalse(result.disabled)
+        self.assertGreater(result.fills, 0)
+        self.assertIn("disabled: False", result.summary())
+
+    def test_disabled(self):
+        # no funds: the strategy disables itself and the result must say so
+        backtest = Backtest(self.config, 'worker 1', [self.feed])
+        result = backtest.run()
+        self.assertTrue(result.disabled)
+        self.assertTrue(result.as_dict()['disabled'])
+        self.assertIn("disabled: True", result.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+import threading
+import time
+import unittest
+from unittest import mock
+
+from bitshares.market import Market
+
+from dexbot.backtest.engine import MatchingEngine
+from dexbot.backtest.objects import SimAsset, SimBitShares, SimMarket
+from dexbot.coalesce import CoalescedMarket, RequestCoalescer, account_key
+
+
+class Node:
+    """ Counts the requests that get through to it, can hold them until released """
+
+    def __init__(self):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def request(self, value):
+        self.calls += 1
+        self.started.set()
+        self.release.wait()
+        return value
+
+
+class TestRequestCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.coalescer = RequestCoalescer()
+        self.node = Node()
+
+    def test_single_flight(self):
+        # callers arriving while the request is in flight wait for its answer
+        self.node.release.clear()
+        results = []
+
+        def caller():
+            results.append(self.coalescer.call(('market', 'USD:BTS', 'ticker'), self.node.request, 'ticker'))
+
+        leader = threading.Thread(target=caller)
+        leader.start()
+        self.node.started.wait()
+        followers = [threading.Thread(target=caller) for i in range(4)]
+        for thread in followers:
+            thread.start()
+        while self.coalescer.stats()['hits'] < 4:
+            time.sleep(0.01)
+        self.node.release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(results, ['ticker'] * 5)
+        self.assertEqual(self.node.calls, 1)
+        self.assertEqual(self.coalescer.stats(), {'hits': 4, 'misses': 1})
+
+    def test_new_block(self):
+        key = ('market', 'USD:BTS', 'ticker')
+        self.coalescer.call(key, self.node.request, 1)
+        self.assertEqual(self.coalescer.call(key, self.node.request, 2), 1)
+        self.coalescer.new_block()
+        self.assertEqual(self.coalescer.call(key, self.node.request, 3), 3)
+        self.assertEqual(self.node.calls, 2)
+
+    def test_invalidate_in_flight(self):
+        # answered, but not kept: it may predate the notification
+        key = ('market', 'USD:BTS', 'ticker')
+        self.node.release.clear()
+        thread = threading.Thread(target=self.coalescer.call, args=(key, self.node.request, 1))
+        thread.start()
+        self.node.started.wait()
+        self.coalescer.invalidate(('market', 'USD:BTS'))
+        self.node.release.set()
+        thread.join()
+        self.assertEqual(self.coalescer.call(key, self.node.request, 2), 2)
+        self.assertEqual(self.node.calls, 2)
+
+    def test_error(self):
+        def fail():
+            raise ValueError('node down')
+
+        key = ('market', 'USD:BTS', 'ticker')
+        with self.assertRaises(ValueError):
+            self.coalescer.call(key, fail)
+        self.assertEqual(self.coalescer.call(key, self.node.request, 1), 1)
+
+
+class TestCoalescedMarket(unittest.TestCase):
+
+    def setUp(self):
+        bitshares = SimBitShares()
+        bitshares.market = SimMarket(
+            'USD:BTS', MatchingEngine(quote=1000, base=1000),
+            SimAsset('1.3.1', 'USD', 5, bitshares),
+            SimAsset('1.3.0', 'BTS', 5, bitshares))
+        self.coalescer = RequestCoalescer()
+        self.market = CoalescedMarket('USD:BTS', bitshares_instance=bitshares, coalescer=self.coalescer)
+        self.node = Node()
+
+    def test_broadcast(self):
+        # our own order changes the account, but not what others see of the market
+        alice = account_key('alice') + (False,)
+        bob = account_key('bob') + (False,)
+        ticker = ('market', 'USD:BTS', 'ticker')
+        for key in (alice, bob, ticker):
+            self.coalescer.call(key, self.node.request, 1)
+        with mock.patch.object(Market, 'buy', return_value={}) as buy:
+            self.market.buy(1, 10, account='alice')
+        buy.assert_called_once_with(1, 10, account='alice')
+        self.assertEqual(self.coalescer.call(alice, self.node.request, 2), 2)
+        self.assertEqual(self.coalescer.call(bob, self.node.request, 2), 1)
+        self.assertEqual(self.coalescer.call(ticker, self.node.request, 2), 1)
+
+    def test_failed_broadcast(self):
+        # the transaction may still have made it to the node
+        alice = account_key('alice') + (False,)
+        self.coalescer.call(alice, self.node.request, 1)
+        with mock.patch.object(Market, 'sell', side_effect=ValueError('timeout')):
+            with self.assertRaises(ValueError):
+                self.market.sell(1, 10, account='alice')
+        self.assertEqual(self.coalescer.call(alice, self.node.request, 2), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
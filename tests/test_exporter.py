@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+import unittest
+import urllib.request
+
+from dexbot import exporter, metrics
+
+
+class Worker:
+
+    def __init__(self, disabled=False):
+        self.disabled = disabled
+
+
+class Infrastructure:
+    """ Just enough of a WorkerInfrastructure to be scraped """
+
+    def __init__(self, workers):
+        self.workers = workers
+
+
+class TestRender(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_text_format(self):
+        self.registry.inc('callback_errors', 2, worker='worker1', event='ontick')
+        self.registry.set('worker_balance', 1.5, worker='say "hi"\n', asset='BTS')
+        self.registry.observe('broadcast_seconds', 0.002, worker='worker1', op='buy')
+        self.registry.observe('broadcast_seconds', 0.5, worker='worker1', op='buy')
+        self.registry.observe('broadcast_seconds', 60.0, worker='worker1', op='buy')
+        lines = exporter.render(self.registry.collect()).splitlines()
+
+        self.assertEqual(lines[:5], [
+            '# HELP dexbot_broadcast_seconds Time to place or cancel orders, retries included',
+            '# TYPE dexbot_broadcast_seconds histogram',
+            'dexbot_broadcast_seconds_bucket{le="0.001",op="buy",worker="worker1"} 0',
+            'dexbot_broadcast_seconds_bucket{le="0.0025",op="buy",worker="worker1"} 1',
+            'dexbot_broadcast_seconds_bucket{le="0.005",op="buy",worker="worker1"} 1',
+        ])
+        # the buckets, +Inf included, then the sum and the count
+        end = 2 + len(metrics.BUCKETS) + 1 + 2
+        self.assertEqual(lines[end - 5:end], [
+            'dexbot_broadcast_seconds_bucket{le="10.0",op="buy",worker="worker1"} 2',
+            'dexbot_broadcast_seconds_bucket{le="30.0",op="buy",worker="worker1"} 2',
+            'dexbot_broadcast_seconds_bucket{le="+Inf",op="buy",worker="worker1"} 3',
+            'dexbot_broadcast_seconds_sum{op="buy",worker="worker1"} 60.502',
+            'dexbot_broadcast_seconds_count{op="buy",worker="worker1"} 3',
+        ])
+        self.assertEqual(lines[end:], [
+            '# HELP dexbot_callback_errors_total Event handlers that raised',
+            '# TYPE dexbot_callback_errors_total counter',
+            'dexbot_callback_errors_total{event="ontick",worker="worker1"} 2',
+            '# HELP dexbot_worker_balance Balance of the worker\'s account in the assets of its market',
+            '# TYPE dexbot_worker_balance gauge',
+            'dexbot_worker_balance{asset="BTS",worker="say \\"hi\\"\\n"} 1.5',
+        ])
+
+    def test_collect_copies(self):
+        # what is being rendered doesn't change under the exporter
+        self.registry.observe('broadcast_seconds', 0.002, worker='worker1', op='buy')
+        self.registry.inc('callback_errors', worker='worker1', event='ontick')
+        collected = self.registry.collect()
+        self.registry.observe('broadcast_seconds', 0.5, worker='worker1', op='buy')
+        self.registry.inc('callback_errors', worker='worker1', event='ontick')
+        histogram = collected[0][2]
+        self.assertEqual((histogram.count, histogram.sum, sum(histogram.counts)), (1, 0.002, 1))
+        self.assertEqual(collected[1][2].value, 1)
+
+
+class TestExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.infrastructure = Infrastructure({'worker1': Worker(), 'worker2': Worker(disabled=True)})
+        self.exporter = exporter.Exporter(self.infrastructure, port=0, registry=self.registry).start()
+
+    def tearDown(self):
+        self.exporter.stop()
+
+    def scrape(self):
+        with urllib.request.urlopen(self.exporter.url) as response:
+            self.assertEqual(response.headers['Content-Type'], exporter.CONTENT_TYPE)
+            return response.read().decode('utf-8').splitlines()
+
+    def test_scrape(self):
+        lines = self.scrape()
+        self.assertIn('dexbot_worker_disabled{worker="worker1"} 0', lines)
+        self.assertIn('dexbot_worker_disabled{worker="worker2"} 1', lines)
+        self.assertIn('# TYPE dexbot_storage_queue_depth gauge', lines)
+        # a stopped worker's gauges go
+        del self.infrastructure.workers['worker2']
+        lines = self.scrape()
+        self.assertNotIn('dexbot_worker_disabled{worker="worker2"} 1', lines)
+        self.assertIn('dexbot_worker_running{worker="worker1"} 1', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+import datetime
+import os
+import tempfile
+import unittest
+
+from dexbot import graph
+
+START = datetime.datetime(2018, 1, 1)
+
+
+def bucket(hour, price):
+    stamp = START + datetime.timedelta(hours=hour)
+    return [(stamp, 'price', price), (stamp, 'USD', 10.0), (stamp, 'BTS', 100.0)]
+
+
+class Source:
+    """ Stands in for a worker's Storage: hourly buckets, and the queries made """
+
+    category = 'worker'
+
+    def __init__(self, hours):
+        self.rows = [row for hour in range(hours) for row in bucket(hour, 1.0 + hour / 10)]
+        self.high_water = 1
+        self.queries = []
+        # how far the clock has moved a relative start on
+        self.moved = datetime.timedelta(0)
+
+    def journal_high_water(self):
+        return self.high_water
+
+    def journal_window(self, start, end_=None):
+        return START + self.moved if start == '7d' else start, 'hour'
+
+    def query_journal_buckets(self, start, end_=None, resolution='auto', value='last'):
+        self.queries.append(start)
+        return [row for row in self.rows if row[0] >= start]
+
+
+class TestGraphCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = graph.GraphCache(self.directory.name)
+        self.source = Source(10)
+
+    def tearDown(self):
+        self.cache.clear()
+        self.directory.cleanup()
+
+    def test_hit(self):
+        path = self.cache.journal_graph(self.source, START, None, 'USD', 'BTS')
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.cache.journal_graph(self.source, START, None, 'USD', 'BTS'), path)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.source.queries, [START])
+
+    def test_extend(self):
+        self.cache.journal_graph(self.source, START, None, 'USD', 'BTS')
+        # the last bucket grows and a new one starts
+        self.source.rows = self.source.rows[:-3] + bucket(9, 5.0) + bucket(10, 6.0)
+        self.source.high_water = 2
+        path = self.cache.journal_graph(self.source, START, None, 'USD', 'BTS')
+        self.assertTrue(os.path.exists(path))
+        # only read again from the last bucket on
+        self.assertEqual(self.source.queries, [START, START + datetime.timedelta(hours=9)])
+        entry = self.cache.entries[(self.source.category, START, None, 'USD', 'BTS')]
+        self.assertEqual(entry['rows'], self.source.rows)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_relative_start(self):
+        first = self.cache.journal_graph(self.source, '7d', None, 'USD', 'BTS')
+        self.source.moved = datetime.timedelta(minutes=30)
+        self.assertEqual(self.cache.journal_graph(self.source, '7d', None, 'USD', 'BTS'), first)
+        self.assertEqual(self.cache.hits, 1)
+        # the window has moved on by a bucket: drawn again, from the rows it has
+        self.source.moved = datetime.timedelta(hours=1)
+        self.cache.journal_graph(self.source, '7d', None, 'USD', 'BTS')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(self.source.queries, [START])
+        entry = self.cache.entries[(self.source.category, '7d', None, 'USD', 'BTS')]
+        self.assertEqual(entry['since'], START + datetime.timedelta(hours=1))
+        self.assertEqual(entry['rows'][0][0], START + datetime.timedelta(hours=1))
+
+    def test_reuse(self):
+        # a shorter period takes its rows from the longer one
+        self.cache.journal_graph(self.source, START, None, 'USD', 'BTS')
+        later = START + datetime.timedelta(hours=5)
+        self.assertIsNotNone(self.cache.journal_graph(self.source, later, None, 'USD', 'BTS'))
+        self.assertEqual(self.source.queries, [START])
+        entry = self.cache.entries[(self.source.category, later, None, 'USD', 'BTS')]
+        self.assertEqual(entry['rows'], [row for row in self.source.rows if row[0] >= later])
+
+    def test_evict(self):
+        self.cache.max_entries = 1
+        first = self.cache.journal_graph(self.source, START, None, 'USD', 'BTS')
+        second = self.cache.journal_graph(self.source, START, None, 'BTS', 'USD')
+        self.assertEqual(list(self.cache.entries), [(self.source.category, START, None, 'BTS', 'USD')])
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+
+if __name__ == '__main__':
+    unittest.main()
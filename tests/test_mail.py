@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+import base64
+import datetime
+import io
+import os
+import tempfile
+import unittest
+
+from dexbot.report.mail import ReportWriter
+
+
+class Worker:
+    """ Just enough of a worker for a report section """
+
+    def __init__(self, graph):
+        self.graph_file = graph
+
+    def graph(self, start=None):
+        return self.graph_file
+
+    def query_journal_buckets(self, start):
+        return []
+
+    def query_log_summary(self, start, top=10):
+        return {}, []
+
+
+class TestReportWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.graph = os.path.join(self.directory.name, 'graph.png')
+        with open(self.graph, 'wb') as fd:
+            fd.write(b'\x89PNG not really')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def section(self, worker, files=None, **options):
+        fd = io.StringIO()
+        ReportWriter(fd, datetime.datetime(2018, 1, 1), **options).worker('worker 1', worker, {'spread': 2}, files)
+        return fd.getvalue()
+
+    def test_embedded(self):
+        # the saved report doesn't depend on the graph cache's file
+        text = self.section(Worker(self.graph), embed_graphs=True)
+        os.remove(self.graph)
+        self.assertIn('<img src="data:image/png;base64,{}">'.format(
+            base64.b64encode(b'\x89PNG not really').decode('ascii')), text)
+        self.assertNotIn(self.graph, text)
+
+    def test_attached(self):
+        files = []
+        text = self.section(Worker(self.graph), files)
+        self.assertIn('<img src="cid:graph.png">', text)
+        self.assertEqual(files, [self.graph])
+
+    def test_no_graph(self):
+        self.assertIn("Not enough data to graph", self.section(Worker(None), embed_graphs=True))
+        os.remove(self.graph)
+        self.assertIn("The graph is not available", self.section(Worker(self.graph), embed_graphs=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+import threading
+import unittest
+
+from dexbot import metrics
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counters(self):
+        self.registry.inc('callback_errors', worker='worker1', event='ontick')
+        self.registry.inc('callback_errors', 2, event='ontick', worker='worker1')
+        self.assertEqual(self.registry.get(metrics.Counter, 'callback_errors',
+                                           {'worker': 'worker1', 'event': 'ontick'}).value, 3)
+
+    def current_worker(self):
+        self.assertEqual(self.registry.current_worker, metrics.NO_WORKER)
+        token = self.registry.enter_event('worker1')
+        self.assertEqual(self.registry.current_worker, 'worker1')
+        inner = self.registry.enter_event('worker2')
+        self.assertEqual(self.registry.current_worker, 'worker2')
+        self.registry.leave_event(inner)
+        self.assertEqual(self.registry.current_worker, 'worker1')
+        # other threads aren't handling the event
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(self.registry.current_worker))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [metrics.NO_WORKER])
+        self.registry.leave_event(token)
+        self.assertEqual(self.registry.current_worker, metrics.NO_WORKER)
+
+    def test_current_worker(self):
+        self.current_worker()
+
+    def test_current_worker_per_thread(self):
+        # as on Python < 3.7, without contextvars
+        self.registry.current = metrics.ThreadLocalVar('test')
+        self.current_worker()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+import os
+import tempfile
+import unittest
+
+from bitshares.account import AccountUpdate
+from bitshares.instance import SharedInstance, set_shared_bitshares_instance
+from bitshares.price import Order, FilledOrder
+
+from dexbot import recording
+from dexbot.backtest.engine import MatchingEngine
+from dexbot.backtest.objects import SimAsset, SimBitShares, SimMarket
+
+FILL = {'id': '1.11.1', 'order_id': '1.7.5', 'account_id': '1.2.100', 'is_maker': True,
+        'pays': {'amount': 100000, 'asset_id': '1.3.1'},
+        'receives': {'amount': 200000, 'asset_id': '1.3.0'},
+        'fee': {'amount': 0, 'asset_id': '1.3.0'}}
+ORDER = {'id': '1.7.6', 'seller': '1.2.100', 'for_sale': 300000,
+         'sell_price': {'base': {'amount': 300000, 'asset_id': '1.3.0'},
+                        'quote': {'amount': 100000, 'asset_id': '1.3.1'}}}
+STATISTICS = {'id': '2.6.100', 'owner': '1.2.100', 'total_ops': 5}
+
+
+class Infrastructure:
+    """ Stands in for a WorkerInfrastructure: remembers the events it is given """
+
+    def __init__(self, bitshares):
+        self.bitshares = bitshares
+        self.events = []
+
+    def on_block(self, data):
+        self.events.append(('block', data))
+
+    def on_market(self, data):
+        self.events.append(('market', data))
+
+    def on_account(self, account_update):
+        self.events.append(('account', account_update))
+
+
+class TestRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'incident.rec.gz')
+        self.bitshares = SimBitShares()
+        self.bitshares.market = SimMarket(
+            'USD:BTS', MatchingEngine(quote=1000, base=1000),
+            SimAsset('1.3.1', 'USD', 5, self.bitshares),
+            SimAsset('1.3.0', 'BTS', 5, self.bitshares))
+        # python-bitshares builds FilledOrder prices with the shared instance
+        self.shared = SharedInstance.instance
+        set_shared_bitshares_instance(self.bitshares)
+
+    def tearDown(self):
+        SharedInstance.instance = self.shared
+        self.directory.cleanup()
+
+    def record(self):
+        recorder = recording.Recorder(self.path)
+        recorder.on_block('00000001')
+        recorder.on_market(FilledOrder(dict(FILL), bitshares_instance=self.bitshares))
+        recorder.on_block('00000002')
+        recorder.on_market(Order(dict(ORDER), bitshares_instance=self.bitshares))
+        recorder.on_market({'id': '1.7.5', 'deleted': True})
+        recorder.on_account(AccountUpdate(dict(STATISTICS), bitshares_instance=self.bitshares))
+        recorder.close()
+        self.assertEqual(recorder.count, 6)
+
+    def test_round_trip(self):
+        self.record()
+        infrastructure = Infrastructure(self.bitshares)
+        count, seconds = recording.Replay(self.path, infrastructure).run()
+        self.assertEqual(count, 6)
+        events = infrastructure.events
+        self.assertEqual([kind for kind, data in events],
+                         ['block', 'market', 'block', 'market', 'market', 'account'])
+        self.assertEqual([events[0][1], events[2][1]], ['00000001', '00000002'])
+
+        fill = events[1][1]
+        self.assertIsInstance(fill, FilledOrder)
+        self.assertEqual(recording.raw_market_event(fill), ('filled', FILL))
+        self.assertEqual(fill['quote']['symbol'], 'USD')
+        self.assertAlmostEqual(fill['price'], 2.0)
+
+        order = events[3][1]
+        self.assertIsInstance(order, Order)
+        self.assertEqual(order['id'], '1.7.6')
+        self.assertEqual(order['sell_price'], ORDER['sell_price'])
+        self.assertAlmostEqual(order['price'], 3.0)
+
+        self.assertIsInstance(events[4][1], recording.DeletedOrder)
+        self.assertEqual(events[4][1], {'id': '1.7.5', 'deleted': True})
+        self.assertIsInstance(events[5][1], AccountUpdate)
+        self.assertEqual(dict(events[5][1]), STATISTICS)
+
+    def test_append(self):
+        # a second run adds to the recording
+        self.record()
+        self.record()
+        stamps = [stamp for stamp, kind, payload in recording.read_recording(self.path)]
+        self.assertEqual(len(stamps), 12)
+        self.assertEqual(stamps, sorted(stamps))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+import uuid
+
+from dexbot import storage
+
+
+class TestSQLiteHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.category = 'test-' + uuid.uuid4().hex[:8]
+        self.logger = logging.getLogger('dexbot.test.' + self.category)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        storage.Storage(self.category).clear()
+
+    def messages(self):
+        return [row.message for row in storage.Storage(self.category).query_log(datetime.datetime(2000, 1, 1))]
+
+    def test_batching(self):
+        self.handler = storage.SQLiteHandler(batch_size=5, flush_interval=3600)
+        self.logger.addHandler(self.handler)
+        for i in range(7):
+            self.logger.info("line %d", i, extra={'worker_name': self.category})
+        # the first 5 went as a batch, 2 wait in the buffer
+        self.assertEqual(len(self.handler.buffer), 2)
+        self.handler.flush(wait=True)
+        self.assertEqual(self.messages(), ["line {}".format(i) for i in range(7)])
+        self.assertEqual(self.handler.pending, 0)
+
+    def test_overload(self):
+        self.handler = storage.SQLiteHandler(batch_size=1000, flush_interval=3600, max_pending=10)
+        self.logger.addHandler(self.handler)
+        for i in range(50):
+            self.logger.info("line %d", i, extra={'worker_name': self.category})
+        # warnings are never dropped
+        self.logger.warning("kept", extra={'worker_name': self.category})
+        self.assertEqual(len(self.handler.buffer), 11)
+        self.handler.flush(wait=True)
+        self.assertEqual(self.handler.pending, 0)
+        messages = self.messages()
+        self.assertEqual(len(messages), 12)
+        self.assertIn("kept", messages)
+        self.assertIn("40 log records dropped, the database was too busy", messages)
+        # and after draining, records are taken again
+        self.logger.info("again", extra={'worker_name': self.category})
+        self.handler.flush(wait=True)
+        self.assertIn("again", self.messages())
+        self.assertEqual(self.handler.pending, 0)
+
+
+class TestCompaction(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = storage.DatabaseWorker(os.path.join(self.directory.name, 'test.sqlite'))
+        self.now = datetime.datetime.now()
+
+    def tearDown(self):
+        self.db.stop()
+        self.directory.cleanup()
+
+    def run_task(self, func):
+        """ func(session) on the database thread, returns its result """
+        def task(token):
+            self.db._set_result(token, func(self.db.session))
+        return self.db.execute(task)
+
+    def add(self, *rows):
+        def add_rows(session):
+            session.add_all(rows)
+            session.commit()
+        self.run_task(add_rows)
+
+    def journal(self, days_ago, hour, minute, amount, key='BTS'):
+        day = self.now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=days_ago)
+        stamp = day.replace(hour=hour, minute=minute)
+        return storage.Journal(category='worker', key=key, amount=amount, stamp=stamp)
+
+    def buckets(self, resolution):
+        return self.run_task(lambda session: [
+            (b.start.hour, b.count, b.sum, b.min, b.max, b.first, b.last)
+            for b in session.query(storage.JournalBucket).filter_by(resolution=resolution).order_by(
+                storage.JournalBucket.start)])
+
+    def test_roll_up(self):
+        self.add(self.journal(1, 10, 5, 1.0), self.journal(1, 10, 30, 3.0), self.journal(1, 11, 10, 2.0))
+        self.db.compact()
+        self.assertEqual(self.buckets('hour'), [(10, 2, 4.0, 1.0, 3.0, 1.0, 3.0), (11, 1, 2.0, 2.0, 2.0, 2.0, 2.0)])
+        self.assertEqual(self.buckets('day'), [(0, 3, 6.0, 1.0, 3.0, 1.0, 2.0)])
+        # rows written later add to the buckets already there
+        self.add(self.journal(1, 11, 50, 5.0))
+        self.db.compact()
+        self.assertEqual(self.buckets('hour')[1], (11, 2, 7.0, 2.0, 5.0, 2.0, 5.0))
+        self.assertEqual(self.buckets('day'), [(0, 4, 11.0, 1.0, 5.0, 1.0, 5.0)])
+        means = self.db.execute(self.db.query_journal_buckets, 'worker', self.now - datetime.timedelta(days=2),
+                                None, 'hour', 'mean')
+        self.assertEqual([value for stamp, key, value in means], [2.0, 3.5])
+
+    def test_prune(self):
+        self.db.set_retention(journal_days=30, hourly_days=365, daily_days=None, log_days=90)
+        old = self.now - datetime.timedelta(days=100)
+        new = self.now - datetime.timedelta(days=1)
+        self.add(self.journal(1, 12, 0, 1.0), self.journal(40, 12, 0, 2.0), self.journal(400, 12, 0, 3.0),
+                 storage.Log(category='worker', severity=1, message='old', stamp=old),
+                 storage.Log(category='worker', severity=1, message='new', stamp=new))
+        self.db.compact()
+        # raw rows after 30 days, but only once they're in the buckets
+        self.assertEqual(self.run_task(lambda session: [row.amount for row in session.query(storage.Journal)]), [1.0])
+        # hourly buckets after a year, daily ones are kept
+        self.assertEqual([b[2] for b in self.buckets('hour')], [2.0, 1.0])
+        self.assertEqual([b[2] for b in self.buckets('day')], [3.0, 2.0, 1.0])
+        self.assertEqual(self.run_task(lambda session: [row.message for row in session.query(storage.Log)]), ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
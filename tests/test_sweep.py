@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+import csv
+import os
+import random
+import tempfile
+import unittest
+
+from dexbot import storage, sweep
+from dexbot.backtest import feed
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.elements = sweep.config_elements('dexbot.strategies.staggered_orders')
+
+    def test_parse_spec(self):
+        self.assertEqual(sweep.parse_spec('increment=0.5:3', self.elements), ('increment', (0.5, 3.0)))
+        self.assertEqual(sweep.parse_spec('spread=1,2,4', self.elements), ('spread', [1.0, 2.0, 4.0]))
+        self.assertEqual(sweep.parse_spec('center_price_dynamic', self.elements),
+                         ('center_price_dynamic', [False, True]))
+        with self.assertRaises(sweep.SweepError):
+            sweep.parse_spec('nonsense', self.elements)
+
+    def test_unbounded(self):
+        # spread has no maximum: up to twice the worker's value, or the default
+        self.assertEqual(sweep.parse_spec('spread', self.elements), ('spread', (0.0, 12.0)))
+        self.assertEqual(sweep.parse_spec('spread', self.elements, {'spread': 2}), ('spread', (0.0, 4.0)))
+        # nothing to go on for a centre price of 0
+        with self.assertRaises(sweep.SweepError):
+            sweep.parse_spec('center_price', self.elements)
+
+    def test_grid(self):
+        ranges = dict(sweep.parse_spec(spec, self.elements) for spec in ['spread=1:3', 'center_price_dynamic'])
+        combinations = list(sweep.grid(ranges, self.elements, 3))
+        self.assertEqual(len(combinations), 6)
+        self.assertEqual(sorted(set(c['spread'] for c in combinations)), [1.0, 2.0, 3.0])
+
+    def test_random_samples(self):
+        ranges = {'spread': (1.0, 3.0), 'center_price_dynamic': [False, True]}
+        samples = list(sweep.random_samples(ranges, self.elements, 20, seed=1))
+        self.assertEqual(len(samples), 20)
+        self.assertTrue(all(1.0 <= s['spread'] <= 3.0 for s in samples))
+        self.assertEqual(samples, list(sweep.random_samples(ranges, self.elements, 20, seed=1)))
+
+    def test_rank(self):
+        results = [
+            ({'spread': 1}, {'profit': 1.0, 'disabled': False}),
+            ({'spread': 2}, {'profit': 5.0, 'disabled': True}),
+            ({'spread': 3}, {'profit': 3.0, 'disabled': False}),
+        ]
+        self.assertEqual([p['spread'] for p, r in sweep.rank(results)], [3, 1])
+        self.assertEqual([p['spread'] for p, r in sweep.rank(results, disabled=True)], [2, 3, 1])
+        self.assertEqual([p['spread'] for p, r in sweep.rank(results, top=1)], [3])
+
+
+class TestSweepRun(unittest.TestCase):
+
+    config = {
+        'workers': {
+            'worker 1': {
+                'account': 'backtest',
+                'market': 'USD:BTS',
+                'module': 'dexbot.strategies.staggered_orders',
+                'amount': 1,
+                'center_price_dynamic': True,
+                'center_price': 0,
+                'spread': 2,
+                'increment': 1,
+                'upper_bound': 2,
+                'lower_bound': 0.5
+            }
+        }
+    }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.feed = os.path.join(self.directory.name, 'feed.csv')
+        rng = random.Random(1)
+        rows = []
+        price = 1.0
+        for i in range(500):
+            price *= 1 + rng.uniform(-0.01, 0.01)
+            if i % 10 == 0:
+                rows.append((1500000000 + 2 * i, 'book', 'bid', price * 0.99, 100))
+                rows.append((1500000000 + 2 * i, 'book', 'ask', price * 1.01, 100))
+            rows.append((1500000000 + 2 * i, 'trade', rng.choice(['buy', 'sell']), price, 5))
+        feed.write_feed(self.feed, rows)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sweep(self):
+        output = os.path.join(self.directory.name, 'sweep.csv')
+        combinations = [{'spread': 1.0}, {'spread': 2.0}, {'spread': 4.0}]
+        results = sweep.sweep(self.config, 'worker 1', [self.feed], combinations, output, processes=2,
+                              quote=1000, base=1000)
+        self.assertEqual(sorted(params['spread'] for params, result in results), [1.0, 2.0, 4.0])
+        with open(output) as fd:
+            rows = list(csv.DictReader(fd))
+        self.assertEqual(sorted(float(row['spread']) for row in rows), [1.0, 2.0, 4.0])
+        self.assertTrue(all(row['error'] == '' for row in rows))
+
+    def test_process_database(self):
+        # a pool process swaps the database it inherited or opened for its own
+        db_worker = storage.db_worker
+        inherited = storage.DatabaseWorker(os.path.join(self.directory.name, 'inherited.sqlite'))
+        storage.db_worker = inherited
+        try:
+            sweep.init_process(self.directory.name)
+            self.assertFalse(inherited.is_alive())
+            self.assertIsNot(storage.db_worker, inherited)
+            self.assertTrue(os.path.exists(os.path.join(self.directory.name, 'sweep-{}.sqlite'.format(os.getpid()))))
+        finally:
+            if storage.db_worker is not inherited:
+                storage.db_worker.stop()
+            storage.db_worker = db_worker
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+import copy
+import unittest
+
+from dexbot.backtest.objects import SimBitShares
+from dexbot.worker import WorkerInfrastructure
+
+
+class Worker:
+    """ Stands in for a strategy: remembers being paused """
+
+    def __init__(self, name, settings, paused):
+        self.name = name
+        self.settings = settings
+        self.paused = paused
+        self.disabled = False
+
+    def pause(self):
+        self.paused.append(self.name)
+
+
+class Notify:
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def reset_subscriptions(self, accounts, markets):
+        self.subscriptions.append((sorted(accounts), sorted(markets)))
+
+
+class Infrastructure(WorkerInfrastructure):
+
+    def init_worker(self, worker_name, config):
+        worker = config['workers'][worker_name]
+        self.workers[worker_name] = Worker(worker_name, dict(worker), self.paused)
+        self.markets.add(worker['market'])
+        self.accounts.add(worker['account'])
+
+
+class TestReloadConfig(unittest.TestCase):
+
+    config = {
+        'node': 'test',
+        'workers': {
+            'worker 1': {'account': 'alice', 'market': 'USD:BTS', 'module': 'test', 'spread': 1},
+            'worker 2': {'account': 'alice', 'market': 'CNY:BTS', 'module': 'test', 'spread': 1},
+            'worker 3': {'account': 'bob', 'market': 'USD:BTS', 'module': 'test', 'spread': 1}
+        }
+    }
+
+    def setUp(self):
+        self.infrastructure = Infrastructure(self.config, bitshares_instance=SimBitShares())
+        self.infrastructure.paused = []
+        self.infrastructure.init_workers(self.infrastructure.config)
+        self.infrastructure.notify = Notify()
+
+    def test_unchanged(self):
+        workers = dict(self.infrastructure.workers)
+        self.assertEqual(self.infrastructure.reload_config(copy.deepcopy(self.config)), ([], [], []))
+        self.assertEqual(self.infrastructure.workers, workers)
+        self.assertEqual(self.infrastructure.notify.subscriptions, [])
+
+    def test_diff(self):
+        config = copy.deepcopy(self.config)
+        config['workers']['worker 1']['spread'] = 2
+        config['workers']['worker 2']['market'] = 'EUR:BTS'
+        del config['workers']['worker 3']
+        config['workers']['worker 4'] = {'account': 'carol', 'market': 'USD:BTS', 'module': 'test'}
+        worker_1 = self.infrastructure.workers['worker 1']
+        added, changed, removed = self.infrastructure.reload_config(config)
+        self.assertEqual((added, changed, removed), (['worker 4'], ['worker 1', 'worker 2'], ['worker 3']))
+        # worker 1 is started again with its new settings, but its orders can stay
+        self.assertIsNot(self.infrastructure.workers['worker 1'], worker_1)
+        self.assertEqual(self.infrastructure.workers['worker 1'].settings['spread'], 2)
+        # worker 2 moved market and worker 3 went: their orders are cancelled
+        self.assertEqual(sorted(self.infrastructure.paused), ['worker 2', 'worker 3'])
+        self.assertEqual(sorted(self.infrastructure.workers), ['worker 1', 'worker 2', 'worker 4'])
+        self.assertEqual(self.infrastructure.notify.subscriptions, [(['alice', 'carol'], ['EUR:BTS', 'USD:BTS'])])
+
+    def test_same_subscriptions(self):
+        # a change that needs no new subscriptions doesn't resubscribe
+        config = copy.deepcopy(self.config)
+        config['workers']['worker 3']['spread'] = 2
+        self.assertEqual(self.infrastructure.reload_config(config), ([], ['worker 3'], []))
+        self.assertEqual(self.infrastructure.paused, [])
+        self.assertEqual(self.infrastructure.notify.subscriptions, [])
+
+    def test_no_workers(self):
+        workers = dict(self.infrastructure.workers)
+        self.assertEqual(self.infrastructure.reload_config({'node': 'test', 'workers': {}}), ([], [], []))
+        self.assertEqual(self.infrastructure.workers, workers)
+
+
+if __name__ == '__main__':
+    unittest.main()